@@ -5,11 +5,12 @@
 #include <WiFi.h>
 #include <HTTPClient.h>
 #include <ArduinoJson.h>
+#include <sys/time.h>
 
 // ===== WIFI SETTINGS - FILL IN YOUR INFO =====
 const char* ssid = "Mars";           // Your WiFi network name
 const char* password = "mn0Tb1T$%s";       // Your WiFi password
-const char* serverUrl = "http://192.168.8.100:5020/sensor_data";  // Your Pi's IP
+const char* serverUrl = "http://192.168.8.100:5020/sensor_data/batch";  // Your Pi's IP
 // ==============================================
 
 Adafruit_BME680 bme;
@@ -49,8 +50,43 @@ float gasBaseline = 0;
 int baselineSamples = 0;
 const int BASELINE_SAMPLES_NEEDED = 50;  // ~5 minutes of readings
 
-unsigned long lastSendTime = 0;
-const unsigned long sendInterval = 60000;  // Send data every 60 seconds
+// Readings are sampled into a RAM ring buffer and uploaded in batches over
+// one kept-alive connection. While WiFi or the server is down they stay in
+// the buffer (the oldest are overwritten once it is full) and go out as
+// soon as the link is back. The buffer is lost on a reboot.
+const unsigned long sampleInterval = 60000;     // Buffer a reading every 60 seconds
+const unsigned long uploadInterval = 60000;     // Upload the buffer every 60 seconds
+const unsigned long reconnectInterval = 30000;  // Retry WiFi this often while offline
+const int BUFFER_SIZE = 1440;  // 24 hours at one reading per minute (~58 KB)
+const int MAX_BATCH = 120;     // Readings per upload
+
+struct Reading {
+  int64_t epochMs;        // Wall-clock time when sampled, 0 until NTP has set the clock
+  unsigned long takenAt;  // millis() when sampled
+  float temperature;
+  float humidity;
+  float pressure;
+  float gasResistance;
+  float airQualityScore;
+  float estimatedCO2;
+  bool calibrated;
+};
+
+Reading readingBuffer[BUFFER_SIZE];
+int bufferStart = 0;     // Index of the oldest buffered reading
+int bufferCount = 0;
+int inFlight = 0;        // Oldest readings sent in the current batch, resent as-is until answered
+uint32_t bootId = 0;     // Random per boot so the server can tell restarts apart
+uint32_t uploadSeq = 0;  // Number of the current batch, the server skips ones it already saved
+
+// Field order of each row in an upload, after the time field: "ts" (epoch
+// milliseconds) once the clock is set, "age_ms" before that
+const char* UPLOAD_FIELDS[] = {"temperature", "humidity", "pressure", "gas_resistance",
+                               "air_quality_score", "estimated_co2", "calibrated"};
+
+unsigned long lastSampleTime = 0;
+unsigned long lastUploadTime = 0;
+unsigned long lastReconnectTime = 0;
 
 bool wifiConnected = false;
 
@@ -58,7 +94,10 @@ bool wifiConnected = false;
 void connectWiFi();
 void readSensors();
 void calculateAirQuality();
-void sendDataToServer();
+void bufferReading();
+bool uploadBuffered();
+void checkWiFi();
+int64_t epochNowMs();
 void drawTemperatureScreen();
 void drawHumidityScreen();
 void drawPressureScreen();
@@ -112,8 +151,12 @@ void setup() {
   M5.Display.drawString("Sensor OK", 64, 50);
   M5.Display.drawString("Calibrating...", 64, 65);
   
+  bootId = esp_random();
+
   // Connect to WiFi
   connectWiFi();
+  configTime(0, 0, "pool.ntp.org", "time.google.com");  // Syncs in the background once online
+  http.setReuse(true);  // Keep the connection to the server open between uploads
   
   delay(2000);
 }
@@ -264,40 +307,146 @@ void calculateAirQuality() {
   }
 }
 
-void sendDataToServer() {
+void bufferReading() {
+  if (bufferCount == BUFFER_SIZE) {
+    // Full: drop the oldest. If it was part of the unanswered batch, that
+    // batch can no longer be resent unchanged, so start a new one
+    bufferStart = (bufferStart + 1) % BUFFER_SIZE;
+    bufferCount--;
+    if (inFlight > 0) {
+      inFlight = 0;
+      uploadSeq++;
+    }
+  }
+
+  Reading& r = readingBuffer[(bufferStart + bufferCount) % BUFFER_SIZE];
+  r.epochMs = epochNowMs();
+  r.takenAt = millis();
+  r.temperature = temperature;
+  r.humidity = humidity;
+  r.pressure = pressure;
+  r.gasResistance = gasResistance;
+  r.airQualityScore = airQualityScore;
+  r.estimatedCO2 = estimatedCO2;
+  r.calibrated = (baselineSamples >= BASELINE_SAMPLES_NEEDED);
+  bufferCount++;
+}
+
+// Append a value rounded to `decimals`, or null for a failed (NaN) reading:
+// a bare nan token is not valid JSON
+void addValue(JsonArray row, float value, unsigned int decimals) {
+  if (isnan(value) || isinf(value)) {
+    row.add(nullptr);
+  } else {
+    row.add(serialized(String(value, decimals)));
+  }
+}
+
+// Upload the oldest buffered readings as one batch. Returns true if the
+// server stored them (or already had them, or refused them for good) and
+// they left the buffer
+bool uploadBuffered() {
+  if (bufferCount == 0) {
+    return false;
+  }
   if (!wifiConnected || WiFi.status() != WL_CONNECTED) {
-    Serial.println("WiFi not connected, skipping data send");
-    return;
+    Serial.println("WiFi not connected, keeping " + String(bufferCount) + " readings buffered");
+    return false;
   }
-  
-  // Create JSON document
+
+  if (inFlight == 0) {
+    inFlight = min(bufferCount, MAX_BATCH);
+  }
+
+  // Once the clock is set, readings taken before that get their wall time
+  // from their age, so every later resend carries the same timestamp and
+  // the server stores each reading once. Until then only the age is known
+  // and the server turns it into a timestamp when the batch arrives
+  unsigned long now = millis();
+  int64_t nowEpoch = epochNowMs();
+  for (int i = 0; nowEpoch != 0 && i < inFlight; i++) {
+    Reading& r = readingBuffer[(bufferStart + i) % BUFFER_SIZE];
+    if (r.epochMs == 0) {
+      r.epochMs = nowEpoch - (int64_t)(now - r.takenAt);
+    }
+  }
+
+  // Compact form: field names once, one array of values per reading
   JsonDocument doc;
-  doc["temperature"] = temperature;
-  doc["humidity"] = humidity;
-  doc["pressure"] = pressure;
-  doc["gas_resistance"] = gasResistance;
-  doc["air_quality_score"] = airQualityScore;
-  doc["estimated_co2"] = estimatedCO2;
-  doc["calibrated"] = (baselineSamples >= BASELINE_SAMPLES_NEEDED);
-  doc["timestamp"] = millis() / 1000;
-  
+  doc["device_id"] = WiFi.macAddress();  // Lets the server tell units apart
+  doc["boot"] = bootId;
+  doc["seq"] = uploadSeq;
+  JsonArray fields = doc["fields"].to<JsonArray>();
+  fields.add(nowEpoch != 0 ? "ts" : "age_ms");
+  for (const char* name : UPLOAD_FIELDS) {
+    fields.add(name);
+  }
+  JsonArray rows = doc["rows"].to<JsonArray>();
+  for (int i = 0; i < inFlight; i++) {
+    const Reading& r = readingBuffer[(bufferStart + i) % BUFFER_SIZE];
+    JsonArray row = rows.add<JsonArray>();
+    if (nowEpoch != 0) {
+      row.add(r.epochMs);
+    } else {
+      row.add(now - r.takenAt);
+    }
+    addValue(row, r.temperature, 1);
+    addValue(row, r.humidity, 1);
+    addValue(row, r.pressure, 1);
+    addValue(row, r.gasResistance, 1);
+    addValue(row, r.airQualityScore, 1);
+    addValue(row, r.estimatedCO2, 0);
+    row.add(r.calibrated ? 1 : 0);
+  }
+
   String jsonString;
   serializeJson(doc, jsonString);
-  
+
   http.begin(serverUrl);
   http.addHeader("Content-Type", "application/json");
-  
   int httpResponseCode = http.POST(jsonString);
-  
-  if (httpResponseCode > 0) {
-    Serial.print("Data sent successfully! Response code: ");
+  http.end();  // With setReuse the connection stays open for the next upload
+
+  if (httpResponseCode < 0 || httpResponseCode >= 500) {
+    // Network error or server trouble: keep the batch and resend it
+    // unchanged (same seq) next time
+    Serial.print("Upload failed, will retry. Response code: ");
     Serial.println(httpResponseCode);
-  } else {
-    Serial.print("Error sending data: ");
+    return false;
+  }
+  if (httpResponseCode != 200) {
+    // The server refused the batch itself; resending it would fail the
+    // same way and block every reading behind it
+    Serial.print("Upload rejected, dropping " + String(inFlight) + " readings. Response code: ");
     Serial.println(httpResponseCode);
+  } else {
+    Serial.println("Uploaded " + String(inFlight) + " readings (batch " + String(uploadSeq) + ")");
   }
-  
-  http.end();
+  bufferStart = (bufferStart + inFlight) % BUFFER_SIZE;
+  bufferCount -= inFlight;
+  inFlight = 0;
+  uploadSeq++;
+  return true;
+}
+
+// Wall-clock time in epoch milliseconds, 0 while NTP hasn't set the clock
+int64_t epochNowMs() {
+  struct timeval tv;
+  gettimeofday(&tv, nullptr);
+  if (tv.tv_sec < 1600000000) {
+    return 0;
+  }
+  return (int64_t)tv.tv_sec * 1000 + tv.tv_usec / 1000;
+}
+
+void checkWiFi() {
+  wifiConnected = (WiFi.status() == WL_CONNECTED);
+  if (wifiConnected || strlen(ssid) == 0 || millis() - lastReconnectTime < reconnectInterval) {
+    return;
+  }
+  Serial.println("WiFi down, reconnecting...");
+  WiFi.reconnect();
+  lastReconnectTime = millis();
 }
 
 void drawTemperatureScreen() {
@@ -545,10 +694,20 @@ void loop() {
     lastRead = millis();
   }
   
-  // Send data to server periodically
-  if (wifiConnected && millis() - lastSendTime > sendInterval) {
-    sendDataToServer();
-    lastSendTime = millis();
+  // Buffer a reading periodically
+  if (millis() - lastSampleTime > sampleInterval) {
+    bufferReading();
+    lastSampleTime = millis();
+  }
+
+  // Upload the buffer periodically; after an outage keep sending batches
+  // back to back until it has drained
+  checkWiFi();
+  if (millis() - lastUploadTime > uploadInterval) {
+    lastUploadTime = millis();
+    if (uploadBuffered() && bufferCount > 0) {
+      lastUploadTime -= uploadInterval;  // Next batch on the next pass
+    }
   }
   
   delay(10);
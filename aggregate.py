@@ -0,0 +1,287 @@
+"""
+Time-bucket aggregation and chart downsampling for sensor readings
+Bucketing is done in SQLite, so a month-long graph needs one small result
+instead of every raw row
+"""
+
+import re
+from collections import deque
+from itertools import groupby
+
+from rollups import FLAGS_JOIN, ROLLUP_LEVELS, has_rollups, trusted_sql
+from sensor_db import RANGE_FILTERS, TIME_TEXT_SQL, build_where
+
+# Bucket sizes accepted by /aggregate (same keys as the rollup levels)
+BUCKETS = tuple(ROLLUP_LEVELS)
+
+# Aggregate functions computed in SQL; pNN percentiles are computed in Python
+SQL_FUNCTIONS = {"avg": "AVG", "min": "MIN", "max": "MAX", "sum": "TOTAL", "count": "COUNT"}
+PERCENTILE_RE = re.compile(r"^p(\d{1,2}(?:\.\d+)?)$")
+
+# Default number of points per series for LTTB downsampling
+DEFAULT_POINTS = 500
+
+# Gap-filling methods of fill_series: interpolate, or carry the last value forward
+FILL_METHODS = ("linear", "previous")
+
+
+def parse_list(value, allowed, name):
+    """Split a comma separated parameter and check every item is allowed"""
+    items = [item.strip().lower() for item in value.split(",") if item.strip()]
+    for item in items:
+        if item not in allowed:
+            raise ValueError(f"Unknown {name}: {item}")
+    if not items:
+        raise ValueError(f"No {name} given")
+    return items
+
+
+def parse_functions(value):
+    """Parse fn=avg,min,max,p95 into a list, checking every name"""
+    fns = [fn.strip().lower() for fn in value.split(",") if fn.strip()]
+    for fn in fns:
+        if fn not in SQL_FUNCTIONS and not PERCENTILE_RE.match(fn):
+            raise ValueError(f"Unknown function: {fn}")
+    if not fns:
+        raise ValueError("No function given")
+    return fns
+
+
+def percentile(values, p):
+    """Linear-interpolated percentile of an already sorted list"""
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def _uses_metric_filters(filters):
+    return any(filters.get(name) is not None for name in RANGE_FILTERS)
+
+
+def _from_rollup(conn, filters, bucket, metrics, fns):
+    """Answer avg/min/max/sum/count straight from a rollup table"""
+    table, _ = ROLLUP_LEVELS[bucket]
+    # Buckets of different devices are combined unless a device is given
+    columns = []
+    for m in metrics:
+        for fn in fns:
+            if fn == "avg":
+                columns.append(f"TOTAL({m}_sum) / NULLIF(SUM({m}_count), 0)")
+            elif fn in ("sum", "count"):
+                columns.append(f"SUM({m}_{fn})")
+            else:
+                columns.append(f"{fn.upper()}({m}_{fn})")
+
+    sql = f"SELECT bucket, SUM(count), {', '.join(columns)} FROM {table} WHERE 1=1"
+    params = []
+    if filters.get("device"):
+        sql += " AND device_id = ?"
+        params.append(filters["device"])
+    if filters.get("start_date"):
+        sql += " AND bucket >= ?"
+        params.append(f"{filters['start_date']} 00:00")
+    if filters.get("end_date"):
+        sql += " AND bucket <= ?"
+        params.append(f"{filters['end_date']} 23:59")
+    sql += " GROUP BY bucket ORDER BY bucket ASC"
+
+    names = [f"{m}_{fn}" for m in metrics for fn in fns]
+    for row in conn.execute(sql, params):
+        record = {"time": row[0], "count": row[1]}
+        record.update(zip(names, row[2:]))
+        yield record
+
+
+def _from_raw_sql(conn, filters, bucket, metrics, fns):
+    """Group raw rows into buckets with SQL aggregates"""
+    _, bucket_expr = ROLLUP_LEVELS[bucket]
+    where_sql, params = build_where(filters)
+    columns = [f"{SQL_FUNCTIONS[fn]}({trusted_sql(m)})" for m in metrics for fn in fns]
+    sql = (f"SELECT {bucket_expr} AS bucket, COUNT(*), {', '.join(columns)} "
+           f"FROM sensor_readings{FLAGS_JOIN}{where_sql} GROUP BY bucket ORDER BY bucket ASC")
+
+    names = [f"{m}_{fn}" for m in metrics for fn in fns]
+    for row in conn.execute(sql, params):
+        record = {"time": row[0], "count": row[1]}
+        record.update(zip(names, row[2:]))
+        yield record
+
+
+def _from_raw_rows(conn, filters, bucket, metrics, fns):
+    """
+    Bucket raw rows in time order and compute every function in Python
+    Used when percentiles are requested; only one bucket is held at a time
+    """
+    _, bucket_expr = ROLLUP_LEVELS[bucket]
+    where_sql, params = build_where(filters)
+    sql = (f"SELECT {bucket_expr} AS bucket, {', '.join(map(trusted_sql, metrics))} "
+           f"FROM sensor_readings{FLAGS_JOIN}{where_sql} ORDER BY ts ASC")
+
+    for key, rows in groupby(conn.execute(sql, params), key=lambda row: row[0]):
+        rows = list(rows)
+        record = {"time": key, "count": len(rows)}
+        for i, m in enumerate(metrics, start=1):
+            values = sorted(row[i] for row in rows if row[i] is not None)
+            for fn in fns:
+                if fn == "avg":
+                    result = sum(values) / len(values) if values else None
+                elif fn == "min":
+                    result = values[0] if values else None
+                elif fn == "max":
+                    result = values[-1] if values else None
+                elif fn == "sum":
+                    result = float(sum(values))
+                elif fn == "count":
+                    result = len(values)
+                else:
+                    result = percentile(values, float(PERCENTILE_RE.match(fn).group(1)))
+                record[f"{m}_{fn}"] = result
+        yield record
+
+
+def aggregate_buckets(conn, filters, bucket, metrics, fns):
+    """
+    Aggregate readings into time buckets
+    Returns a list of {"time", "count", "<metric>_<fn>": value, ...} dicts
+
+    Plain aggregates over a date range are read from the rollup tables;
+    metric range filters or percentiles fall back to the raw rows. Either
+    way spike and pre-calibration values flagged by anomalies.py are left out.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket: {bucket}")
+
+    if any(PERCENTILE_RE.match(fn) for fn in fns):
+        return list(_from_raw_rows(conn, filters, bucket, metrics, fns))
+    if not _uses_metric_filters(filters) and has_rollups(conn):
+        return list(_from_rollup(conn, filters, bucket, metrics, fns))
+    return list(_from_raw_sql(conn, filters, bucket, metrics, fns))
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling
+    points is a list of (x, y, label) tuples sorted by x; returns at most
+    threshold of them, always keeping the first and last point
+    """
+    if threshold >= len(points) or threshold < 3:
+        return points
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_points = points[next_start:next_end]
+        avg_x = sum(p[0] for p in next_points) / len(next_points)
+        avg_y = sum(p[1] for p in next_points) / len(next_points)
+
+        # Pick the point in this bucket forming the largest triangle
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+
+        sampled.append(points[best])
+        a = best
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def downsample(conn, filters, metrics, points=DEFAULT_POINTS):
+    """
+    Downsample every metric to at most `points` raw readings with LTTB
+    Returns {metric: [[time, value], ...]}
+    """
+    where_sql, params = build_where(filters)
+    sql = (f"SELECT {TIME_TEXT_SQL}, ts, {', '.join(map(trusted_sql, metrics))} "
+           f"FROM sensor_readings{FLAGS_JOIN}{where_sql} ORDER BY ts ASC")
+    rows = conn.execute(sql, params).fetchall()
+
+    series = {}
+    for i, m in enumerate(metrics, start=2):
+        values = [(row[1], row[i], row[0]) for row in rows if row[i] is not None]
+        series[m] = [[label, y] for _, y, label in lttb(values, points)]
+    return series
+
+
+def fill_series(records, metrics, step_ms, method="linear"):
+    """
+    Resample one device's readings onto an evenly spaced series
+    records are dicts with "ts" and the metrics (None where a value is
+    missing or flagged), in time order. Points fall on multiples of step_ms
+    from the first reading to the last. "previous" carries each metric's
+    last value forward, "linear" interpolates between the values on either
+    side; nothing is extrapolated past a metric's first or last value.
+    Yields {"ts", <metric>: value, "filled"} dicts, filled when no reading
+    fell in the step ending at the point. Only points still waiting for a
+    metric's next value (linear across flagged values) are held in memory.
+    """
+    if method not in FILL_METHODS:
+        raise ValueError(f"Unknown fill method: {method}")
+    last = {m: None for m in metrics}       # (ts, value) of each metric's last value
+    waiting = {m: [] for m in metrics}      # points waiting for each metric's next value
+    pending = deque()                       # [point, metrics still missing], oldest first
+    next_t = last_seen = None
+
+    for record in records:
+        ts = record["ts"]
+        if next_t is None:
+            next_t = -(-ts // step_ms) * step_ms
+        while next_t <= ts:
+            point = {"ts": next_t}
+            entry = [point, 0]
+            for m in metrics:
+                value = record[m]
+                if next_t == ts and value is not None:
+                    pass
+                elif method == "previous":
+                    value = last[m][1] if last[m] else None
+                elif last[m] is None:
+                    value = None
+                elif value is None:
+                    waiting[m].append(entry)
+                    entry[1] += 1
+                else:
+                    value = _interpolate(last[m], (ts, value), next_t)
+                point[m] = value
+            point["filled"] = not (next_t == ts or (last_seen is not None
+                                                    and last_seen > next_t - step_ms))
+            pending.append(entry)
+            next_t += step_ms
+
+        for m in metrics:
+            value = record[m]
+            if value is None:
+                continue
+            for entry in waiting[m]:
+                entry[0][m] = _interpolate(last[m], (ts, value), entry[0]["ts"])
+                entry[1] -= 1
+            waiting[m] = []
+            last[m] = (ts, value)
+        last_seen = ts
+
+        while pending and pending[0][1] == 0:
+            yield pending.popleft()[0]
+
+    # Values never seen again stay None
+    for point, _ in pending:
+        yield point
+
+
+def _interpolate(before, after, t):
+    (t0, v0), (t1, v1) = before, after
+    if t1 == t0:
+        return v1
+    return round(v0 + (v1 - v0) * (t - t0) / (t1 - t0), 2)
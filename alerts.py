@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Rule-based alerts evaluated on readings as they are committed
+Each rule keeps a few values of state per device and looks at one reading
+at a time, so evaluation is O(1) per reading per rule and never queries
+the database. The ingest writer only hands committed rows to a queue; a
+background thread evaluates them and delivers "firing"/"resolved" events
+to the sinks (a JSON-lines file, a webhook). An alert fires once and stays
+quiet until it resolves, and rules clear at a separate level from the one
+they fire at (hysteresis), so a value hovering at the limit doesn't flap.
+
+Usage:
+    python alerts.py replay [db_file] [--start-date YYYY-MM-DD] [--end-date YYYY-MM-DD]
+                                                    print the alerts the rules would
+                                                    have raised over stored readings
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.request
+
+from sensor_db import DB_FILE, READING_COLUMNS, build_where, connect, format_ts, now_ms
+
+# Rules used by the server. Types:
+#   threshold: metric above (or below) a level for at least `for` seconds,
+#              resolved once it is back past `clear`
+#   rate:      metric changing faster than `per_hour` (absolute), measured
+#              over at least `window` seconds, resolved below `clear_per_hour`
+#   silence:   no reading from a device for `after` seconds
+ALERT_RULES = [
+    {"name": "co2_high", "type": "threshold", "metric": "co2",
+     "above": 1200, "clear": 1100, "for": 600},
+    {"name": "humidity_swing", "type": "rate", "metric": "humidity",
+     "per_hour": 15, "clear_per_hour": 10, "window": 600},
+    {"name": "device_silent", "type": "silence", "after": 300},
+]
+
+# Readings waiting for evaluation before new ones are dropped (and counted)
+QUEUE_SIZE = 10000
+
+# Seconds between checks for silent devices
+SILENCE_CHECK = 30
+
+# Seconds to wait for a webhook to answer
+WEBHOOK_TIMEOUT = 5
+
+_STOP = object()
+
+
+class ThresholdRule:
+    """Metric beyond a level for a minimum duration"""
+
+    def __init__(self, name, metric, above=None, below=None, clear=None, duration=0):
+        if (above is None) == (below is None):
+            raise ValueError(f"Rule {name}: give exactly one of 'above' or 'below'")
+        self.name = name
+        self.metric = metric
+        self.above = above
+        self.below = below
+        self.clear = clear if clear is not None else (above if above is not None else below)
+        self.duration_ms = int(duration * 1000)
+
+    def new_state(self):
+        # [ts the condition started holding, firing]
+        return [None, False]
+
+    def _beyond(self, value):
+        return value > self.above if self.above is not None else value < self.below
+
+    def _cleared(self, value):
+        return value <= self.clear if self.above is not None else value >= self.clear
+
+    def update(self, state, record):
+        value = record.get(self.metric)
+        if value is None:
+            return None
+        ts = record["ts"]
+        if state[1]:
+            if self._cleared(value):
+                state[0], state[1] = None, False
+                return "resolved", value
+            return None
+        if not self._beyond(value):
+            state[0] = None
+            return None
+        if state[0] is None:
+            state[0] = ts
+        if ts - state[0] >= self.duration_ms:
+            state[1] = True
+            return "firing", value
+        return None
+
+    def describe(self, value):
+        limit = f"> {self.above}" if self.above is not None else f"< {self.below}"
+        return f"{self.metric} {value} {limit} for {self.duration_ms // 1000}s"
+
+
+class RateRule:
+    """Metric changing faster than a rate per hour"""
+
+    def __init__(self, name, metric, per_hour, clear_per_hour=None, window=600):
+        self.name = name
+        self.metric = metric
+        self.per_hour = per_hour
+        self.clear_per_hour = clear_per_hour if clear_per_hour is not None else per_hour
+        self.window_ms = int(window * 1000)
+
+    def new_state(self):
+        # [anchor ts, anchor value, firing]
+        return [None, None, False]
+
+    def update(self, state, record):
+        value = record.get(self.metric)
+        if value is None:
+            return None
+        ts = record["ts"]
+        if state[0] is None:
+            state[0], state[1] = ts, value
+            return None
+        elapsed = ts - state[0]
+        if elapsed < self.window_ms:
+            return None
+        rate = abs(value - state[1]) * 3600000 / elapsed
+        state[0], state[1] = ts, value
+        if not state[2] and rate > self.per_hour:
+            state[2] = True
+            return "firing", round(rate, 2)
+        if state[2] and rate <= self.clear_per_hour:
+            state[2] = False
+            return "resolved", round(rate, 2)
+        return None
+
+    def describe(self, value):
+        return f"{self.metric} changing {value}/h (limit {self.per_hour}/h)"
+
+
+class SilenceRule:
+    """No reading from a device for a while"""
+
+    metric = None
+
+    def __init__(self, name, after=300):
+        self.name = name
+        self.after_ms = int(after * 1000)
+
+    def new_state(self):
+        # [ts of the latest reading, firing]
+        return [None, False]
+
+    def update(self, state, record):
+        """A reading resolves a firing alert; a gap seen only now fires and resolves it"""
+        last, firing = state
+        state[0] = record["ts"]
+        if firing:
+            state[1] = False
+            return "resolved", None
+        if last is not None and record["ts"] - last > self.after_ms:
+            return "gap", (record["ts"] - last) // 1000
+        return None
+
+    def check(self, state, now):
+        """Called periodically: fire once a device has been quiet too long"""
+        if state[0] is not None and not state[1] and now - state[0] > self.after_ms:
+            state[1] = True
+            return "firing", (now - state[0]) // 1000
+        return None
+
+    def describe(self, value):
+        return f"no data for {value}s" if value is not None else "data received again"
+
+
+RULE_TYPES = {
+    "threshold": lambda s: ThresholdRule(s["name"], s["metric"], s.get("above"), s.get("below"),
+                                         s.get("clear"), s.get("for", 0)),
+    "rate": lambda s: RateRule(s["name"], s["metric"], s["per_hour"], s.get("clear_per_hour"),
+                               s.get("window", 600)),
+    "silence": lambda s: SilenceRule(s["name"], s.get("after", 300)),
+}
+
+
+def load_rules(specs):
+    """Rule objects from a list of rule dicts (see ALERT_RULES)"""
+    rules = []
+    for spec in specs:
+        factory = RULE_TYPES.get(spec.get("type"))
+        if factory is None:
+            raise ValueError(f"Unknown alert rule type: {spec.get('type')}")
+        rules.append(factory(spec))
+    return rules
+
+
+class FileSink:
+    """Append alert events to a JSON-lines file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, event):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(event) + "\n")
+
+
+class WebhookSink:
+    """POST each alert event as JSON to a URL"""
+
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, event):
+        request = urllib.request.Request(self.url, data=json.dumps(event).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class PrintSink:
+    """Print alert events (used by the replay command)"""
+
+    def send(self, event):
+        print(f"{event['time']}  {event['state']:8}  {event['rule']:16} {event['device']:20} "
+              f"{event['message']}")
+
+
+class AlertEngine:
+    """
+    Evaluates rules on committed readings in a background thread
+
+    submit() is the group-commit writer listener and only queues the rows,
+    so ingest never waits for rules or sinks. evaluate() runs the rules
+    synchronously (replay, tests). Each device's readings are evaluated in
+    time order; one older than the device's last evaluated reading (a late
+    upload) is skipped, since rule state only moves forward and a silence
+    rule would otherwise date the device's last reading back. `events`
+    counts delivered events and `skipped` the late readings.
+    """
+
+    def __init__(self, rules, sinks=(), queue_size=QUEUE_SIZE, check_interval=SILENCE_CHECK):
+        self.rules = rules
+        self._rules = {rule.name: rule for rule in rules}
+        self.sinks = list(sinks)
+        self.check_interval = check_interval
+        self.dropped = 0
+        self.events = 0
+        self.skipped = 0
+        self._queue = queue.Queue(queue_size)
+        self._state = {}
+        # ts of the last evaluated reading of every device
+        self._last_ts = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, rows):
+        """Writer listener: queue committed rows for evaluation"""
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            self.dropped += len(rows)
+
+    def prime(self, last_seen):
+        """Seed silence rules with {device: ts of its latest reading}"""
+        with self._lock:
+            for device, ts in last_seen.items():
+                self._last_ts[device] = max(ts, self._last_ts.get(device, ts))
+            for rule in self.rules:
+                if isinstance(rule, SilenceRule):
+                    for device, ts in last_seen.items():
+                        self._state.setdefault((rule.name, device), rule.new_state())[0] = ts
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="alerts", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        next_check = time.monotonic() + self.check_interval
+        while True:
+            try:
+                rows = self._queue.get(timeout=max(0.0, next_check - time.monotonic()))
+            except queue.Empty:
+                rows = None
+            if rows is _STOP:
+                return
+            try:
+                if rows:
+                    self.evaluate(rows)
+                if time.monotonic() >= next_check:
+                    self.check_silence(now_ms())
+                    next_check = time.monotonic() + self.check_interval
+            except Exception as e:
+                print(f"Error: alert evaluation failed: {e}")
+
+    def evaluate(self, rows):
+        """Run every rule over readings (mappings with device_id, ts and metrics)"""
+        # A commit can interleave devices and times
+        for row in sorted(rows, key=lambda row: row["ts"]):
+            record = dict(row)
+            device = record["device_id"]
+            with self._lock:
+                last = self._last_ts.get(device)
+                if last is not None and record["ts"] <= last:
+                    self.skipped += 1
+                    continue
+                self._last_ts[device] = record["ts"]
+            for rule in self.rules:
+                key = (rule.name, device)
+                with self._lock:
+                    state = self._state.get(key)
+                    if state is None:
+                        state = self._state[key] = rule.new_state()
+                    result = rule.update(state, record)
+                if result is None:
+                    continue
+                change, value = result
+                if change == "gap":
+                    # Only noticed when the device came back (replay, or
+                    # a gap shorter than the silence check interval)
+                    silent_since = record["ts"] - value * 1000
+                    self._emit(rule, device, "firing", value, silent_since + rule.after_ms)
+                    change, value = "resolved", None
+                self._emit(rule, device, change, value, record["ts"])
+
+    def check_silence(self, now):
+        """Fire silence rules for devices that have gone quiet"""
+        fired = []
+        with self._lock:
+            for (name, device), state in self._state.items():
+                rule = self._rules[name]
+                if isinstance(rule, SilenceRule):
+                    result = rule.check(state, now)
+                    if result is not None:
+                        fired.append((rule, device, result))
+        for rule, device, (change, value) in fired:
+            self._emit(rule, device, change, value, now)
+
+    def _emit(self, rule, device, change, value, ts):
+        event = {
+            "rule": rule.name,
+            "device": device,
+            "state": change,
+            "metric": rule.metric,
+            "value": value,
+            "ts": ts,
+            "time": format_ts(ts),
+            "message": rule.describe(value),
+        }
+        with self._lock:
+            if change == "firing":
+                self._active[(rule.name, device)] = event
+            else:
+                self._active.pop((rule.name, device), None)
+            self.events += 1
+        for sink in self.sinks:
+            try:
+                sink.send(event)
+            except Exception as e:
+                print(f"Error: alert sink {type(sink).__name__} failed: {e}")
+
+    def active(self):
+        """Currently firing alerts, oldest first"""
+        with self._lock:
+            return sorted(self._active.values(), key=lambda e: e["ts"])
+
+
+def replay(db_file, filters, rules):
+    """Evaluate rules over stored readings in time order, printing every event"""
+    engine = AlertEngine(rules, [PrintSink()])
+    where_sql, params = build_where(filters)
+    conn = connect(db_file)
+    try:
+        cursor = conn.execute(f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                              "ORDER BY ts ASC, id ASC", params)
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            engine.evaluate(rows)
+    finally:
+        conn.close()
+    return engine.events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Alert rules over sensor readings")
+    parser.add_argument("command", choices=["replay"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--start-date")
+    parser.add_argument("--end-date")
+    parser.add_argument("--device")
+    args = parser.parse_args()
+
+    filters = {"start_date": args.start_date, "end_date": args.end_date, "device": args.device}
+    events = replay(args.db_file, filters, load_rules(ALERT_RULES))
+    print(f"{events} events")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+Column-oriented analytics over sensor readings for the command-line tool
+Query results are loaded straight into one typed array per column, so
+summaries, percentiles, rolling means, daily/weekly profiles and
+correlations are single passes over packed numbers instead of loops over
+sqlite3.Row objects. NumPy is used when installed; otherwise the same
+results are computed from the arrays in pure Python (slower, no extra
+dependency).
+"""
+
+import math
+from array import array
+from datetime import datetime
+
+from rollups import METRICS
+from sensor_db import build_where
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Rows fetched from SQLite per round trip while loading columns
+LOAD_CHUNK = 10000
+
+# Percentiles reported by summarize()
+SUMMARY_PERCENTILES = (5, 50, 95)
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+HOUR_MS = 3600 * 1000
+
+NAN = float("nan")
+
+
+class Columns:
+    """
+    Readings held column-wise: ts (epoch ms) plus one float column per
+    metric with NaN for NULL. Columns are numpy arrays when NumPy is
+    installed, array.array otherwise.
+    """
+
+    def __init__(self, ts, values):
+        self.ts = ts
+        self.values = values
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def metrics(self):
+        return tuple(self.values)
+
+
+def load_columns(conn, filters=None, metrics=METRICS):
+    """Run a filtered query (same filters as /query) and load it column-wise in time order"""
+    where_sql, params = build_where(filters or {})
+    cursor = conn.execute(f"SELECT ts, {', '.join(metrics)} FROM sensor_readings{where_sql} "
+                          "ORDER BY ts ASC, id ASC", params)
+
+    ts = array("q")
+    values = {m: array("d") for m in metrics}
+    targets = [values[m] for m in metrics]
+    while True:
+        rows = cursor.fetchmany(LOAD_CHUNK)
+        if not rows:
+            break
+        ts.extend(row[0] for row in rows)
+        for i, target in enumerate(targets, start=1):
+            target.extend(NAN if row[i] is None else row[i] for row in rows)
+    cursor.close()
+
+    if np is not None:
+        # Zero-copy views over the packed buffers
+        return Columns(np.frombuffer(ts, dtype=np.int64),
+                       {m: np.frombuffer(v, dtype=np.float64) for m, v in values.items()})
+    return Columns(ts, values)
+
+
+def _valid(column):
+    """Non-NaN values of a column (sorted copy in pure Python)"""
+    return sorted(v for v in column if v == v)
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(cols, percentiles=SUMMARY_PERCENTILES):
+    """
+    Per-metric count, min, max, mean, std and percentiles
+    Returns {metric: {"count", "min", "max", "mean", "std", "p5", ...}}
+    """
+    result = {}
+    for m, column in cols.values.items():
+        if np is not None:
+            valid = column[~np.isnan(column)]
+            count = int(valid.size)
+            stats = {"count": count}
+            if count:
+                stats.update(min=float(valid.min()), max=float(valid.max()),
+                             mean=float(valid.mean()), std=float(valid.std()))
+                for p, value in zip(percentiles, np.percentile(valid, percentiles)):
+                    stats[f"p{p}"] = float(value)
+        else:
+            valid = _valid(column)
+            count = len(valid)
+            stats = {"count": count}
+            if count:
+                mean = math.fsum(valid) / count
+                stats.update(min=valid[0], max=valid[-1], mean=mean,
+                             std=math.sqrt(math.fsum((v - mean) ** 2 for v in valid) / count))
+                for p in percentiles:
+                    stats[f"p{p}"] = _percentile(valid, p)
+        if not count:
+            stats.update(min=None, max=None, mean=None, std=None,
+                         **{f"p{p}": None for p in percentiles})
+        result[m] = stats
+    return result
+
+
+def rolling_mean(cols, metric, window):
+    """
+    Mean of the last `window` readings at every position (NaN values are
+    skipped; positions with no valid value in the window are NaN)
+    """
+    column = cols.values[metric]
+    if np is not None:
+        valid = ~np.isnan(column)
+        sums = np.concatenate(([0.0], np.cumsum(np.where(valid, column, 0.0))))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+        idx = np.arange(1, len(column) + 1)
+        start = np.maximum(idx - window, 0)
+        n = counts[idx] - counts[start]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, (sums[idx] - sums[start]) / n, np.nan)
+
+    result = array("d")
+    total, count = 0.0, 0
+    for i, v in enumerate(column):
+        if v == v:
+            total += v
+            count += 1
+        if i >= window:
+            old = column[i - window]
+            if old == old:
+                total -= old
+                count -= 1
+        result.append(total / count if count else NAN)
+    return result
+
+
+def peak_window(cols, metric, window):
+    """
+    Highest `window`-reading rolling mean of a metric
+    Returns (mean, ts at the end of that window) or (None, None)
+    """
+    means = rolling_mean(cols, metric, window)
+    if len(means) < window:
+        return None, None
+    if np is not None:
+        tail = means[window - 1:]
+        if np.isnan(tail).all():
+            return None, None
+        i = int(np.nanargmax(tail)) + window - 1
+        return float(means[i]), int(cols.ts[i])
+
+    best, best_i = None, None
+    for i in range(window - 1, len(means)):
+        v = means[i]
+        if v == v and (best is None or v > best):
+            best, best_i = v, i
+    return best, (cols.ts[best_i] if best_i is not None else None)
+
+
+def _local_keys(ts):
+    """
+    Local (hour of day, weekday) for every timestamp
+    Local time is resolved once per distinct UTC hour, so DST is exact
+    """
+    if np is not None:
+        hours, inverse = np.unique(ts // HOUR_MS, return_inverse=True)
+        local = [datetime.fromtimestamp(h * 3600) for h in hours.tolist()]
+        hour_of_day = np.array([t.hour for t in local], dtype=np.int64)[inverse]
+        weekday = np.array([t.weekday() for t in local], dtype=np.int64)[inverse]
+        return hour_of_day, weekday
+
+    cache = {}
+    hour_of_day, weekday = array("b"), array("b")
+    for t in ts:
+        key = t // HOUR_MS
+        local = cache.get(key)
+        if local is None:
+            local = cache[key] = datetime.fromtimestamp(key * 3600)
+        hour_of_day.append(local.hour)
+        weekday.append(local.weekday())
+    return hour_of_day, weekday
+
+
+def profiles(cols, metrics=None):
+    """
+    Mean of each metric by local hour of day and by day of week
+    Returns {"hour": {metric: [24 means]}, "weekday": {metric: [7 means]}}
+    """
+    metrics = metrics or cols.metrics
+    hour_of_day, weekday = _local_keys(cols.ts)
+    result = {"hour": {}, "weekday": {}}
+    for name, keys, size in (("hour", hour_of_day, 24), ("weekday", weekday, 7)):
+        for m in metrics:
+            column = cols.values[m]
+            if np is not None:
+                valid = ~np.isnan(column)
+                sums = np.bincount(keys[valid], weights=column[valid], minlength=size)
+                counts = np.bincount(keys[valid], minlength=size)
+                result[name][m] = [float(s / c) if c else None for s, c in zip(sums, counts)]
+            else:
+                sums, counts = [0.0] * size, [0] * size
+                for k, v in zip(keys, column):
+                    if v == v:
+                        sums[k] += v
+                        counts[k] += 1
+                result[name][m] = [s / c if c else None for s, c in zip(sums, counts)]
+    return result
+
+
+def correlation(cols, a, b):
+    """Pearson correlation of two metrics over readings where both are present"""
+    x, y = cols.values[a], cols.values[b]
+    if np is not None:
+        both = ~(np.isnan(x) | np.isnan(y))
+        if both.sum() < 2:
+            return None
+        x, y = x[both], y[both]
+        sx, sy = x.std(), y.std()
+        if not sx or not sy:
+            return None
+        return float(((x - x.mean()) * (y - y.mean())).mean() / (sx * sy))
+
+    pairs = [(u, v) for u, v in zip(x, y) if u == u and v == v]
+    n = len(pairs)
+    if n < 2:
+        return None
+    mx = math.fsum(u for u, _ in pairs) / n
+    my = math.fsum(v for _, v in pairs) / n
+    cov = math.fsum((u - mx) * (v - my) for u, v in pairs)
+    vx = math.fsum((u - mx) ** 2 for u, _ in pairs)
+    vy = math.fsum((v - my) ** 2 for _, v in pairs)
+    if not vx or not vy:
+        return None
+    return cov / math.sqrt(vx * vy)
+
+
+def correlation_matrix(cols, metrics=None):
+    """{(a, b): r} for every pair of metrics"""
+    metrics = metrics or cols.metrics
+    return {(a, b): correlation(cols, a, b)
+            for i, a in enumerate(metrics) for b in metrics[i + 1:]}
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Anomaly flags for sensor readings, computed with streaming statistics
+Each device keeps a little state per metric and every reading is checked
+once, in time order, without querying the database:
+  spike   value far from the median of the last MEDIAN_WINDOW values, in
+          units of an EWMA of the squared deviations from that median
+  stuck   the same value (Welford variance of the current run ~0) for
+          STUCK_READINGS readings in a row; only the reading where the
+          run gets that long and the run's last one are flagged
+  precal  gas/AQI/CO2 sent before the firmware finished calibrating
+  gap     reading arriving long after the previous one (a missed upload)
+Flags go to reading_flags in the same transaction as the readings (the
+ingest writer calls AnomalyDetector.flag), so the rollups and aggregates
+built from that transaction already leave spike and precal values out.
+Stuck and gap flags are informational only. A steady signal can stay
+stuck for days, so a run is stored as its two ends rather than a flag per
+reading: the STUCK_READINGS-th repeat (the earlier ones can't be told
+apart from a steady reading yet) and, once a different value arrives,
+the last repeat. The scan command recomputes the flags of stored history
+and rebuilds the rollups.
+
+Usage:
+    python anomalies.py scan [db_file] [--start-date YYYY-MM-DD] [--end-date YYYY-MM-DD]
+                             [--device D]       recompute flags of stored readings
+    python anomalies.py list [db_file] [--start-date ...] [--end-date ...] [--device D]
+                             [--limit N]        print flagged readings, newest first
+"""
+
+import argparse
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+from rollups import (FLAG_GAP, FLAG_PRECAL, FLAG_SPIKE, FLAG_STUCK, METRICS, PRECAL_METRICS,
+                     backfill, has_rollups)
+from sensor_db import DB_FILE, READING_COLUMNS, build_where, connect, format_ts, shard_files
+
+# Values in the moving window whose median is a metric's baseline
+MEDIAN_WINDOW = 15
+
+# Weight of the newest squared deviation in a metric's EWMA spread
+SPREAD_ALPHA = 0.05
+
+# A value further than SPIKE_SIGMAS spreads from the median is a spike
+SPIKE_SIGMAS = 6.0
+SPIKE_SIGMAS2 = SPIKE_SIGMAS ** 2
+
+# Smallest spread per metric, so a very steady signal doesn't turn normal
+# 0.1-step changes (readings are rounded to 1 decimal) into spikes
+MIN_SPREAD = {"temperature": 0.3, "humidity": 1.0, "pressure": 0.5,
+              "gas": 5.0, "aqi": 5.0, "co2": 30.0}
+
+# Identical values in a row (one reading a minute) before a metric counts
+# as stuck; pressure legitimately holds one 0.1 hPa step for a long time
+STUCK_READINGS = {"temperature": 60, "humidity": 90, "pressure": 240,
+                  "gas": 30, "aqi": 60, "co2": 60}
+
+# Resolution each metric is transmitted at (the firmware rounds CO2 to
+# whole ppm and everything else to 1 decimal)
+RESOLUTION = {"temperature": 0.1, "humidity": 0.1, "pressure": 0.1,
+              "gas": 0.1, "aqi": 0.1, "co2": 1.0}
+
+# Standard deviation of a run still treated as one repeated value: far below
+# what a single step of the metric's resolution adds to a run of
+# STUCK_READINGS values, so any transmitted change starts a new run
+STUCK_TOLERANCE2 = {m: (RESOLUTION[m] / 100) ** 2 for m in RESOLUTION}
+
+# A reading arriving GAP_FACTOR typical intervals (EWMA) after the previous
+# one, and at least MIN_GAP_MS later, starts after a gap
+GAP_FACTOR = 5
+MIN_GAP_MS = 3 * 60 * 1000
+INTERVAL_ALPHA = 0.1
+
+# Readings flagged per transaction of a scan
+SCAN_CHUNK = 5000
+
+# The end of a stuck run is flagged after its reading was, so masks are merged
+INSERT_FLAGS_SQL = """
+    INSERT INTO reading_flags (device_id, ts, mask, gap_ms)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (device_id, ts) DO UPDATE SET mask = mask | excluded.mask,
+        gap_ms = COALESCE(excluded.gap_ms, gap_ms)
+"""
+
+
+class Ewma:
+    """Exponentially weighted moving average (None until the first value)"""
+
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        self.value = x if self.value is None else self.value + self.alpha * (x - self.value)
+        return self.value
+
+
+class MetricDetector:
+    """
+    Spike and stuck checks for one metric of one device
+    update() runs for every value of every reading (a bulk import feeds it
+    millions), so the median window (a ring buffer plus a sorted copy), the
+    EWMA spread and the Welford run are plain attributes updated inline.
+    """
+
+    __slots__ = ("min_spread2", "stuck_after", "tolerance2", "recent", "ordered", "spread",
+                 "run_count", "run_mean", "run_m2", "last_ts")
+
+    def __init__(self, metric):
+        self.min_spread2 = MIN_SPREAD[metric] ** 2
+        self.stuck_after = STUCK_READINGS[metric]
+        self.tolerance2 = STUCK_TOLERANCE2[metric]
+        self.recent = deque()       # last MEDIAN_WINDOW values, oldest first
+        self.ordered = []           # the same values, sorted
+        self.spread = None          # EWMA of squared deviations from the median
+        # Welford count, mean and M2 of the values since the metric last changed
+        self.run_count = 0
+        self.run_mean = 0.0
+        self.run_m2 = 0.0
+        self.last_ts = None         # time of the last value fed, set by the caller
+
+    def update(self, value):
+        """
+        Feed one value, returns (spike, stuck, unstuck): stuck when the run
+        of repeats just got long enough, unstuck when a stuck run just ended
+        (its last value was the previous one)
+        """
+        ordered = self.ordered
+        n = len(ordered)
+        spike = False
+        if n:
+            half = n // 2
+            deviation = value - (ordered[half] if n % 2 else (ordered[half - 1] + ordered[half]) / 2)
+            # Compared squared: SPIKE_SIGMAS * max(sqrt(spread), MIN_SPREAD)
+            spread = self.spread or 0.0
+            limit2 = SPIKE_SIGMAS2 * (spread if spread > self.min_spread2 else self.min_spread2)
+            deviation2 = deviation * deviation
+            spike = n == MEDIAN_WINDOW and deviation2 > limit2
+            # An outlier only nudges the spread, so it doesn't mask the next one
+            clipped = deviation2 if deviation2 < limit2 else limit2
+            self.spread = clipped if self.spread is None else spread + SPREAD_ALPHA * (clipped - spread)
+        # Spikes still enter the window: the median ignores a lone outlier
+        # and follows a real level change after half a window
+        if n == MEDIAN_WINDOW:
+            del ordered[bisect_left(ordered, self.recent.popleft())]
+        self.recent.append(value)
+        insort(ordered, value)
+
+        previous = self.run_count
+        count = previous + 1
+        delta = value - self.run_mean
+        mean = self.run_mean + delta / count
+        m2 = self.run_m2 + delta * (value - mean)
+        if m2 > self.tolerance2 * count:
+            # Variance above tolerance: the value changed, a new run starts
+            count, mean, m2 = 1, value, 0.0
+        self.run_count, self.run_mean, self.run_m2 = count, mean, m2
+        return spike, count == self.stuck_after, count == 1 and previous >= self.stuck_after
+
+
+class DeviceState:
+    """Detector state of one device"""
+
+    __slots__ = ("last_ts", "interval", "metrics", "checks")
+
+    def __init__(self):
+        self.last_ts = None
+        self.interval = Ewma(INTERVAL_ALPHA)
+        self.metrics = {m: MetricDetector(m) for m in METRICS}
+        # (metric, detector, spike bit, stuck bit, skipped before calibration)
+        self.checks = [(m, self.metrics[m], FLAG_SPIKE[m], FLAG_STUCK[m], m in PRECAL_METRICS)
+                       for m in METRICS]
+
+
+def describe(mask, gap_ms=None):
+    """Readable labels for a flag mask, e.g. ['spike:co2', 'gap:600s']"""
+    labels = [f"spike:{m}" for m in METRICS if mask & FLAG_SPIKE[m]]
+    labels += [f"stuck:{m}" for m in METRICS if mask & FLAG_STUCK[m]]
+    if mask & FLAG_PRECAL:
+        labels.append("precal")
+    if mask & FLAG_GAP:
+        labels.append(f"gap:{gap_ms // 1000}s" if gap_ms else "gap")
+    return labels
+
+
+class AnomalyDetector:
+    """
+    Flags readings in time order per device
+
+    flag() is the ingest writer's pre-commit hook: it checks the rows of a
+    transaction and writes their flags in it. Readings older than the
+    device's latest one (late uploads) only get the precal flag, the
+    streaming statistics only move forward. `flagged` counts flags by kind
+    (stuck counts runs).
+    """
+
+    def __init__(self):
+        self.flagged = {"spike": 0, "stuck": 0, "precal": 0, "gap": 0}
+        self._devices = {}
+        # (device_id, ts, mask, None) marking the last reading of stuck runs
+        # that ended, collected by check()
+        self._run_ends = []
+        self._lock = threading.Lock()
+
+    def inspect(self, record):
+        """Check one reading (a mapping), returns (mask, gap_ms or None)"""
+        state = self._devices.get(record["device_id"])
+        if state is None:
+            state = self._devices[record["device_id"]] = DeviceState()
+        ts = record["ts"]
+        precal = record["calibrated"] == "false"
+        mask = FLAG_PRECAL if precal else 0
+        if state.last_ts is not None and ts <= state.last_ts:
+            return mask, None
+
+        gap_ms = None
+        if state.last_ts is not None:
+            elapsed = ts - state.last_ts
+            limit = max(GAP_FACTOR * (state.interval.value or 0), MIN_GAP_MS)
+            if elapsed > limit:
+                mask |= FLAG_GAP
+                gap_ms = elapsed
+            # Clipped, so one long outage doesn't hide the next
+            state.interval.update(min(elapsed, limit))
+        state.last_ts = ts
+
+        for m, detector, spike_bit, stuck_bit, gas in state.checks:
+            value = record[m]
+            if value is None or (precal and gas):
+                continue
+            spike, stuck, unstuck = detector.update(value)
+            if spike:
+                mask |= spike_bit
+            if stuck:
+                mask |= stuck_bit
+            elif unstuck:
+                self._run_ends.append((record["device_id"], detector.last_ts, stuck_bit, None))
+            detector.last_ts = ts
+        return mask, gap_ms
+
+    def prime(self, rows):
+        """Feed stored readings (in time order) to warm the statistics up without flagging"""
+        with self._lock:
+            for row in rows:
+                self.inspect(row)
+            self._run_ends.clear()
+
+    def check(self, rows):
+        """
+        (device_id, ts, mask, gap_ms) for every flagged reading among rows,
+        and for the last reading of every stuck run they end
+        """
+        flags = []
+        with self._lock:
+            for row in rows:
+                mask, gap_ms = self.inspect(row)
+                if mask:
+                    flags.append((row["device_id"], row["ts"], mask, gap_ms))
+                    self._count(mask)
+            flags += self._run_ends
+            self._run_ends.clear()
+        return flags
+
+    def flag(self, conn, rows):
+        """Writer pre-commit hook: write the flags of newly inserted rows"""
+        # Rows come in insert order; a batch can interleave devices and times
+        flags = self.check(sorted(rows, key=lambda row: row["ts"]))
+        if flags:
+            conn.executemany(INSERT_FLAGS_SQL, flags)
+        return flags
+
+    def _count(self, mask):
+        if mask & sum(FLAG_SPIKE.values()):
+            self.flagged["spike"] += 1
+        if mask & sum(FLAG_STUCK.values()):
+            self.flagged["stuck"] += 1
+        if mask & FLAG_PRECAL:
+            self.flagged["precal"] += 1
+        if mask & FLAG_GAP:
+            self.flagged["gap"] += 1
+
+
+def flag_filters(filters):
+    """The part of a filter dict that applies to reading_flags (device and dates)"""
+    return {key: filters.get(key) for key in ("device", "start_date", "end_date")}
+
+
+def scan(conn, filters):
+    """
+    Recompute the flags of the stored readings in a device/date range
+    One transaction, so ingest waits while it runs; the detectors start
+    cold at the beginning of the range. Returns counts by kind.
+    """
+    detector = AnomalyDetector()
+    where_sql, params = build_where(flag_filters(filters))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(f"DELETE FROM reading_flags{where_sql}", params)
+        # (device_id, ts) order reads idx_reading_key and keeps each device's
+        # readings together
+        cursor = conn.execute(f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                              "ORDER BY device_id, ts", params)
+        while True:
+            rows = cursor.fetchmany(SCAN_CHUNK)
+            if not rows:
+                break
+            conn.executemany(INSERT_FLAGS_SQL, detector.check(rows))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+    if has_rollups(conn):
+        # Values flagged or unflagged now move in or out of the rollups
+        backfill(conn)
+    return detector.flagged
+
+
+def read_flags(conn, filters, limit=None):
+    """Flagged readings as dicts, newest first"""
+    where_sql, params = build_where(flag_filters(filters))
+    sql = f"SELECT device_id, ts, mask, gap_ms FROM reading_flags{where_sql} ORDER BY ts DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [{"device_id": device, "ts": ts, "time": format_ts(ts),
+             "flags": describe(mask, gap_ms), "mask": mask, "gap_ms": gap_ms}
+            for device, ts, mask, gap_ms in conn.execute(sql, params)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Anomaly flags for sensor readings")
+    parser.add_argument("command", choices=["scan", "list"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--start-date")
+    parser.add_argument("--end-date")
+    parser.add_argument("--device")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    filters = {"start_date": args.start_date, "end_date": args.end_date, "device": args.device}
+    started = time.monotonic()
+    for path in shard_files(args.db_file, args.device):
+        conn = connect(path)
+        try:
+            if args.command == "scan":
+                counts = scan(conn, filters)
+                print(f"{path}: " + ", ".join(f"{n} {kind}" for kind, n in counts.items()))
+            else:
+                for flag in read_flags(conn, filters, args.limit):
+                    print(f"{flag['time']}  {flag['device_id']:20} {' '.join(flag['flags'])}")
+        finally:
+            conn.close()
+    if args.command == "scan":
+        print(f"Done in {time.monotonic() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
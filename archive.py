@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Compressed columnar archive for closed months of raw readings
+Each month becomes one file next to the database. Columns are stored
+separately and zlib-compressed: ids and timestamps delta-encoded, metrics
+as delta-encoded integers (tenths for the one-decimal values the server
+stores, exact for anything else), device ids dictionary-encoded and the
+calibrated flag as one byte.
+Readers memory-map the file and only decompress the columns they need.
+
+Usage:
+    python archive.py export [db_file] [--month YYYY-MM]   archive closed months and
+                                                            remove their raw rows
+    python archive.py list [db_file]                        show archived months
+"""
+
+import argparse
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from retention import delete_batches
+from rollups import METRICS
+from sensor_db import (CREATE_FLAGS_SQL, DB_FILE, RANGE_FILTERS, READING_COLUMN_NAMES,
+                       READING_COLUMNS, MergedCursor, connect, filter_range_ms, format_ts,
+                       shard_files, to_epoch_ms)
+
+MAGIC = b"SCA1"
+
+# Metric columns are stored as integers in units of 10**-decimals, using
+# the fewest decimals (up to MAX_DECIMALS) that round-trip every value
+# exactly; columns that need more are stored as plain doubles
+MAX_DECIMALS = 4
+
+# Days after a month ends before it counts as closed (late batches, clock skew)
+CLOSE_AFTER_DAYS = 2
+
+# zlib level for column blobs
+COMPRESSION = 6
+
+_HEADER = struct.Struct("<4sI")
+_CALIBRATED = {"true": 1, "false": 0}
+_CALIBRATED_TEXT = {1: "true", 0: "false", 2: None}
+
+
+class ArchiveRow(tuple):
+    """Reading tuple in READING_COLUMN_NAMES order that also supports row["name"] like sqlite3.Row"""
+
+    _index = {name: i for i, name in enumerate(READING_COLUMN_NAMES)}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(READING_COLUMN_NAMES)
+
+
+def archive_dir(db_file=DB_FILE):
+    """Directory holding the archive files of a database"""
+    root, _ = os.path.splitext(db_file)
+    return f"{root}-archive"
+
+
+def archive_path(db_file, month):
+    return os.path.join(archive_dir(db_file), f"{month}.sca")
+
+
+def month_range(month):
+    """(start_ms, end_ms) of a 'YYYY-MM' month in local time"""
+    start = datetime.strptime(month, "%Y-%m")
+    end = (start + timedelta(days=32)).replace(day=1)
+    return to_epoch_ms(start), to_epoch_ms(end)
+
+
+def archived_months(db_file=DB_FILE):
+    """Sorted list of archived 'YYYY-MM' months"""
+    pattern = os.path.join(glob.escape(archive_dir(db_file)), "[0-9][0-9][0-9][0-9]-[0-9][0-9].sca")
+    return sorted(os.path.basename(path)[:-4] for path in glob.glob(pattern))
+
+
+def archived_ranges(db_file=DB_FILE):
+    """Archived time as sorted, merged (start_ms, end_ms) ranges"""
+    ranges = []
+    for month in archived_months(db_file):
+        start, end = month_range(month)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+# ----- encoding -----
+
+def _delta(values, typecode):
+    return array(typecode, (v - prev for v, prev in zip(values, [0] + values[:-1])))
+
+
+def _undelta(deltas):
+    return array(deltas.typecode, accumulate(deltas))
+
+
+def _scale_for(values):
+    """Smallest power of ten that turns every value into an exact integer, or None"""
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10 ** decimals
+        if all(round(v * scale) / scale == v for v in values):
+            return scale
+    return None
+
+
+def write_archive(path, rows):
+    """
+    Write rows (in READING_COLUMN_NAMES order, sorted by ts and id) to an
+    archive file atomically, returns the number of rows written
+    """
+    devices = {}
+    ids, ts, device_idx, calibrated = [], [], array("H"), array("B")
+    metrics = {m: [] for m in METRICS}
+    nulls = {m: array("B") for m in METRICS}
+    positions = {name: i for i, name in enumerate(READING_COLUMN_NAMES)}
+
+    for row in rows:
+        ids.append(row[positions["id"]])
+        ts.append(row[positions["ts"]])
+        device_idx.append(devices.setdefault(row[positions["device_id"]], len(devices)))
+        calibrated.append(_CALIBRATED.get(row[positions["calibrated"]], 2))
+        for m in METRICS:
+            value = row[positions[m]]
+            column = metrics[m]
+            if value is None:
+                # Repeat the previous value so the delta stays zero
+                column.append(column[-1] if column else 0.0)
+                nulls[m].append(1)
+            else:
+                column.append(float(value))
+                nulls[m].append(0)
+
+    blobs = {
+        "id": (_delta(ids, "q"), True),
+        "ts": (_delta(ts, "q"), True),
+        "device": (device_idx, False),
+        "calibrated": (calibrated, False),
+    }
+    scales = {}
+    for m in METRICS:
+        scales[m] = scale = _scale_for(metrics[m])
+        if scale is None:
+            blobs[m] = (array("d", metrics[m]), False)
+        else:
+            blobs[m] = (_delta([round(v * scale) for v in metrics[m]], "q"), True)
+        if any(nulls[m]):
+            blobs[f"{m}_null"] = (nulls[m], False)
+
+    columns = {}
+    body = []
+    offset = 0
+    for name, (values, delta) in blobs.items():
+        data = zlib.compress(values.tobytes(), COMPRESSION)
+        columns[name] = {"offset": offset, "length": len(data), "type": values.typecode,
+                         "delta": delta}
+        body.append(data)
+        offset += len(data)
+
+    header = json.dumps({
+        "version": 1,
+        "rows": len(ids),
+        "scales": scales,
+        "ts_min": ts[0] if ts else None,
+        "ts_max": ts[-1] if ts else None,
+        "devices": list(devices),
+        "columns": columns,
+    }).encode()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for data in body:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(ids)
+
+
+# ----- reading -----
+
+class ArchiveFile:
+    """Memory-mapped archive file; columns are decompressed on first use"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Not a sensor archive: {path}")
+        self.header = json.loads(self._map[_HEADER.size:_HEADER.size + length])
+        self._base = _HEADER.size + length
+        self._columns = {}
+        self._metrics = {}
+
+    def __len__(self):
+        return self.header["rows"]
+
+    def close(self):
+        self._columns.clear()
+        self._metrics.clear()
+        self._map.close()
+        self._file.close()
+
+    def column(self, name):
+        """Decoded column as an array (metrics still in scaled integer units)"""
+        values = self._columns.get(name)
+        if values is None:
+            info = self.header["columns"].get(name)
+            if info is None:
+                return None
+            start = self._base + info["offset"]
+            values = array(info["type"])
+            values.frombytes(zlib.decompress(self._map[start:start + info["length"]]))
+            if info["delta"]:
+                values = _undelta(values)
+            self._columns[name] = values
+        return values
+
+    def metric(self, name):
+        """Metric column as floats, None where the reading had no value"""
+        values = self._metrics.get(name)
+        if values is None:
+            values = self.column(name)
+            scale = self.header["scales"][name]
+            if scale is not None:
+                values = [v / scale for v in values]
+            nulls = self.column(f"{name}_null")
+            if nulls is not None:
+                values = [None if null else v for v, null in zip(values, nulls)]
+            self._metrics[name] = values
+        return values
+
+    def select(self, filters):
+        """Row positions matching a /query filter dict, in time order"""
+        ts = self.column("ts")
+        start_ms, end_ms = filter_range_ms(filters)
+        lo = 0 if start_ms is None else bisect.bisect_left(ts, start_ms)
+        hi = len(ts) if end_ms is None else bisect.bisect_left(ts, end_ms)
+        selected = range(lo, hi)
+
+        after = filters.get("after")
+        if after:
+            # lo is already the cursor's ts, so only the rows sharing it are compared
+            after_ts, after_id, after_device = after
+            ids, devices = self.column("id"), self.column("device")
+            names = self.header["devices"]
+            tied_end = max(lo, min(hi, bisect.bisect_right(ts, after_ts)))
+            kept = [i for i in range(lo, tied_end)
+                    if (ids[i], names[devices[i]]) > (after_id, after_device)]
+            selected = kept + list(range(tied_end, hi)) if kept else range(tied_end, hi)
+
+        device = filters.get("device")
+        if device:
+            if device not in self.header["devices"]:
+                return []
+            code = self.header["devices"].index(device)
+            devices = self.column("device")
+            selected = [i for i in selected if devices[i] == code]
+
+        # Only the filtered metric columns are decoded at this point
+        for name, (column, op) in RANGE_FILTERS.items():
+            value = filters.get(name)
+            if value is None:
+                continue
+            values = self.metric(column)
+            if op == ">=":
+                selected = [i for i in selected if values[i] is not None and values[i] >= value]
+            else:
+                selected = [i for i in selected if values[i] is not None and values[i] <= value]
+        return selected
+
+    def rows(self, filters):
+        """Matching readings as ArchiveRow tuples, in (ts, id) order"""
+        selected = self.select(filters)
+        if not selected:
+            return
+        ids, ts = self.column("id"), self.column("ts")
+        devices = self.header["devices"]
+        device = self.column("device")
+        calibrated = self.column("calibrated")
+        metrics = [self.metric(m) for m in METRICS]
+        for i in selected:
+            yield ArchiveRow((ids[i], devices[device[i]], ts[i], format_ts(ts[i]),
+                              *(column[i] for column in metrics),
+                              _CALIBRATED_TEXT[calibrated[i]]))
+
+
+class ArchiveCursor:
+    """Cursor-like reader over one archive file's matching rows"""
+
+    def __init__(self, path, filters, limit=None):
+        self.description = [(name,) for name in READING_COLUMN_NAMES]
+        self._archive = ArchiveFile(path)
+        rows = self._archive.rows(filters)
+        self._rows = rows if limit is None else (row for _, row in zip(range(limit), rows))
+
+    def __iter__(self):
+        return self._rows
+
+    def fetchmany(self, size):
+        return [row for _, row in zip(range(size), self._rows)]
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        self._archive.close()
+
+
+def archive_cursors(db_file, filters, limit=None):
+    """One ArchiveCursor per archived month the filter's date range touches"""
+    start_ms, end_ms = filter_range_ms(filters)
+    cursors = []
+    for month in archived_months(db_file):
+        month_start, month_end = month_range(month)
+        if (start_ms is None or month_end > start_ms) and (end_ms is None or month_start < end_ms):
+            cursors.append(ArchiveCursor(archive_path(db_file, month), filters, limit))
+    return cursors
+
+
+def count_archived(db_file, filters):
+    """Number of archived readings matching a filter dict"""
+    count = 0
+    for cursor in archive_cursors(db_file, filters):
+        count += len(cursor._archive.select(filters))
+        cursor.close()
+    return count
+
+
+# ----- export -----
+
+def closed_months(db_file=DB_FILE, now=None):
+    """Months with raw readings that ended at least CLOSE_AFTER_DAYS ago"""
+    limit = to_epoch_ms((now or datetime.now()) - timedelta(days=CLOSE_AFTER_DAYS))
+    months = set()
+    for path in shard_files(db_file):
+        conn = connect(path)
+        try:
+            first = conn.execute("SELECT MIN(ts) FROM sensor_readings").fetchone()[0]
+        finally:
+            conn.close()
+        if first is None:
+            continue
+        month = datetime.fromtimestamp(first / 1000).replace(day=1, hour=0, minute=0,
+                                                             second=0, microsecond=0)
+        while True:
+            _, end = month_range(f"{month:%Y-%m}")
+            if end > limit:
+                break
+            months.add(f"{month:%Y-%m}")
+            month = (month + timedelta(days=32)).replace(day=1)
+    return sorted(months)
+
+
+def archive_month(db_file, month):
+    """
+    Move one month of raw readings into its archive file
+    Rows already archived are merged with any raw rows that arrived since.
+    Raw rows are deleted in batches only after the file is written.
+    Returns the number of raw rows moved
+    """
+    start_ms, end_ms = month_range(month)
+    path = archive_path(db_file, month)
+    where_sql = " WHERE ts >= ? AND ts < ? AND id <= ?"
+
+    with ExitStack() as stack:
+        conns = {}
+        for p in shard_files(db_file):
+            conns[p] = connect(p)
+            stack.callback(conns[p].close)
+            conns[p].execute(CREATE_FLAGS_SQL)
+
+        # Highest id copied per file, so rows written meanwhile stay put
+        upto = {}
+        for p, conn in conns.items():
+            last = conn.execute("SELECT MAX(id) FROM sensor_readings WHERE ts >= ? AND ts < ?",
+                                (start_ms, end_ms)).fetchone()[0]
+            if last is not None:
+                upto[p] = last
+        if not upto:
+            return 0
+
+        moved = 0
+        cursors = []
+        for p, last in upto.items():
+            params = (start_ms, end_ms, last)
+            moved += conns[p].execute(f"SELECT COUNT(*) FROM sensor_readings{where_sql}",
+                                      params).fetchone()[0]
+            cursors.append(conns[p].execute(f"SELECT {READING_COLUMNS} FROM sensor_readings"
+                                            f"{where_sql} ORDER BY ts ASC, id ASC", params))
+        if os.path.exists(path):
+            cursors.append(ArchiveCursor(path, {}))
+        written = write_archive(path, MergedCursor(cursors))
+
+        check = ArchiveFile(path)
+        rows = len(check)
+        check.close()
+        if rows != written:
+            raise RuntimeError(f"Archive {path} holds {rows} rows, expected {written}")
+
+        for p, last in upto.items():
+            delete_batches(conns[p], "DELETE FROM sensor_readings WHERE id IN "
+                           f"(SELECT id FROM sensor_readings{where_sql} LIMIT ?)",
+                           [start_ms, end_ms, last])
+            # Archives keep no flags (anomalies.py): drop those of the moved readings
+            with conns[p]:
+                conns[p].execute("DELETE FROM reading_flags WHERE ts >= ? AND ts < ? AND NOT EXISTS "
+                                 "(SELECT 1 FROM sensor_readings AS r WHERE r.device_id = "
+                                 "reading_flags.device_id AND r.ts = reading_flags.ts)",
+                                 (start_ms, end_ms))
+    return moved
+
+
+def archive_closed_months(db_file=DB_FILE):
+    """Archive every closed month that still has raw rows, returns {month: rows moved}"""
+    return {month: archive_month(db_file, month) for month in closed_months(db_file)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive closed months into compressed column files")
+    parser.add_argument("command", choices=["export", "list"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--month", help="archive just this YYYY-MM month")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for month in archived_months(args.db_file):
+            path = archive_path(args.db_file, month)
+            archive = ArchiveFile(path)
+            print(f"{month}: {len(archive)} readings, {os.path.getsize(path)} bytes, "
+                  f"{len(archive.header['devices'])} devices")
+            archive.close()
+        return 0
+
+    started = time.monotonic()
+    months = [args.month] if args.month else closed_months(args.db_file)
+    for month in months:
+        moved = archive_month(args.db_file, month)
+        print(f"{month}: moved {moved} readings to {archive_path(args.db_file, month)}")
+    print(f"Done in {time.monotonic() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
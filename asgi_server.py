@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+Async (ASGI) server mode for the air quality sensor server
+Serves the same routes as env_server.py on an event loop: POSTs are parsed
+on the loop and handed to the group-commit writer thread, while reads and
+exports run in a thread pool so a large /query never delays ingest. Ingest,
+/status, /latest, /query and /stream are served natively; every other route
+(/metrics, /aggregate, /recent, /last24h, /alerts, /anomalies, ...) is
+passed to the Flask app in the thread pool, which times it the same way.
+
+Usage:
+    python asgi_server.py [--port 5020] [--workers 8] [--max-inflight 256]
+(requires uvicorn: pip install uvicorn)
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+from env_server import (ACK_MODE, ACK_TIMEOUT, QUERY_FORMATS, REQUEST_SECONDS, REQUESTS_TOTAL,
+                        RUN_ALERTS, RUN_RETENTION, alert_engine, broadcaster,
+                        build_reading_query, cache, compactor, decode_body, init_database,
+                        latest_reading, lookup_result, parse_batch, parse_filters, parse_fill,
+                        parse_page, parse_reading, parse_readings, parse_stream_args, query_cache,
+                        query_page, reading_files, record_count, record_upload, stream_filled,
+                        stream_query, upload_sequence, upload_sequences, writer)
+from env_server import app as flask_app
+from live_stream import KEEPALIVE, sse_event, sse_keepalive
+from query_cache import cache_key, etag_matches
+from sensor_db import DEFAULT_DEVICE, now_ms
+from sensor_export import iter_csv, iter_json, iter_ndjson
+
+# Threads running blocking SQLite reads and exports
+WORKERS = 8
+
+# Requests allowed in flight before new ones are refused with 503
+MAX_INFLIGHT = 256
+
+# Submissions waiting in the writer queue before ingest is refused with 503
+MAX_PENDING_WRITES = 1000
+
+# Seconds to wait for in-flight requests when shutting down
+DRAIN_TIMEOUT = 30
+
+# Largest request body accepted (bytes)
+MAX_BODY = 16 * 1024 * 1024
+
+
+class Args:
+    """Query string arguments with the get(name, default, type) API of Flask's request.args"""
+
+    def __init__(self, query_string):
+        self._values = dict(parse_qsl(query_string.decode("latin-1")))
+
+    def get(self, name, default=None, type=None):
+        value = self._values.get(name)
+        if value is None:
+            return default
+        if type is not None:
+            try:
+                return type(value)
+            except ValueError:
+                return default
+        return value
+
+
+class AsyncServer:
+    """ASGI application with request backpressure and graceful drain"""
+
+    def __init__(self, workers=WORKERS, max_inflight=MAX_INFLIGHT):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asgi-db")
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.draining = False
+        self._idle = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, init_database)
+                writer.start()
+                if RUN_ALERTS:
+                    alert_engine.start()
+                if RUN_RETENTION:
+                    compactor.start()
+                self._idle = asyncio.Event()
+                self._idle.set()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.drain()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def drain(self):
+        """Refuse new requests, wait for in-flight ones, then flush the writer"""
+        self.draining = True
+        broadcaster.close()
+        if self._idle is not None:
+            try:
+                await asyncio.wait_for(self._idle.wait(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Shutdown: {self.inflight} requests still running after {DRAIN_TIMEOUT}s")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, compactor.stop)
+        await loop.run_in_executor(None, writer.stop)
+        await loop.run_in_executor(None, alert_engine.stop)
+        self.executor.shutdown(wait=True)
+
+    async def handle(self, scope, receive, send):
+        if self.draining or self.inflight >= self.max_inflight:
+            await send_json(send, 503, {"status": "error", "message": "Server busy, retry later"},
+                            [(b"retry-after", b"1")])
+            return
+
+        # Live streams stay open for as long as the client listens, so they
+        # are bounded by the broadcaster's subscriber limit instead
+        if (scope["method"], scope["path"]) == ("GET", "/stream"):
+            await self.stream(scope, receive, send)
+            return
+
+        self.inflight += 1
+        if self._idle is not None:
+            self._idle.clear()
+        try:
+            route = ROUTES.get((scope["method"], scope["path"]))
+            if route is None:
+                await self.flask(scope, receive, send)
+            else:
+                await self.timed(route, scope, receive, send)
+        finally:
+            self.inflight -= 1
+            if self.inflight == 0 and self._idle is not None:
+                self._idle.set()
+
+    async def timed(self, route, scope, receive, send):
+        """Run a native route, counted and timed like env_server's requests"""
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await route(self, scope, receive, send_status)
+        finally:
+            REQUESTS_TOTAL.inc(route=scope["path"], method=scope["method"], status=status[0])
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=scope["path"])
+
+    async def flask(self, scope, receive, send):
+        """Serve a route the ASGI app doesn't implement through env_server's Flask app"""
+        try:
+            environ = wsgi_environ(scope, await read_body(receive))
+        except Exception as e:
+            await send_json(send, 400, {"error": str(e)})
+            return
+        status, headers, body = await self.run(call_wsgi, flask_app, environ)
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                                for k, v in headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def run(self, fn, *args):
+        """Run a blocking function in the DB thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # ----- routes -----
+
+    async def sensor_data(self, scope, receive, send):
+        try:
+            data = json.loads(await read_body(receive))
+            row = parse_reading(data, scope_device(scope))
+            await self.save_rows(scope, send, [row], {})
+        except Exception as e:
+            await send_json(send, 400, {"status": "error", "message": str(e)})
+
+    async def sensor_data_batch(self, scope, receive, send):
+        try:
+            received_ms = now_ms()
+            body = decode_body(await read_body(receive), header(scope, b"content-encoding"))
+            mimetype = header(scope, b"content-type", "").split(";")[0].strip()
+            readings, upload = parse_batch(body, mimetype)
+            device_id = str(upload.get("device_id") or scope_device(scope))
+            rows, rejected = parse_readings(readings, device_id, received_ms)
+            extra = {"rejected": rejected} if rejected else {}
+            sequence = upload_sequence(upload, device_id)
+            if sequence is None:
+                await self.save_rows(scope, send, rows, {"count": len(rows), **extra})
+            else:
+                await self.save_upload(send, rows, sequence, extra)
+        except Exception as e:
+            await send_json(send, 400, {"status": "error", "message": str(e)})
+
+    async def save_rows(self, scope, send, rows, extra):
+        """Hand rows to the writer, answering on enqueue or commit like env_server"""
+        ack = Args(scope["query_string"]).get("ack", ACK_MODE)
+        if ack not in ("enqueue", "commit"):
+            raise ValueError(f"Unknown ack mode: {ack}")
+        if writer.pending() >= MAX_PENDING_WRITES:
+            await send_json(send, 503, {"status": "error", "message": "Write queue full, retry later"},
+                            [(b"retry-after", b"1")])
+            return
+
+        future = writer.submit(rows)
+        if ack == "enqueue":
+            await send_json(send, 202, {"status": "accepted", **extra,
+                                        "message": "Data queued for saving"})
+            return
+
+        # Shielded: a timeout must not cancel the writer's future
+        stored = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), ACK_TIMEOUT)
+        if "count" in extra:
+            extra = {**extra, "stored": stored, "duplicates": extra["count"] - stored}
+        elif stored == 0:
+            await send_json(send, 200, {"status": "duplicate", "message": "Reading already saved"})
+            return
+        await send_json(send, 200, {"status": "success", **extra,
+                                    "message": "Data saved to database"})
+
+    async def save_upload(self, send, rows, sequence, extra):
+        """Store a numbered upload once, answering on commit like env_server"""
+        if writer.pending() >= MAX_PENDING_WRITES:
+            await send_json(send, 503, {"status": "error", "message": "Write queue full, retry later"},
+                            [(b"retry-after", b"1")])
+            return
+        previous = upload_sequences.claim(*sequence)
+        if previous is None:
+            await send_json(send, 200, {"status": "duplicate", "count": 0, "seq": sequence[2],
+                                        "message": "Batch already saved"})
+            return
+
+        try:
+            stored = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(writer.submit(rows))),
+                                            ACK_TIMEOUT)
+        except Exception:
+            upload_sequences.release(*sequence, previous)
+            raise
+        await self.run(record_upload, sequence)
+        await send_json(send, 200, {"status": "success", "count": len(rows), "stored": stored,
+                                    "duplicates": len(rows) - stored, "seq": sequence[2],
+                                    **extra, "message": "Data saved to database"})
+
+    async def status(self, scope, receive, send):
+        try:
+            count = await self.run(record_count)
+            await send_json(send, 200, {"status": "running",
+                                        "message": "Air Quality Server (ASGI) is active",
+                                        "records": count,
+                                        "inflight": self.inflight,
+                                        "pending_writes": writer.pending()})
+        except Exception as e:
+            await send_json(send, 200, {"status": "running",
+                                        "message": "Air Quality Server (ASGI) is active",
+                                        "error": str(e)})
+
+    async def latest(self, scope, receive, send):
+        try:
+            row = await self.run(latest_reading, Args(scope["query_string"]).get("device"))
+            if row:
+                await send_json(send, 200, row)
+            else:
+                await send_json(send, 404, {"message": "No data available"})
+        except Exception as e:
+            await send_json(send, 400, {"error": str(e)})
+
+    async def query(self, scope, receive, send):
+        """Same parameters as env_server's /query; rows are streamed, pages built whole"""
+        try:
+            args = Args(scope["query_string"])
+            filters = parse_filters(args)
+            stream = args.get("stream", "false").lower() == "true"
+            limit = args.get("limit", default=None if stream else 1000, type=int)
+            fmt = args.get("format", "json").lower()
+            if args.get("export_csv", "false").lower() == "true":
+                fmt = "csv"
+            if fmt not in QUERY_FORMATS:
+                raise ValueError(f"Unknown format: {fmt}")
+            page_size = parse_page(args, filters)
+            if page_size is not None:
+                limit = page_size + 1
+            fill, step_ms = parse_fill(args)
+            if fill and page_size is not None:
+                raise ValueError("fill can't be combined with page_size or cursor")
+            key = cache_key("/query", filters, fmt=fmt, stream=stream, limit=limit, page=page_size,
+                            fill=fill, step=step_ms)
+            entry = lookup_result(key)
+            token = query_cache.token()
+            if entry is None and not fill:
+                query_sql, params = await self.run(build_reading_query, filters, limit)
+                files = await self.run(reading_files, filters)
+        except Exception as e:
+            await send_json(send, 400, {"error": str(e)})
+            return
+
+        formatter, content_type = {
+            "csv": (iter_csv, "text/csv"),
+            "ndjson": (iter_ndjson, "application/x-ndjson"),
+            "json": (iter_json, "application/json"),
+        }[fmt]
+        headers = [(b"content-type", content_type.encode())]
+        if fmt == "csv":
+            headers.append((b"content-disposition",
+                            f"attachment; filename=sensor_data_"
+                            f"{datetime.now():%Y%m%d_%H%M%S}.csv".encode()))
+
+        if entry is None and page_size is not None:
+            body, _, page_headers = await self.run(query_page, files, query_sql, params,
+                                                   page_size, filters, fmt)
+            body = body.encode()
+            entry = query_cache.put(key, body, content_type, filters, token, page_headers)
+            if entry is None:
+                headers += [(k.lower().encode(), v.encode()) for k, v in page_headers.items()]
+                await send({"type": "http.response.start", "status": 200, "headers": headers})
+                await send({"type": "http.response.body", "body": body})
+                return
+
+        if entry is not None:
+            headers += [(k.lower().encode(), v.encode()) for k, v in entry.headers.items()]
+            headers.append((b"etag", entry.etag.encode()))
+            if etag_matches(header(scope, b"if-none-match"), entry.etag):
+                await send({"type": "http.response.start", "status": 304, "headers": headers[-1:]})
+                await send({"type": "http.response.body", "body": b""})
+            else:
+                await send({"type": "http.response.start", "status": 200, "headers": headers})
+                await send({"type": "http.response.body", "body": entry.body})
+            return
+
+        if fill:
+            source = stream_filled(filters, fill, step_ms, limit, formatter)
+        else:
+            source = stream_query(files, query_sql, params, limit, formatter, filters)
+        chunks = query_cache.tee(key, token, filters, content_type, source)
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        try:
+            while True:
+                # Each chunk is fetched and formatted off the event loop
+                chunk = await self.run(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await self.run(chunks.close)
+
+
+    async def stream(self, scope, receive, send):
+        """Same parameters as env_server's /stream; subscribers wait on the loop, not a thread"""
+        try:
+            device, metrics, interval = parse_stream_args(Args(scope["query_string"]))
+        except Exception as e:
+            await send_json(send, 400, {"error": str(e)})
+            return
+        subscription = broadcaster.subscribe(device, metrics, interval)
+        if subscription is None:
+            await send_json(send, 503, {"error": "Too many subscribers, retry later"},
+                            [(b"retry-after", b"5")])
+            return
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        subscription.wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream"),
+                                    (b"cache-control", b"no-cache"),
+                                    (b"x-accel-buffering", b"no")]})
+            record = cache.latest(device)
+            if record:
+                await send_sse(send, sse_event(subscription.shape(record)))
+            idle_since = loop.time()
+            while not subscription.closed and not disconnected.done():
+                ready.clear()
+                records = subscription.take()
+                if records:
+                    await send_sse(send, "".join(sse_event(r) for r in records))
+                    idle_since = loop.time()
+                    continue
+                if loop.time() - idle_since >= KEEPALIVE:
+                    await send_sse(send, sse_keepalive())
+                    idle_since = loop.time()
+                timeout = KEEPALIVE - (loop.time() - idle_since)
+                if subscription.pending():
+                    timeout = min(timeout, subscription.due_in())
+                woken = asyncio.ensure_future(ready.wait())
+                await asyncio.wait([woken, disconnected], timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            broadcaster.unsubscribe(subscription)
+
+
+ROUTES = {
+    ("POST", "/sensor_data"): AsyncServer.sensor_data,
+    ("POST", "/sensor_data/batch"): AsyncServer.sensor_data_batch,
+    ("GET", "/status"): AsyncServer.status,
+    ("GET", "/latest"): AsyncServer.latest,
+    ("GET", "/query"): AsyncServer.query,
+}
+
+
+def header(scope, name, default=None):
+    """First value of a request header as text"""
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return default
+
+
+def scope_device(scope):
+    """Device id for the request, in the same order as env_server.request_device"""
+    return (header(scope, b"x-device-id") or Args(scope["query_string"]).get("device")
+            or DEFAULT_DEVICE)
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI HTTP request whose body has been read"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0] if client else "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_LENGTH":
+            continue
+        if key != "CONTENT_TYPE":
+            key = "HTTP_" + key
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """(status, headers, body) of a WSGI app's whole response"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("Client disconnected")
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY:
+            raise ValueError("Request body too large")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_disconnect(receive):
+    """Return once the client has gone away"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_sse(send, text):
+    await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+
+async def send_json(send, status_code, payload, headers=()):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"application/json"), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+app = AsyncServer()
+
+
+def main():
+    global app
+
+    parser = argparse.ArgumentParser(description="Async air quality sensor server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="threads for database reads and exports")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT,
+                        help="requests in flight before answering 503")
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("uvicorn is required for the async server: pip install uvicorn")
+        return 1
+
+    # One process keeps a single writer and cache; concurrency comes from
+    # the event loop plus the read thread pool
+    app = AsyncServer(args.workers, args.max_inflight)
+    print(f"Air Quality Sensor Server (ASGI) on http://{args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port, lifespan="on")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
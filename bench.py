@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Load generation and benchmarks for the sensor server and query tool
+Every run prints one JSON document so results can be stored and compared
+
+Usage:
+    python bench.py ingest [--url URL] [--devices N] [--rate R] [--duration S] [--batch N]
+    python bench.py query  [--url URL] [--requests N] [--concurrency C]
+    python bench.py cli    [--db FILE] [--years Y] [--devices N] [--interval S] [--repeat N]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import query_sensor_data
+from aggregate import aggregate_buckets, downsample, percentile
+from ingest_writer import INSERT_SQL
+from rollups import backfill, summarize_all, summarize_since
+from sensor_db import connect, init_schema, now_ms
+
+DEFAULT_URL = "http://localhost:5020"
+
+# Rows inserted per transaction when generating a synthetic database
+GENERATE_CHUNK = 50000
+
+
+def latency_stats(samples):
+    """p50/p99/max of a list of latencies in seconds, reported in milliseconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def db_size(db_file):
+    """Size in bytes of a database file and its WAL"""
+    sizes = {}
+    for name, path in (("db_bytes", db_file), ("wal_bytes", db_file + "-wal")):
+        sizes[name] = os.path.getsize(path) if os.path.exists(path) else 0
+    return sizes
+
+
+def device_name(i):
+    """MAC-style id like the one the firmware sends"""
+    return "AA:BB:CC:{:02X}:{:02X}:{:02X}".format((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+
+
+def fake_reading(device_id, t, uptime_s=0, rng=random):
+    """
+    Reading shaped like the JSON ENV_Sensor_AirQuality.ino posts
+    t is seconds since the epoch; values follow a daily cycle plus noise
+    """
+    day = 2 * math.pi * (t % 86400) / 86400
+    return {
+        "device_id": device_id,
+        "temperature": round(21 + 3 * math.sin(day) + rng.gauss(0, 0.3), 2),
+        "humidity": round(45 - 8 * math.sin(day) + rng.gauss(0, 1), 2),
+        "pressure": round(1013 + 5 * math.sin(t / 400000) + rng.gauss(0, 0.2), 2),
+        "gas_resistance": round(max(5.0, 120 + 30 * math.cos(day) + rng.gauss(0, 5)), 2),
+        "air_quality_score": round(min(100.0, max(0.0, 80 + 10 * math.cos(day) + rng.gauss(0, 3))), 2),
+        "estimated_co2": round(max(400.0, 600 + 200 * math.sin(day) + rng.gauss(0, 20)), 2),
+        "calibrated": True,
+        "timestamp": uptime_s,
+        "ts": int(t * 1000),
+    }
+
+
+def post_json(url, payload, timeout=30):
+    """POST a JSON payload, returns (status code, seconds taken)"""
+    body = json.dumps(payload).encode()
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 0
+    return status, time.perf_counter() - started
+
+
+def get_url(url, timeout=120):
+    """GET a URL and read the whole body, returns (status code, bytes, seconds taken)"""
+    started = time.perf_counter()
+    size = 0
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            while True:
+                chunk = resp.read(65536)
+                if not chunk:
+                    break
+                size += len(chunk)
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 0
+    return status, size, time.perf_counter() - started
+
+
+def server_records(url):
+    """Record count reported by /status, or None if unavailable"""
+    try:
+        with urllib.request.urlopen(f"{url}/status", timeout=10) as resp:
+            return json.loads(resp.read()).get("records")
+    except (OSError, ValueError):
+        return None
+
+
+# ----- ingest -----
+
+def run_ingest(args):
+    """Simulate a fleet of devices posting readings at a fixed rate"""
+    interval = 1.0 / args.rate
+    deadline = time.monotonic() + args.duration
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def device_loop(i):
+        rng = random.Random(i)
+        device_id = device_name(i)
+        batch = []
+        # Spread devices over the first interval so they don't fire in lockstep
+        next_send = time.monotonic() + rng.random() * interval
+        while next_send < deadline:
+            time.sleep(max(0.0, next_send - time.monotonic()))
+            batch.append(fake_reading(device_id, time.time(), int(next_send), rng))
+            next_send += interval
+            if len(batch) < args.batch:
+                continue
+            if args.batch > 1:
+                status, elapsed = post_json(f"{args.url}/sensor_data/batch?ack={args.ack}", batch)
+            else:
+                status, elapsed = post_json(f"{args.url}/sensor_data?ack={args.ack}", batch[0])
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + len(batch)
+            batch = []
+
+    before = server_records(args.url)
+    started = time.monotonic()
+    threads = [threading.Thread(target=device_loop, args=(i,), daemon=True)
+               for i in range(args.devices)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    after = server_records(args.url)
+
+    accepted = sum(n for status, n in statuses.items() if 200 <= status < 300)
+    result = {
+        "readings_sent": sum(statuses.values()),
+        "readings_accepted": accepted,
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(accepted / elapsed, 1) if elapsed else None,
+        "request_latency": latency_stats(latencies),
+        "server_records_added": after - before if None not in (before, after) else None,
+    }
+    if args.db:
+        result.update(db_size(args.db))
+    return result
+
+
+# ----- query replay -----
+
+def query_workload(url, devices):
+    """Mix of read requests like the ones dashboards and scripts make"""
+    today = date.today()
+    week_ago = today - timedelta(days=7)
+    paths = [
+        "/latest",
+        "/status",
+        "/recent?limit=60",
+        "/last24h",
+        "/query?limit=1000",
+        f"/query?start_date={week_ago}&end_date={today}&limit=20000",
+        f"/query?start_date={week_ago}&end_date={today}&format=csv&stream=true",
+        "/query?temp_min=25&limit=1000",
+        f"/aggregate?bucket=1h&metrics=temperature,co2&fn=avg,max&start_date={week_ago}&end_date={today}",
+        f"/aggregate?mode=lttb&metrics=temperature&points=500&start_date={week_ago}&end_date={today}",
+    ]
+    for i in range(devices):
+        paths.append(f"/latest?device={urllib.request.quote(device_name(i))}")
+    return [url + path for path in paths]
+
+
+def run_query(args):
+    """Replay the read workload against a running server"""
+    urls = query_workload(args.url, args.devices)
+    jobs = [urls[i % len(urls)] for i in range(args.requests)]
+    results = {}
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for url, (status, size, elapsed) in zip(jobs, pool.map(get_url, jobs)):
+            entry = results.setdefault(url[len(args.url):], {"latencies": [], "bytes": 0, "errors": 0})
+            entry["latencies"].append(elapsed)
+            entry["bytes"] = max(entry["bytes"], size)
+            if status != 200:
+                entry["errors"] += 1
+    elapsed = time.monotonic() - started
+
+    return {
+        "requests": len(jobs),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(jobs) / elapsed, 1) if elapsed else None,
+        "endpoints": {
+            path: {**latency_stats(entry["latencies"]), "bytes": entry["bytes"],
+                   "errors": entry["errors"]}
+            for path, entry in results.items()
+        },
+    }
+
+
+# ----- CLI functions over a synthetic database -----
+
+def generate_database(db_file, years, devices, interval):
+    """
+    Fill db_file with `years` of readings every `interval` seconds per device
+    Returns the number of rows written
+    """
+    conn = connect(db_file)
+    init_schema(conn)
+    rng = random.Random(42)
+    end = int(time.time()) // interval * interval
+    start = end - int(years * 365 * 86400)
+
+    written = 0
+    rows = []
+    for t in range(start, end, interval):
+        for i in range(devices):
+            r = fake_reading(device_name(i), t, t - start, rng)
+            rows.append((r["device_id"], t * 1000, r["temperature"], r["humidity"], r["pressure"],
+                         r["gas_resistance"], r["air_quality_score"], r["estimated_co2"], "true"))
+        if len(rows) >= GENERATE_CHUNK:
+            with conn:
+                conn.executemany(INSERT_SQL, rows)
+            written += len(rows)
+            rows = []
+    if rows:
+        with conn:
+            conn.executemany(INSERT_SQL, rows)
+        written += len(rows)
+
+    backfill(conn)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return written
+
+
+def time_call(fn, repeat):
+    """Run fn `repeat` times, returns (timings dict, last result)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {"min_ms": round(timings[0] * 1000, 3),
+            "median_ms": round(percentile(timings, 50) * 1000, 3)}, result
+
+
+def run_cli(args):
+    """Time the query tool's functions against a synthetic multi-year database"""
+    tmpdir = None
+    db_file = args.db
+    if db_file is None:
+        tmpdir = tempfile.mkdtemp(prefix="sensor-bench-")
+        db_file = os.path.join(tmpdir, "bench.db")
+
+    result = {"db_file": db_file}
+    if not os.path.exists(db_file) or args.regenerate:
+        started = time.perf_counter()
+        result["rows_generated"] = generate_database(db_file, args.years, args.devices, args.interval)
+        result["generate_s"] = round(time.perf_counter() - started, 3)
+    result.update(db_size(db_file))
+
+    query_sensor_data.DB_FILE = db_file
+    today = date.today()
+    month_ago = str(today - timedelta(days=30))
+    year_ago = str(today - timedelta(days=365))
+    filters = query_sensor_data.make_filters(start_date=year_ago, end_date=str(today))
+    day_ago = datetime.now() - timedelta(days=1)
+
+    cases = {
+        "query_data_default": lambda: query_sensor_data.query_data(),
+        "query_data_month": lambda: query_sensor_data.query_data(start_date=month_ago, limit=None),
+        "query_data_temp_range": lambda: query_sensor_data.query_data(temp_min=23, temp_max=24),
+        "count_data_year": lambda: query_sensor_data.count_data(filters),
+        "get_recent_readings": lambda: query_sensor_data.get_recent_readings(60),
+        "get_last_24_hours": lambda: query_sensor_data.get_last_24_hours(),
+    }
+    with connect(db_file) as conn:
+        cases.update({
+            "summarize_all": lambda: summarize_all(conn),
+            "summarize_last_24h": lambda: summarize_since(conn, day_ago),
+            "aggregate_1h_month": lambda: aggregate_buckets(
+                conn, {"start_date": month_ago}, "1h", ["temperature"], ["avg", "min", "max"]),
+            "aggregate_1d_year_p95": lambda: aggregate_buckets(
+                conn, {"start_date": year_ago}, "1d", ["temperature"], ["p95"]),
+            "downsample_year": lambda: downsample(conn, {"start_date": year_ago}, ["temperature"]),
+        })
+
+        timings = {}
+        for name, fn in cases.items():
+            timings[name], rows = time_call(fn, args.repeat)
+            if isinstance(rows, list):
+                timings[name]["rows"] = len(rows)
+        result["functions"] = timings
+
+    if tmpdir and not args.keep:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+        result["db_file"] = None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sensor server and query tool")
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ingest = sub.add_parser("ingest", help="simulate devices posting readings")
+    ingest.add_argument("--url", default=DEFAULT_URL)
+    ingest.add_argument("--devices", type=int, default=10)
+    ingest.add_argument("--rate", type=float, default=1.0, help="readings per second per device")
+    ingest.add_argument("--duration", type=float, default=30.0, help="seconds")
+    ingest.add_argument("--batch", type=int, default=1, help="readings per POST (uses /sensor_data/batch)")
+    ingest.add_argument("--ack", choices=["commit", "enqueue"], default="commit")
+    ingest.add_argument("--db", help="server database file, to report its size")
+
+    replay = sub.add_parser("query", help="replay read requests against a server")
+    replay.add_argument("--url", default=DEFAULT_URL)
+    replay.add_argument("--requests", type=int, default=200)
+    replay.add_argument("--concurrency", type=int, default=4)
+    replay.add_argument("--devices", type=int, default=2, help="devices to ask /latest for")
+
+    cli = sub.add_parser("cli", help="time query functions on a synthetic database")
+    cli.add_argument("--db", help="database to use (generated if missing; default: temporary)")
+    cli.add_argument("--years", type=float, default=2.0)
+    cli.add_argument("--devices", type=int, default=1)
+    cli.add_argument("--interval", type=int, default=60, help="seconds between readings")
+    cli.add_argument("--repeat", type=int, default=5)
+    cli.add_argument("--regenerate", action="store_true", help="rebuild --db even if it exists")
+    cli.add_argument("--keep", action="store_true", help="keep the temporary database")
+    args = parser.parse_args()
+
+    runners = {"ingest": run_ingest, "query": run_query, "cli": run_cli}
+    params = {k: v for k, v in vars(args).items() if k not in ("command", "output")}
+    report = {
+        "benchmark": args.command,
+        "started": now_ms(),
+        "params": params,
+        "results": runners[args.command](args),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Bulk import of historic readings from CSV, NDJSON or another database
+Rows are streamed in and inserted BATCH_ROWS at a time, one transaction
+(and one fsync) per batch. The secondary reading indexes are dropped
+for the import and rebuilt once at the end, which is far cheaper than
+updating them row by row. The unique (device_id, ts) key stays in place,
+so readings already stored, or repeated in the input, are skipped.
+Readings that only share a timestamp with a different reading (legacy
+minute-resolution 'time' text) are kept and moved a millisecond apart,
+as dedup_readings.py does.
+Each batch updates the rollups and anomaly flags in its own
+transaction, the same way the ingest writer does.
+
+CSV and NDJSON files are read in the layout /query and
+query_sensor_data.py export: id, device_id, ts, time, temperature, ...,
+calibrated. The firmware's field names (gas_resistance,
+air_quality_score, estimated_co2) are accepted too. Rows without ts
+are timed from their local 'time' or 'timestamp' text. Rows with an
+empty id are retention-tier averages, not readings, and are skipped.
+So are readings in months that archive.py has already archived.
+A database source is copied with INSERT ... SELECT through ATTACH. It
+must use epoch timestamps ('python migrate_epoch.py' converts it).
+A source without the unique key may hold such shared timestamps and is
+read row by row instead. Its archive files are not read.
+
+Run it while the server is stopped: the server would have to run
+without the dropped indexes, and its caches don't see imported rows.
+If an import is interrupted, the next run or server start recreates
+the indexes.
+
+Usage:
+    python bulk_import.py SOURCE... [--db db_file] [--device D]
+                          [--format csv|ndjson|db] [--batch N] [--keep-indexes]
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from bisect import bisect_right
+from datetime import datetime
+
+from anomalies import AnomalyDetector
+from archive import archived_ranges
+from rollups import init_rollup_tables, last_row_id, update_rollups
+from sensor_db import (DB_FILE, DEFAULT_DEVICE, READING_COLUMNS, READING_INDEXES,
+                       READING_KEY_INDEX, TIME_FORMAT, connect, init_schema, is_legacy_schema,
+                       shard_path, to_epoch_ms)
+import sensor_db
+
+# Readings inserted per transaction
+BATCH_ROWS = 100000
+
+# sensor_readings column -> names accepted in the input, export names first
+FIELD_NAMES = {
+    "temperature": ("temperature",),
+    "humidity": ("humidity",),
+    "pressure": ("pressure",),
+    "gas": ("gas", "gas_resistance"),
+    "aqi": ("aqi", "air_quality_score"),
+    "co2": ("co2", "estimated_co2"),
+}
+
+# Local time formats of rows without ts: the export format, then the
+# minute-resolution text of databases from before epoch timestamps
+TIME_FORMATS = (TIME_FORMAT, "%Y-%m-%d %H:%M")
+
+# Columns compared to tell a copy of a stored reading from a different one
+VALUE_COLUMNS = "temperature, humidity, pressure, gas, aqi, co2, calibrated"
+
+INSERT_SQL = """
+    INSERT INTO sensor_readings
+    (device_id, ts, temperature, humidity, pressure, gas, aqi, co2, calibrated)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT DO NOTHING
+"""
+
+
+def parse_time(text):
+    for fmt in TIME_FORMATS:
+        try:
+            return to_epoch_ms(datetime.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognised time: {text}")
+
+
+def to_row(record, device=DEFAULT_DEVICE):
+    """
+    A sensor_readings row tuple for one input record (a dict), or None for
+    a retention-tier row
+    Raises ValueError (or KeyError) for a record that isn't a reading
+    """
+    get = record.get
+    if "id" in record and get("id") in ("", None):
+        return None
+    ts = get("ts")
+    if ts in ("", None):
+        ts = parse_time(get("time") or record["timestamp"])
+    else:
+        ts = int(float(ts))
+    calibrated = get("calibrated")
+    if calibrated in ("", None):
+        calibrated = None
+    elif isinstance(calibrated, str):
+        calibrated = "true" if calibrated.lower() in ("true", "1") else "false"
+    else:
+        calibrated = "true" if calibrated else "false"
+    row = [str(get("device_id") or device), ts]
+    for names in FIELD_NAMES.values():
+        for name in names:
+            value = get(name)
+            if value is not None and value != "":
+                row.append(float(value))
+                break
+        else:
+            row.append(None)
+    row.append(calibrated)
+    return tuple(row)
+
+
+def read_csv(path):
+    """Records of a CSV file with a header row"""
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        for row in reader:
+            if row:
+                yield dict(zip(header, row))
+
+
+def read_ndjson(path):
+    """Records of a newline-delimited JSON file"""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def source_format(path):
+    """csv, ndjson or db from a file name"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".csv", ".txt"):
+        return "csv"
+    if ext in (".ndjson", ".jsonl", ".json"):
+        return "ndjson"
+    if ext in (".db", ".sqlite", ".sqlite3"):
+        return "db"
+    raise ValueError(f"Can't tell the format of {path}, use --format")
+
+
+class Importer:
+    """
+    Inserts readings into the database file each belongs to, BATCH_ROWS per
+    transaction, with the secondary indexes dropped until finish()
+    """
+
+    def __init__(self, db_file=DB_FILE, batch=BATCH_ROWS, defer_indexes=True):
+        self.db_file = db_file
+        self.batch = batch
+        self.defer_indexes = defer_indexes
+        self.detector = AnomalyDetector()
+        self.archived = archived_ranges(db_file)
+        self._archived_starts = [start for start, _ in self.archived]
+        self._conns = {}
+        self.stats = {"read": 0, "stored": 0, "duplicates": 0, "moved": 0, "tier_rows": 0,
+                      "archived": 0, "invalid": 0}
+
+    def connection(self, path):
+        """Writable connection for a database file, prepared for the import on first use"""
+        conn = self._conns.get(path)
+        if conn is None:
+            conn = connect(path)
+            init_schema(conn)
+            init_rollup_tables(conn)
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                                (READING_KEY_INDEX,)).fetchone():
+                conn.close()
+                raise RuntimeError(f"{path} has no unique (device_id, ts) key, "
+                                   "run 'python dedup_readings.py' before importing")
+            if self.defer_indexes:
+                for name in READING_INDEXES:
+                    conn.execute(f"DROP INDEX IF EXISTS {name}")
+                conn.commit()
+            self._conns[path] = conn
+        return conn
+
+    def is_archived(self, ts):
+        i = bisect_right(self._archived_starts, ts) - 1
+        return i >= 0 and ts < self.archived[i][1]
+
+    def import_records(self, records, device=DEFAULT_DEVICE):
+        """Import an iterable of record dicts"""
+        groups = {}
+        for record in records:
+            self.stats["read"] += 1
+            try:
+                row = to_row(record, device)
+            except (ValueError, KeyError, TypeError):
+                self.stats["invalid"] += 1
+                continue
+            if row is None:
+                self.stats["tier_rows"] += 1
+                continue
+            if self.archived and self.is_archived(row[1]):
+                self.stats["archived"] += 1
+                continue
+            path = shard_path(self.db_file, row[0], row[1])
+            rows = groups.setdefault(path, [])
+            rows.append(row)
+            if len(rows) >= self.batch:
+                self._write(self.connection(path), rows)
+                rows.clear()
+        for path, rows in groups.items():
+            if rows:
+                self._write(self.connection(path), rows)
+
+    def import_database(self, path, device=DEFAULT_DEVICE):
+        """
+        Copy another database's readings, BATCH_ROWS source rows per
+        transaction: with INSERT ... SELECT through ATTACH, or through
+        import_records when the target is sharded or the source has no
+        unique (device_id, ts) key
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if os.path.exists(self.db_file) and os.path.samefile(path, self.db_file):
+            raise ValueError(f"{path} is the database being imported into")
+        source = connect(path, readonly=True)
+        try:
+            if is_legacy_schema(source):
+                raise RuntimeError(f"{path} uses the old TEXT time column, "
+                                   "run 'python migrate_epoch.py' on it first")
+            columns = [row[1] for row in source.execute("PRAGMA table_info(sensor_readings)")]
+            unique_key = source.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                (READING_KEY_INDEX,)).fetchone()
+            if sensor_db.SHARD_BY is not None or not unique_key:
+                select = READING_COLUMNS if "device_id" in columns else \
+                    READING_COLUMNS.replace("device_id", "NULL AS device_id", 1)
+                cursor = source.execute(f"SELECT {select} FROM sensor_readings ORDER BY id")
+                self.import_records((dict(row) for row in cursor), device)
+                return
+        finally:
+            source.close()
+
+        conn = self.connection(self.db_file)
+        # Rows of archived months are left out in the SELECT
+        archived_sql = "".join(" AND NOT (ts >= ? AND ts < ?)" for _ in self.archived)
+        archived_params = [ms for span in self.archived for ms in span]
+        device_sql, device_params = ("device_id", []) if "device_id" in columns else ("?", [device])
+        insert_sql = f"""
+            INSERT INTO sensor_readings
+            (device_id, ts, temperature, humidity, pressure, gas, aqi, co2, calibrated)
+            SELECT {device_sql}, ts, temperature, humidity, pressure, gas, aqi, co2, calibrated
+            FROM src.sensor_readings WHERE id > ? AND id <= ?{archived_sql}
+            ORDER BY ts
+            ON CONFLICT DO NOTHING
+        """
+        conn.execute("ATTACH DATABASE ? AS src", (path,))
+        try:
+            last_id, end_id, total = conn.execute(
+                "SELECT MIN(id) - 1, MAX(id), COUNT(*) FROM src.sensor_readings").fetchone()
+            archived = conn.execute(
+                "SELECT COUNT(*) FROM src.sensor_readings WHERE 0" +
+                archived_sql.replace(" AND NOT ", " OR "), archived_params).fetchone()[0]
+            stored = 0
+            while last_id is not None and last_id < end_id:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    before = last_row_id(conn)
+                    stored += conn.execute(insert_sql, device_params + [
+                        last_id, last_id + self.batch] + archived_params).rowcount
+                    self._after_insert(conn, before)
+                last_id += self.batch
+        finally:
+            conn.execute("DETACH DATABASE src")
+        self.stats["read"] += total
+        self.stats["stored"] += stored
+        self.stats["archived"] += archived
+        self.stats["duplicates"] += total - stored - archived
+
+    def _write(self, conn, rows):
+        # Time order keeps the new rowids in time order, like live ingest
+        rows.sort(key=lambda row: row[1])
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            placed = self._place(conn, rows)
+            before = last_row_id(conn)
+            stored = conn.executemany(INSERT_SQL, placed).rowcount
+            self._after_insert(conn, before)
+        self.stats["stored"] += stored
+        self.stats["duplicates"] += len(rows) - stored
+
+    def _place(self, conn, rows):
+        """
+        rows (in time order) without exact copies of stored or earlier rows,
+        readings that share a key with a different reading moved to the next
+        free millisecond
+        Placement only depends on the input order, so importing the same file
+        again finds every reading as a copy.
+        """
+        spans = {}
+        for row in rows:
+            low, high = spans.get(row[0], (row[1], row[1]))
+            spans[row[0]] = (min(low, row[1]), max(high, row[1]))
+        taken = {}
+        for device_id, (low, high) in spans.items():
+            for stored in conn.execute(f"SELECT device_id, ts, {VALUE_COLUMNS} FROM sensor_readings "
+                                       "WHERE device_id = ? AND ts BETWEEN ? AND ?",
+                                       (device_id, low, high)):
+                taken[tuple(stored[:2])] = tuple(stored[2:])
+        placed = []
+        for row in rows:
+            device_id, ts, values = row[0], row[1], row[2:]
+            while True:
+                held = taken.get((device_id, ts))
+                if held is None and ts > spans[device_id][1]:
+                    # Moved past the span read above
+                    stored = conn.execute(f"SELECT {VALUE_COLUMNS} FROM sensor_readings "
+                                          "WHERE device_id = ? AND ts = ?",
+                                          (device_id, ts)).fetchone()
+                    held = tuple(stored) if stored else None
+                if held is None:
+                    taken[(device_id, ts)] = values
+                    if ts != row[1]:
+                        self.stats["moved"] += 1
+                    placed.append((device_id, ts) + values)
+                    break
+                if held == values:
+                    break
+                ts += 1
+        return placed
+
+    def _after_insert(self, conn, before):
+        """Flag and roll up the rows inserted after id before, in the same transaction"""
+        new_rows = conn.execute(f"SELECT {READING_COLUMNS} FROM sensor_readings "
+                                "WHERE id > ? ORDER BY id", (before,)).fetchall()
+        self.detector.flag(conn, new_rows)
+        update_rollups(conn, before)
+
+    def finish(self):
+        """Rebuild the dropped indexes and close every file"""
+        for conn in self._conns.values():
+            init_schema(conn)
+            conn.execute("PRAGMA optimize")
+            conn.close()
+        self._conns.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import readings")
+    parser.add_argument("sources", nargs="+", help="CSV, NDJSON or SQLite database files")
+    parser.add_argument("--db", default=DB_FILE, help="database to import into")
+    parser.add_argument("--device", default=DEFAULT_DEVICE,
+                        help="device id for rows that don't carry one")
+    parser.add_argument("--format", choices=["csv", "ndjson", "db"],
+                        help="source format (default: from the file extension)")
+    parser.add_argument("--batch", type=int, default=BATCH_ROWS, help="rows per transaction")
+    parser.add_argument("--keep-indexes", action="store_true",
+                        help="keep the secondary indexes during the import (small imports)")
+    args = parser.parse_args()
+
+    importer = Importer(args.db, args.batch, not args.keep_indexes)
+    started = time.monotonic()
+    try:
+        for path in args.sources:
+            fmt = args.format or source_format(path)
+            file_started = time.monotonic()
+            stored = importer.stats["stored"]
+            if fmt == "db":
+                importer.import_database(path, args.device)
+            else:
+                reader = read_csv if fmt == "csv" else read_ndjson
+                importer.import_records(reader(path), args.device)
+            stored = importer.stats["stored"] - stored
+            elapsed = time.monotonic() - file_started
+            print(f"{path}: {stored} readings stored in {elapsed:.1f}s "
+                  f"({stored / elapsed if elapsed else 0:.0f} rows/s)")
+    finally:
+        index_started = time.monotonic()
+        importer.finish()
+        print(f"Indexes rebuilt in {time.monotonic() - index_started:.1f}s")
+
+    elapsed = time.monotonic() - started
+    stats = importer.stats
+    print(f"Done in {elapsed:.1f}s: {stats['read']} rows read, {stats['stored']} stored "
+          f"({stats['stored'] / elapsed if elapsed else 0:.0f} rows/s), "
+          f"{stats['duplicates']} duplicates, {stats['moved']} moved 1 ms apart, "
+          f"{stats['tier_rows']} tier rows, "
+          f"{stats['archived']} in archived months, {stats['invalid']} invalid")
+    flagged = ", ".join(f"{n} {kind}" for kind, n in importer.detector.flagged.items() if n)
+    if flagged:
+        print(f"Flagged: {flagged}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
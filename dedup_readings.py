@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Remove duplicate readings so the unique (device_id, ts) key can be created
+Databases written before ingest was idempotent can hold the same reading
+more than once (a firmware retry after a timeout was stored again), and
+readings migrated from minute-resolution text times can share a timestamp
+while holding different values. Exact copies are deleted, keeping the
+oldest row; readings that only share a timestamp are kept and moved a
+millisecond apart. Everything happens in one transaction that ends with
+creating the unique index, so ingest waits while it runs. Afterwards the
+rollups of the raw span are rebuilt and freed pages released. Archived
+months (archive.py) are not touched.
+
+Usage:
+    python dedup_readings.py [db_file] [--dry-run]
+"""
+
+import argparse
+import sys
+import time
+
+from retention import incremental_vacuum
+from rollups import backfill, has_rollups
+from sensor_db import (DB_FILE, LEGACY_KEY_INDEX, READING_KEY_COLUMNS, READING_KEY_INDEX, connect,
+                       shard_files)
+
+# Columns compared to tell an exact copy from a different reading
+VALUE_COLUMNS = ("temperature", "humidity", "pressure", "gas", "aqi", "co2", "calibrated")
+
+
+def duplicate_keys(conn):
+    """(device_id, ts) keys held by more than one row"""
+    return conn.execute("SELECT device_id, ts FROM sensor_readings "
+                        "GROUP BY device_id, ts HAVING COUNT(*) > 1").fetchall()
+
+
+def plan_group(conn, device_id, ts, taken):
+    """
+    Ids to delete and (id, new ts) moves for one duplicated key
+    taken holds (device_id, ts) keys already handed out by earlier moves
+    """
+    rows = conn.execute(f"SELECT id, {', '.join(VALUE_COLUMNS)} FROM sensor_readings "
+                        "WHERE device_id = ? AND ts = ? ORDER BY id", (device_id, ts)).fetchall()
+    kept = {tuple(rows[0])[1:]}
+    deletes, moves = [], []
+    next_ts = ts
+    for row in rows[1:]:
+        values = tuple(row)[1:]
+        if values in kept:
+            deletes.append(row[0])
+            continue
+        kept.add(values)
+        next_ts += 1
+        while (device_id, next_ts) in taken or conn.execute(
+                "SELECT 1 FROM sensor_readings WHERE device_id = ? AND ts = ?",
+                (device_id, next_ts)).fetchone():
+            next_ts += 1
+        taken.add((device_id, next_ts))
+        moves.append((row[0], next_ts))
+    return deletes, moves
+
+
+def dedup(conn, dry_run=False):
+    """
+    Delete exact copies, separate readings sharing a key and create the
+    unique index, returns {"keys": ..., "deleted": ..., "moved": ...}
+    """
+    # An index on the key columns keeps the lookups below cheap
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                        (READING_KEY_INDEX,)).fetchone():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {LEGACY_KEY_INDEX} "
+                     f"ON sensor_readings({READING_KEY_COLUMNS})")
+        conn.commit()
+    result = {"keys": 0, "deleted": 0, "moved": 0}
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        taken = set()
+        for device_id, ts in duplicate_keys(conn):
+            deletes, moves = plan_group(conn, device_id, ts, taken)
+            result["keys"] += 1
+            result["deleted"] += len(deletes)
+            result["moved"] += len(moves)
+            conn.executemany("DELETE FROM sensor_readings WHERE id = ?", [(i,) for i in deletes])
+            conn.executemany("UPDATE sensor_readings SET ts = ? WHERE id = ?",
+                             [(new_ts, i) for i, new_ts in moves])
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {READING_KEY_INDEX} "
+                     f"ON sensor_readings({READING_KEY_COLUMNS})")
+        conn.execute(f"DROP INDEX IF EXISTS {LEGACY_KEY_INDEX}")
+    except BaseException:
+        conn.rollback()
+        raise
+    if dry_run:
+        conn.rollback()
+        return result
+    conn.commit()
+
+    if result["deleted"] and has_rollups(conn):
+        # Copies were counted into the rollups when they were inserted
+        backfill(conn)
+    result["vacuumed_pages"] = incremental_vacuum(conn)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove duplicate readings")
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="report what would change without changing anything")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    for path in shard_files(args.db_file):
+        conn = connect(path)
+        try:
+            result = dedup(conn, args.dry_run)
+        finally:
+            conn.close()
+        print(f"{path}: {result['keys']} duplicated keys, {result['deleted']} copies deleted, "
+              f"{result['moved']} readings moved" + (" (dry run)" if args.dry_run else ""))
+    print(f"Done in {time.monotonic() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
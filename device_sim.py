@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the buffered uploads of ENV_Sensor_AirQuality.ino
+Each simulated device samples readings into a ring buffer and uploads them
+the way the firmware does: compact batches with a boot id, a sequence
+number and each reading's time (or age, without a clock), over one
+keep-alive connection, resending
+an unanswered batch unchanged. Outages, replies lost on the way back and
+reboots can be injected. At the end every device comes back online,
+drains its buffer, and the readings stored on the server are compared with
+the ones sampled (count and timestamp error). Prints one JSON document.
+
+Usage:
+    python device_sim.py [--url URL] [--devices N] [--duration S] [--sample S] [--upload S]
+                         [--outage-rate P] [--lost-reply-rate P] [--reboot-rate P] [--gzip]
+                         [--no-clock] [--no-seq]
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+from urllib.parse import urlsplit
+
+from bench import DEFAULT_URL, fake_reading
+
+# Same row layout as the firmware: "ts" or "age_ms", then UPLOAD_FIELDS
+UPLOAD_FIELDS = ("temperature", "humidity", "pressure", "gas_resistance",
+                 "air_quality_score", "estimated_co2", "calibrated")
+
+# Buffer size and readings per upload, as in the firmware
+BUFFER_SIZE = 1440
+MAX_BATCH = 120
+
+# Upload attempts per device when draining at the end
+DRAIN_ATTEMPTS = 50
+
+
+class SimDevice:
+    """One device: ring buffer, boot id and batch sequence, persistent connection"""
+
+    def __init__(self, device_id, url, args, rng):
+        parts = urlsplit(url)
+        self.device_id = device_id
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = (parts.path.rstrip("/") or "") + "/sensor_data/batch"
+        self.args = args
+        self.rng = rng
+        self.buffer = deque()      # (monotonic time, epoch ms, reading) per sample
+        self.in_flight = 0         # readings sent in the current, unanswered batch
+        self.in_flight_saved = False
+        self.boot = rng.getrandbits(32)
+        self.seq = 0
+        self.online = True
+        self.offline_until = 0.0
+        self.conn = None
+        self.sampled = []          # epoch ms of every reading taken
+        self.lost = set()          # epoch ms of readings that can never reach the server
+        self.stats = {"uploads": 0, "failed": 0, "lost_replies": 0, "duplicates": 0,
+                      "readings_skipped": 0, "connections": 0, "bytes": 0, "outages": 0,
+                      "reboots": 0, "overwritten": 0}
+
+    def sample(self):
+        if len(self.buffer) == BUFFER_SIZE:
+            _, taken_ms, _ = self.buffer.popleft()
+            if not (self.in_flight and self.in_flight_saved):
+                self.lost.add(taken_ms)
+            self.stats["overwritten"] += 1
+            if self.in_flight:
+                self.in_flight, self.in_flight_saved = 0, False
+                self.seq += 1
+        taken_ms = int(time.time() * 1000)
+        reading = fake_reading(self.device_id, taken_ms / 1000, rng=self.rng)
+        self.buffer.append((time.monotonic(), taken_ms, reading))
+        self.sampled.append(taken_ms)
+
+    def reboot(self):
+        """Lose the buffer and start a new boot (seq starts over)"""
+        for i, (_, taken_ms, _) in enumerate(self.buffer):
+            if not (i < self.in_flight and self.in_flight_saved):
+                self.lost.add(taken_ms)
+        self.buffer.clear()
+        self.in_flight, self.in_flight_saved = 0, False
+        self.boot = self.rng.getrandbits(32)
+        self.seq = 0
+        self.disconnect()
+        self.stats["reboots"] += 1
+
+    def disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.stats["connections"] += 1
+        return self.conn
+
+    def upload(self):
+        """Send the oldest readings as one batch; True if they left the buffer"""
+        if not self.buffer:
+            return False
+        if self.in_flight == 0:
+            self.in_flight = min(len(self.buffer), MAX_BATCH)
+
+        now = time.monotonic()
+        clock = not self.args.no_clock
+        rows = [[taken_ms if clock else int((now - taken) * 1000)] +
+                [reading[f] for f in UPLOAD_FIELDS]
+                for taken, taken_ms, reading in islice(self.buffer, self.in_flight)]
+        upload = {"device_id": self.device_id,
+                  "fields": ("ts" if clock else "age_ms",) + UPLOAD_FIELDS, "rows": rows}
+        if not self.args.no_seq:
+            upload.update(boot=self.boot, seq=self.seq)
+        body = json.dumps(upload).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.args.gzip:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
+        try:
+            conn = self.connection()
+            conn.request("POST", self.path, body, headers)
+            resp = conn.getresponse()
+            payload = json.loads(resp.read() or b"{}")
+        except (OSError, ValueError, http.client.HTTPException):
+            self.disconnect()
+            self.stats["failed"] += 1
+            return False
+        self.stats["uploads"] += 1
+        self.stats["bytes"] += len(body)
+        if resp.status != 200:
+            self.stats["failed"] += 1
+            return False
+        if self.rng.random() < self.args.lost_reply_rate:
+            # Saved, but the device never hears about it and will resend
+            self.in_flight_saved = True
+            self.stats["lost_replies"] += 1
+            self.disconnect()
+            return False
+        if payload.get("status") == "duplicate":
+            self.stats["duplicates"] += 1
+        self.stats["readings_skipped"] += payload.get("duplicates", 0)
+
+        for _ in range(self.in_flight):
+            self.buffer.popleft()
+        self.in_flight, self.in_flight_saved = 0, False
+        self.seq += 1
+        return True
+
+    def tick_link(self, now):
+        """Maybe go offline, reboot or come back online before an upload"""
+        if not self.online:
+            if now >= self.offline_until:
+                self.online = True
+            return
+        if self.rng.random() < self.args.reboot_rate:
+            self.reboot()
+        if self.rng.random() < self.args.outage_rate:
+            self.online = False
+            self.offline_until = now + self.args.outage * (0.5 + self.rng.random())
+            self.disconnect()
+            self.stats["outages"] += 1
+
+    def run(self, deadline):
+        next_sample = time.monotonic() + self.rng.random() * self.args.sample
+        next_upload = next_sample + self.args.upload
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= next_sample:
+                # Like the firmware: the next reading is due an interval
+                # after this one, missed ones are not caught up
+                self.sample()
+                next_sample = now + self.args.sample
+            if now >= next_upload:
+                next_upload += self.args.upload
+                self.tick_link(now)
+                # After an outage keep sending until the buffer has drained
+                while self.online and self.upload() and self.buffer:
+                    pass
+            time.sleep(max(0.0, min(next_sample, next_upload, deadline) - time.monotonic()))
+
+    def drain(self):
+        self.online = True
+        attempts = 0
+        while self.buffer and attempts < DRAIN_ATTEMPTS:
+            if not self.upload():
+                attempts += 1
+        self.disconnect()
+
+    def expected(self):
+        return [ts for ts in self.sampled if ts not in self.lost]
+
+
+def stored_timestamps(url, device_id):
+    """ts of every reading the server holds for device_id, in time order"""
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=120)
+    try:
+        path = parts.path.rstrip("/") + f"/query?format=ndjson&stream=true&device={device_id}"
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        lines = resp.read().decode().splitlines()
+    finally:
+        conn.close()
+    return sorted(json.loads(line)["ts"] for line in lines if line.strip())
+
+
+def compare(expected, stored):
+    """Missing/extra counts and the worst timestamp error of matched readings"""
+    result = {"expected": len(expected), "stored": len(stored),
+              "missing": max(0, len(expected) - len(stored)),
+              "extra": max(0, len(stored) - len(expected)),
+              "max_ts_error_ms": None}
+    if len(expected) == len(stored) and expected:
+        result["max_ts_error_ms"] = max(abs(s - e) for s, e in zip(stored, expected))
+    return result
+
+
+def run(args):
+    run_id = random.getrandbits(16)
+    devices = [SimDevice(f"SIM-{run_id:04X}-{i:02d}", args.url, args,
+                         random.Random(args.seed + i))
+               for i in range(args.devices)]
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=device.run, args=(deadline,), daemon=True)
+               for device in devices]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for device in devices:
+        device.drain()
+
+    totals = {}
+    checks = []
+    for device in devices:
+        for key, value in device.stats.items():
+            totals[key] = totals.get(key, 0) + value
+        checks.append(compare(device.expected(), stored_timestamps(args.url, device.device_id)))
+
+    errors = [c["max_ts_error_ms"] for c in checks if c["max_ts_error_ms"] is not None]
+    return {
+        "devices": [d.device_id for d in devices],
+        "sampled": sum(len(d.sampled) for d in devices),
+        "lost_on_device": sum(len(d.lost) for d in devices),
+        "still_buffered": sum(len(d.buffer) for d in devices),
+        **totals,
+        "expected": sum(c["expected"] for c in checks),
+        "stored": sum(c["stored"] for c in checks),
+        "missing": sum(c["missing"] for c in checks),
+        "extra": sum(c["extra"] for c in checks),
+        "max_ts_error_ms": max(errors) if errors else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate devices uploading buffered readings")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--sample", type=float, default=0.5, help="seconds between readings")
+    parser.add_argument("--upload", type=float, default=2.0, help="seconds between uploads")
+    parser.add_argument("--outage-rate", type=float, default=0.1,
+                        help="chance per upload of the link going down")
+    parser.add_argument("--outage", type=float, default=5.0, help="typical outage length (s)")
+    parser.add_argument("--lost-reply-rate", type=float, default=0.1,
+                        help="chance a saved batch's reply never reaches the device")
+    parser.add_argument("--reboot-rate", type=float, default=0.0,
+                        help="chance per upload of a reboot (buffer lost)")
+    parser.add_argument("--gzip", action="store_true", help="compress uploads")
+    parser.add_argument("--no-clock", action="store_true",
+                        help="send each reading's age instead of its time (clock not set yet)")
+    parser.add_argument("--no-seq", action="store_true",
+                        help="send no boot/seq, leaving resends to the database key")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    report = {"params": vars(args), "results": run(args)}
+    print(json.dumps(report, indent=2))
+    return 0 if report["results"]["missing"] == report["results"]["extra"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
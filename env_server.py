@@ -4,53 +4,439 @@ Flask server to receive air quality sensor data from M5Stack
 Stores data in SQLite database instead of CSV
 """
 
-import sqlite3
+import atexit
+import heapq
+import json
+import math
+import os
+import time
+import zlib
+from contextlib import ExitStack
 from datetime import datetime
+from itertools import islice
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+from alerts import ALERT_RULES, AlertEngine, FileSink, WebhookSink, load_rules
+from anomalies import AnomalyDetector, flag_filters, read_flags
+from archive import archive_closed_months, archived_ranges
+from aggregate import (DEFAULT_POINTS, FILL_METHODS, aggregate_buckets, downsample, fill_series,
+                       parse_functions, parse_list)
+from federated import map_files, open_federated, query_files
+from ingest_writer import GroupCommitWriter
+from instrumentation import (REGISTRY, Counter, Gauge, Histogram, RateLimitedLog,
+                             SamplingProfiler)
+from live_cache import DAY_MS, LiveCache
+from live_stream import KEEPALIVE, Broadcaster, sse_event, sse_keepalive
+from query_cache import QueryCache, cache_key, etag_matches
+from retention import RETENTION_DAYS, RetentionJob, build_tiered_query
+from rollups import (METRICS, backfill, has_rollups, init_rollup_tables, read_cutoffs,
+                     summarize_all, untrusted_mask)
+import sensor_db
+from sensor_db import (CREATE_FLAGS_SQL, DB_FILE, DEFAULT_DEVICE, RANGE_FILTERS, READING_COLUMNS,
+                       build_where, check_page_size, db_connection, decode_cursor, fetch_page,
+                       filter_range_ms, format_ts, init_schema, now_ms, shard_files)
+from sensor_export import (RowsCursor, column_names, iter_chunks, iter_csv, iter_json,
+                           iter_ndjson)
+from uploads import ReceiveStamps, SequenceTracker
 
 app = Flask(__name__)
 
-# Database file
-DB_FILE = "/home/terry/env_home/sensor_data.db"
+# Group-commit settings: readings from all devices are buffered and written
+# in one transaction every BATCH_MAX_ROWS rows or BATCH_MAX_DELAY_MS ms
+BATCH_MAX_ROWS = 500
+BATCH_MAX_DELAY_MS = 200
+
+# "commit" answers a POST once its rows are committed to disk,
+# "enqueue" answers as soon as they are buffered (can be overridden with ?ack=)
+ACK_MODE = "commit"
+ACK_TIMEOUT = 10  # seconds to wait for a commit before reporting an error
+
+# Buffered uploads (a firmware ring buffer, a backfill after an outage) may
+# carry readings taken up to this many days before they arrive; older data
+# goes through bulk_import.py. Kept well inside RETENTION_DAYS["raw"]. A late
+# reading in a month archive.py has already closed is merged into the
+# archive on its next run
+MAX_READING_AGE_DAYS = 14
+
+# Clock error tolerated for readings that carry their own epoch time
+MAX_CLOCK_SKEW_MS = 60 * 1000
+
+# Largest batch body accepted once decompressed (bytes)
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Output formats accepted by /query
+QUERY_FORMATS = ("json", "csv", "ndjson")
+
+# Readings per /query page when a cursor is sent without page_size
+PAGE_SIZE = 1000
+
+# Spacing of a gap-filled /query series (?fill=) when no step is given (seconds)
+FILL_STEP = 60
+
+# Columns of a gap-filled /query series
+FILL_COLUMNS = ("device_id", "ts", "time") + METRICS + ("filled",)
+
+# Per-reading log lines (JSON, one per line). Off by default; when on, at
+# most LOG_READINGS_PER_MINUTE lines are printed and the rest are counted
+LOG_READINGS = False
+LOG_READINGS_PER_MINUTE = 10
+
+# Allow /debug/profiler to start the sampling profiler at runtime
+ALLOW_PROFILER = True
+
+# Evaluate the alert rules in alerts.py (ALERT_RULES) on every committed
+# reading. Events are appended to ALERT_FILE and/or posted to ALERT_WEBHOOK
+RUN_ALERTS = True
+ALERT_FILE = os.path.join(os.path.dirname(DB_FILE), "alerts.jsonl")
+ALERT_WEBHOOK = None
+
+# Flag spikes, stuck sensors, pre-calibration values and gaps (anomalies.py)
+# in the transaction that stores each reading; spikes and pre-calibration
+# values are left out of the rollups, aggregates and charts
+FLAG_ANOMALIES = True
+
+# Apply the retention policy in retention.py (RETENTION_DAYS) in the background.
+# Off by default: compaction deletes raw readings older than the raw window
+# for good, so turn ARCHIVE_MONTHS on too unless the rollups are enough
+RUN_RETENTION = False
+
+# Before each retention run, move closed months of raw readings into
+# compressed archive files (archive.py) so they keep full resolution
+ARCHIVE_MONTHS = False
+
+writer = GroupCommitWriter(DB_FILE, BATCH_MAX_ROWS, BATCH_MAX_DELAY_MS)
+atexit.register(writer.stop)
+
+# Latest readings, record count and ~24h ring buffers, updated on every commit
+cache = LiveCache()
+writer.listeners.append(cache.add)
+
+# Finished /query and /aggregate bodies; commits drop the entries whose range
+# they touch, and retention runs drop everything (rows move between tiers)
+query_cache = QueryCache()
+writer.listeners.append(query_cache.invalidate)
+
+# Live /stream subscribers, fed from memory on every commit
+broadcaster = Broadcaster()
+writer.listeners.append(broadcaster.publish)
+
+# Alert rules run on their own thread; the writer only queues committed rows
+alert_sinks = [FileSink(ALERT_FILE)] if ALERT_FILE else []
+if ALERT_WEBHOOK:
+    alert_sinks.append(WebhookSink(ALERT_WEBHOOK))
+alert_engine = AlertEngine(load_rules(ALERT_RULES), alert_sinks)
+if RUN_ALERTS:
+    writer.listeners.append(alert_engine.submit)
+
+anomaly_detector = AnomalyDetector()
+if FLAG_ANOMALIES:
+    writer.pre_commit.append(anomaly_detector.flag)
+
+# Last (boot, seq) committed per device, so resent upload batches are
+# acknowledged without being stored twice
+upload_sequences = SequenceTracker()
+
+# Receive times handed to readings sent without ts or age_ms
+receive_stamps = ReceiveStamps()
+
+compactor = RetentionJob(DB_FILE)
+if ARCHIVE_MONTHS:
+    compactor.tasks.append(archive_closed_months)
+compactor.listeners.append(lambda results: query_cache.clear())
+
+reading_log = RateLimitedLog(LOG_READINGS_PER_MINUTE)
+reading_log.enabled = LOG_READINGS
+profiler = SamplingProfiler()
+
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "sensor_http_requests_total", "HTTP requests handled", ("route", "method", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "sensor_http_request_duration_seconds", "HTTP request latency", ("route",)))
+QUERY_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "sensor_query_cache_lookups_total", "Result cache lookups", ("result",)))
+
+
+def file_sizes(suffix=""):
+    """{file: size in bytes} for every database file (or its -wal)"""
+    sizes = {}
+    for path in shard_files(DB_FILE):
+        try:
+            sizes[os.path.basename(path)] = os.path.getsize(path + suffix)
+        except OSError:
+            sizes[os.path.basename(path)] = 0
+    return sizes
+
+
+def device_ages():
+    """Seconds since the latest reading of every device"""
+    now = now_ms()
+    return {device: (now - ts) / 1000.0 for device, ts in cache.last_seen().items()}
+
+
+REGISTRY.register(Gauge("sensor_write_queue_depth",
+                        "Submissions waiting for the group-commit writer", writer.pending))
+REGISTRY.register(Gauge("sensor_db_file_bytes", "Database file size", file_sizes, ("file",)))
+REGISTRY.register(Gauge("sensor_db_wal_bytes", "Write-ahead log size",
+                        lambda: file_sizes("-wal"), ("file",)))
+REGISTRY.register(Gauge("sensor_ingest_duplicates", "Resent readings skipped since start",
+                        lambda: writer.duplicates))
+REGISTRY.register(Gauge("sensor_ingest_recent_key_hits",
+                        "Duplicates caught by the writer's recent-key filter", lambda: writer.recent.hits))
+REGISTRY.register(Gauge("sensor_query_cache_bytes", "Size of cached response bodies",
+                        lambda: query_cache.size))
+REGISTRY.register(Gauge("sensor_stream_subscribers", "Connected /stream subscribers",
+                        broadcaster.subscribers))
+REGISTRY.register(Gauge("sensor_alerts_active", "Alerts currently firing",
+                        lambda: len(alert_engine.active())))
+REGISTRY.register(Gauge("sensor_alert_events", "Alert events delivered since start",
+                        lambda: alert_engine.events))
+REGISTRY.register(Gauge("sensor_anomaly_flags", "Readings flagged since start, by kind",
+                        lambda: anomaly_detector.flagged, ("kind",)))
+REGISTRY.register(Gauge("sensor_device_last_seen_seconds",
+                        "Seconds since the latest reading from each device", device_ages, ("device",)))
 
 
 def init_database():
     """Create the database table if it doesn't exist"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            time TEXT NOT NULL,
-            temperature REAL,
-            humidity REAL,
-            pressure REAL,
-            gas REAL,
-            aqi REAL,
-            co2 REAL,
-            calibrated TEXT
-        )
-    """)
-    
-    # Create indexes for faster queries on commonly filtered columns
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_time 
-        ON sensor_readings(time)
-    """)
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_temperature 
-        ON sensor_readings(temperature)
-    """)
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_humidity 
-        ON sensor_readings(humidity)
-    """)
-    
-    conn.commit()
-    conn.close()
+    with db_connection(DB_FILE) as conn:
+        init_schema(conn)
+        upload_sequences.load(conn)
+        if init_rollup_tables(conn):
+            print("Rebuilding rollup tables...")
+            backfill(conn)
+    # Queries join reading_flags, so shard files need it before the writer opens them
+    for path in shard_files(DB_FILE):
+        with db_connection(path) as conn:
+            conn.execute(CREATE_FLAGS_SQL)
+            conn.commit()
     print(f"Database initialized: {DB_FILE}")
+    prime_cache()
+
+
+def count_records():
+    """Total readings across every database file"""
+    count = 0
+    for path in shard_files(DB_FILE):
+        with db_connection(path) as conn:
+            if has_rollups(conn):
+                count += summarize_all(conn)["count"]
+            else:
+                count += conn.execute("SELECT COUNT(*) FROM sensor_readings").fetchone()[0]
+    return count
+
+
+def record_count():
+    """Record count from the cache, counted on disk only before priming"""
+    count = cache.count()
+    if count is None:
+        count = count_records()
+    return count
+
+
+def latest_reading(device=None):
+    """Most recent reading (of one device) as a dict, or None"""
+    record = cache.latest(device)
+    if record:
+        return record
+    
+    where_sql, params = build_where({"device": device})
+    row = None
+    for path in shard_files(DB_FILE, device):
+        with db_connection(path) as conn:
+            candidate = conn.execute(f"""
+                SELECT {READING_COLUMNS} FROM sensor_readings{where_sql}
+                ORDER BY ts DESC, id DESC 
+                LIMIT 1
+            """, params).fetchone()
+        if candidate and (row is None or candidate["ts"] > row["ts"]):
+            row = candidate
+    return dict(row) if row else None
+
+
+def read_since(since_ms, device=None):
+    """Readings at or after since_ms from disk, in time order"""
+    where_sql, params = build_where({"device": device})
+    query_sql = (f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} AND ts >= ? "
+                 "ORDER BY ts ASC, id ASC")
+    with ExitStack() as stack:
+        return open_query(stack, shard_files(DB_FILE, device, since_ms), query_sql,
+                          params + [since_ms]).fetchall()
+
+
+def prime_cache():
+    """Load the record count and the last 24 hours of readings into the cache"""
+    since_ms = now_ms() - DAY_MS
+    rows = read_since(since_ms)
+    cache.prime(count_records(), rows, since_ms)
+    alert_engine.prime(cache.last_seen())
+    # Warm the anomaly statistics up, so a restart doesn't start them cold
+    anomaly_detector.prime(rows)
+
+
+def request_device():
+    """
+    Device id for readings in this request that don't carry their own:
+    X-Device-ID header, then ?device=, then DEFAULT_DEVICE (client addresses
+    change with DHCP and NAT, so they don't name a device)
+    """
+    return request.headers.get("X-Device-ID") or request.args.get("device") or DEFAULT_DEVICE
+
+
+def reading_value(data, name):
+    """One metric of a JSON reading rounded to 1 decimal, None when sent as null or NaN"""
+    value = data.get(name, 0)
+    if value is None:
+        return None
+    value = float(value)
+    return round(value, 1) if math.isfinite(value) else None
+
+
+def parse_reading(data, device_id=DEFAULT_DEVICE, received_ms=None):
+    """
+    Convert one JSON reading into a sensor_readings row tuple
+    Readings uploaded from a device buffer carry their age in milliseconds
+    when sent (age_ms, the device clock is only uptime), clients with a real
+    clock may send epoch milliseconds (ts); anything else is stamped with
+    the server receive time (see ReceiveStamps)
+    """
+    device_id = str(data.get("device_id") or device_id)
+
+    # Extract and round values to 1 decimal place
+    temperature = reading_value(data, "temperature")
+    humidity = reading_value(data, "humidity")
+    pressure = reading_value(data, "pressure")
+    gas = reading_value(data, "gas_resistance")
+    aqi = reading_value(data, "air_quality_score")
+    co2 = reading_value(data, "estimated_co2")
+    calibrated = "true" if data.get("calibrated", False) else "false"
+
+    # Epoch milliseconds
+    received_ms = received_ms or now_ms()
+    if data.get("age_ms") is not None:
+        ts = received_ms - int(data["age_ms"])
+    elif data.get("ts") is not None:
+        ts = int(data["ts"])
+    else:
+        ts = receive_stamps.stamp(device_id, received_ms)
+    if ts < received_ms - MAX_READING_AGE_DAYS * DAY_MS:
+        raise ValueError(f"Reading time {format_ts(ts)} is more than {MAX_READING_AGE_DAYS} "
+                         "days old, import older readings with bulk_import.py")
+    if ts > received_ms + MAX_CLOCK_SKEW_MS:
+        raise ValueError(f"Reading time {format_ts(ts)} is ahead of the server clock")
+
+    return (device_id, ts, temperature, humidity, pressure, gas, aqi, co2, calibrated)
+
+
+def parse_readings(readings, device_id, received_ms):
+    """
+    Rows for the readings of a batch, and the ones rejected
+    A bad reading (e.g. stamped by a device clock that isn't set yet) is
+    skipped on its own, so it can't get the rest of its batch refused;
+    rejected is a list of {"index", "message"}. Readings without ts or
+    age_ms are only accepted one per request: stamped with the receive
+    time, the readings of a batch would all share one (device_id, ts) key.
+    """
+    rows, rejected = [], []
+    for i, data in enumerate(readings):
+        try:
+            if len(readings) > 1 and data.get("ts") is None and data.get("age_ms") is None:
+                raise ValueError("Reading has no ts or age_ms, which every reading "
+                                 "of a multi-reading batch needs")
+            rows.append(parse_reading(data, device_id, received_ms))
+        except (ValueError, TypeError, AttributeError) as e:
+            rejected.append({"index": i, "message": str(e)})
+    return rows, rejected
+
+
+def decode_body(data, encoding):
+    """Request body bytes with a gzip or deflate Content-Encoding undone"""
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return data
+    if encoding not in ("gzip", "deflate"):
+        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+    # wbits=47 accepts both gzip and zlib (HTTP deflate) headers
+    inflater = zlib.decompressobj(47)
+    body = inflater.decompress(data, MAX_BATCH_BYTES)
+    if inflater.unconsumed_tail:
+        raise ValueError("Request body too large")
+    return body
+
+
+def parse_batch(body, mimetype):
+    """
+    Parse a batch upload body into (list of reading dicts, upload dict)
+    Accepts a JSON array, NDJSON (one JSON object per line) or an upload
+    object from a device buffer:
+        {"device_id": ..., "boot": ..., "seq": ...,
+         "readings": [{...}, ...]}                       or, compact,
+         "fields": ["age_ms", "temperature", ...], "rows": [[...], ...]}
+    The upload dict is empty for the first two forms.
+    """
+    if mimetype in ("application/x-ndjson", "application/ndjson"):
+        return [json.loads(line) for line in body.splitlines() if line.strip()], {}
+
+    batch = json.loads(body)
+    if isinstance(batch, list):
+        return batch, {}
+    if not isinstance(batch, dict) or ("readings" not in batch and "rows" not in batch):
+        raise ValueError("Batch body must be a JSON array of readings or an upload object")
+    if "rows" in batch:
+        # Field names once, then one array of values per reading
+        fields = batch["fields"]
+        readings = [dict(zip(fields, row)) for row in batch["rows"]]
+    else:
+        readings = batch["readings"]
+    return readings, batch
+
+
+def upload_sequence(upload, device_id):
+    """(device, boot, seq) of a numbered upload, or None"""
+    if upload.get("seq") is None:
+        return None
+    return (str(upload.get("device_id") or device_id), str(upload.get("boot", "")),
+            int(upload["seq"]))
+
+
+def record_upload(sequence):
+    """Persist the (device, boot, seq) of a committed upload"""
+    with db_connection(DB_FILE) as conn:
+        upload_sequences.committed(conn, *sequence)
+
+
+def save_rows(rows):
+    """
+    Hand rows to the group-commit writer
+    Waits for the commit unless the ack mode is 'enqueue'
+    Returns the number of rows stored (readings already in the database
+    are skipped), or None if they were only queued
+    """
+    ack = request.args.get("ack", ACK_MODE)
+    if ack not in ("enqueue", "commit"):
+        raise ValueError(f"Unknown ack mode: {ack}")
+
+    future = writer.submit(rows)
+    if ack == "enqueue":
+        return None
+
+    return future.result(timeout=ACK_TIMEOUT)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """Count every request and time it under its route pattern"""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS_TOTAL.inc(route=route, method=request.method, status=response.status_code)
+    if "started" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.started, route=route)
+    return response
 
 
 @app.route("/sensor_data", methods=["POST"])
@@ -58,37 +444,73 @@ def receive_data():
     try:
         # Get JSON data from request
         data = request.get_json()
+        row = parse_reading(data, request_device())
+        stored = save_rows([row])
 
-        # Extract and round values to 1 decimal place
-        temperature = round(data.get("temperature", 0), 1)
-        humidity = round(data.get("humidity", 0), 1)
-        pressure = round(data.get("pressure", 0), 1)
-        gas = round(data.get("gas_resistance", 0), 1)
-        aqi = round(data.get("air_quality_score", 0), 1)
-        co2 = round(data.get("estimated_co2", 0), 1)
-        calibrated = "true" if data.get("calibrated", False) else "false"
-
-        # Timestamp without seconds (matching CSV format)
-        time = datetime.now().strftime("%Y-%m-%d %H:%M")
-
-        # Insert into database
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO sensor_readings 
-            (time, temperature, humidity, pressure, gas, aqi, co2, calibrated)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (time, temperature, humidity, pressure, gas, aqi, co2, calibrated))
-        
-        conn.commit()
-        conn.close()
+        device_id, _, temperature, humidity, pressure, gas, aqi, co2, calibrated = row
+        reading_log.log("reading", device=device_id, temperature=temperature, humidity=humidity,
+                        pressure=pressure, gas=gas, aqi=aqi, co2=co2, calibrated=calibrated,
+                        committed=stored is not None)
+
+        if stored == 0:
+            return jsonify({"status": "duplicate", "message": "Reading already saved"}), 200
+        if stored is not None:
+            return jsonify({"status": "success", "message": "Data saved to database"}), 200
+        return jsonify({"status": "accepted", "message": "Data queued for saving"}), 202
+
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 400
 
-        print(f"Data saved: Temp={temperature:.1f}°C, Humidity={humidity:.1f}%, "
-              f"Pressure={pressure:.1f}hPa, Gas={gas:.1f}KOhm, "
-              f"AQI={aqi:.1f}, CO2={co2:.1f}ppm (cal:{calibrated})")
 
-        return jsonify({"status": "success", "message": "Data saved to database"}), 200
+@app.route("/sensor_data/batch", methods=["POST"])
+def receive_batch():
+    """
+    Receive many readings in one request
+
+    Body is a JSON array of readings, NDJSON (Content-Type: application/x-ndjson)
+    or an upload object (see parse_batch), optionally gzip/deflate compressed
+    (Content-Encoding). Every reading of a batch needs its ts or age_ms,
+    at most MAX_READING_AGE_DAYS old (bulk_import.py takes older data);
+    the others are listed in "rejected" with the reason. Optional query parameter
+    ack=enqueue|commit overrides ACK_MODE. Uploads with a seq are always answered on commit, and one
+    already saved for the device's current boot is acknowledged as a
+    duplicate without storing it again.
+    """
+    try:
+        received_ms = now_ms()
+        body = decode_body(request.get_data(), request.headers.get("Content-Encoding"))
+        readings, upload = parse_batch(body, request.mimetype)
+        device_id = str(upload.get("device_id") or request_device())
+        rows, rejected = parse_readings(readings, device_id, received_ms)
+
+        sequence = upload_sequence(upload, device_id)
+        if sequence is None:
+            stored = save_rows(rows)
+        else:
+            previous = upload_sequences.claim(*sequence)
+            if previous is None:
+                return jsonify({"status": "duplicate", "count": 0, "seq": sequence[2],
+                                "message": "Batch already saved"}), 200
+            try:
+                stored = writer.submit(rows).result(timeout=ACK_TIMEOUT)
+            except Exception:
+                upload_sequences.release(*sequence, previous)
+                raise
+            record_upload(sequence)
+
+        reading_log.log("batch", device=device_id, count=len(rows), stored=stored,
+                        rejected=len(rejected), seq=sequence[2] if sequence else None)
+
+        extra = {"seq": sequence[2]} if sequence else {}
+        if rejected:
+            extra["rejected"] = rejected
+        if stored is not None:
+            return jsonify({"status": "success", "count": len(rows), "stored": stored,
+                            "duplicates": len(rows) - stored, **extra,
+                            "message": "Data saved to database"}), 200
+        return jsonify({"status": "accepted", "count": len(rows), **extra,
+                        "message": "Data queued for saving"}), 202
 
     except Exception as e:
         print(f"Error: {e}")
@@ -99,16 +521,13 @@ def receive_data():
 def status():
     """Status check endpoint with record count"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM sensor_readings")
-        count = cursor.fetchone()[0]
-        conn.close()
-        
         return jsonify({
             "status": "running",
             "message": "Air Quality Server (SQLite) is active",
-            "records": count
+            "records": record_count(),
+            "cache": cache.stats(),
+            "query_cache": query_cache.stats(),
+            "subscribers": broadcaster.subscribers()
         }), 200
     except Exception as e:
         return jsonify({
@@ -120,23 +539,15 @@ def status():
 
 @app.route("/latest", methods=["GET"])
 def latest():
-    """Get the most recent reading"""
+    """
+    Get the most recent reading
+    Optional ?device= returns the most recent reading of that device
+    """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT * FROM sensor_readings 
-            ORDER BY time DESC 
-            LIMIT 1
-        """)
-        
-        row = cursor.fetchone()
-        conn.close()
+        row = latest_reading(request.args.get("device"))
         
         if row:
-            return jsonify(dict(row)), 200
+            return jsonify(row), 200
         else:
             return jsonify({"message": "No data available"}), 404
             
@@ -144,6 +555,291 @@ def latest():
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/recent", methods=["GET"])
+def recent():
+    """
+    Most recent readings, newest first (like the CLI's "last 60 readings")
+    
+    Query parameters:
+    - limit: number of readings (default: 60)
+    - device: only readings from this device id
+    
+    Served from the in-memory ring buffer when it holds enough readings.
+    """
+    try:
+        limit = request.args.get("limit", default=60, type=int)
+        device = request.args.get("device")
+        
+        records = cache.recent(limit, device)
+        if records is None:
+            where_sql, params = build_where({"device": device})
+            query_sql = (f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                         "ORDER BY ts DESC, id DESC LIMIT ?")
+            records = []
+            for path in shard_files(DB_FILE, device):
+                with db_connection(path) as conn:
+                    records.extend(dict(row) for row in conn.execute(query_sql, params + [limit]))
+            records.sort(key=lambda r: (r["ts"], r["id"]), reverse=True)
+            records = records[:limit]
+        
+        return jsonify({"count": len(records), "records": records}), 200
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/last24h", methods=["GET"])
+def last_24_hours():
+    """
+    Every reading from the last 24 hours in time order (optional ?device=)
+    Served from the in-memory ring buffer when it covers the whole window
+    """
+    try:
+        device = request.args.get("device")
+        since_ms = now_ms() - DAY_MS
+        
+        records = cache.since(since_ms, device)
+        if records is None:
+            records = [dict(row) for row in read_since(since_ms, device)]
+        
+        return jsonify({"count": len(records), "records": records}), 200
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def parse_stream_args(args):
+    """(device, metrics or None, interval seconds) from /stream request arguments"""
+    metrics = args.get("metrics")
+    if metrics is not None:
+        metrics = parse_list(metrics, METRICS, "metric")
+    interval = args.get("interval", default=0.0, type=float)
+    if interval < 0:
+        raise ValueError("interval must not be negative")
+    return args.get("device"), metrics, interval
+
+
+def iter_sse(subscription):
+    """
+    Server-Sent Events for a subscription: the latest reading held in memory,
+    then readings as they are committed, with keep-alive comments when idle
+    """
+    try:
+        record = cache.latest(subscription.device)
+        if record:
+            yield sse_event(subscription.shape(record))
+        while not subscription.closed:
+            records = subscription.wait(KEEPALIVE)
+            if records:
+                yield "".join(sse_event(r) for r in records)
+            elif not subscription.closed:
+                yield sse_keepalive()
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+@app.route("/stream", methods=["GET"])
+def stream():
+    """
+    Push readings as Server-Sent Events as soon as they are committed
+    
+    Query parameters:
+    - device: only readings from this device id
+    - metrics: comma separated metrics to include, e.g. temperature,co2 (default: all)
+    - interval: send at most one reading per device every N seconds, newest wins
+    
+    Readings are fanned out from memory; an idle subscriber costs no queries.
+    """
+    try:
+        device, metrics, interval = parse_stream_args(request.args)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    
+    subscription = broadcaster.subscribe(device, metrics, interval)
+    if subscription is None:
+        return jsonify({"error": "Too many subscribers, retry later"}), 503, {"Retry-After": "5"}
+    return Response(iter_sse(subscription), 200, {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+def build_reading_query(filters, limit=None):
+    """
+    build_query that reads ranges older than the raw retention window from
+    the rollup tiers instead, and leaves archived months to open_query
+    """
+    with db_connection(DB_FILE) as conn:
+        cutoffs = read_cutoffs(conn)
+    return build_tiered_query(filters, limit, cutoffs, archived_ranges(DB_FILE))
+
+
+def parse_filters(args):
+    """Read the /query range, date and device filters from request arguments"""
+    filters = {name: args.get(name, type=float) for name in RANGE_FILTERS}
+    filters["start_date"] = args.get("start_date")
+    filters["end_date"] = args.get("end_date")
+    filters["device"] = args.get("device")
+    return filters
+
+
+def parse_page(args, filters):
+    """
+    Read the keyset paging arguments of /query (page_size, cursor)
+    The cursor becomes the filters' "after" key; returns the page size, or
+    None for an unpaged query
+    """
+    cursor = args.get("cursor")
+    page_size = args.get("page_size")
+    if cursor is None and page_size is None:
+        return None
+    if cursor:
+        filters["after"] = decode_cursor(cursor)
+    try:
+        page_size = int(page_size) if page_size is not None else PAGE_SIZE
+    except ValueError:
+        raise ValueError(f"Invalid page_size: {page_size}") from None
+    return check_page_size(page_size)
+
+
+def query_page(files, query_sql, params, page_size, filters, fmt):
+    """
+    Run a paged query (built with limit page_size + 1) and format one page
+    Returns (body text, content type, extra headers); the next page's
+    cursor is sent as X-Next-Cursor and, in JSON, as next_cursor
+    """
+    with ExitStack() as stack:
+        cursor = open_query(stack, files, query_sql, params, page_size + 1, filters)
+        columns = column_names(cursor)
+        rows, next_cursor = fetch_page(cursor, page_size)
+        cursor.close()
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    if fmt == "json":
+        body = json.dumps({"count": len(rows), "records": [dict(zip(columns, row)) for row in rows],
+                           "next_cursor": next_cursor})
+        return body, "application/json", headers
+    formatter, content_type = {"csv": (iter_csv, "text/csv"),
+                               "ndjson": (iter_ndjson, "application/x-ndjson")}[fmt]
+    return "".join(formatter(RowsCursor(columns, rows))), content_type, headers
+
+
+def reading_files(filters):
+    """
+    Database files that can hold readings matching a filter dict: shards
+    outside the date range or without the device are skipped
+    """
+    return query_files(DB_FILE, filters)
+
+
+def open_query(stack, files, query_sql, params, limit=None, filters=None):
+    """
+    Run a query against every file on read-only connections, closed by stack
+    Returns one cursor, merging the files in time order if there are several
+    (read in parallel, see federated.py). With filters, matching rows from
+    archived months are merged in too.
+    """
+    cursor = open_federated(DB_FILE, files, query_sql, params, limit, filters)
+    stack.callback(cursor.close)
+    return cursor
+
+
+def stream_query(files, query_sql, params, limit, formatter, filters=None):
+    """Run a query on pooled connections and yield formatted chunks"""
+    with ExitStack() as stack:
+        cursor = open_query(stack, files, query_sql, params, limit, filters)
+        try:
+            yield from formatter(cursor)
+        finally:
+            cursor.close()
+
+
+def parse_fill(args):
+    """(method, step in ms) of a gap-filled /query series, or (None, None)"""
+    method = args.get("fill")
+    if method is None:
+        return None, None
+    if method not in FILL_METHODS:
+        raise ValueError(f"Unknown fill method: {method} (use {' or '.join(FILL_METHODS)})")
+    step = args.get("step", default=FILL_STEP, type=float)
+    if not step or step < 1:
+        raise ValueError("step must be at least 1 second")
+    return method, int(step * 1000)
+
+
+def series_devices(filters):
+    """Devices with readings in the files a filter dict touches"""
+    if filters.get("device"):
+        return [filters["device"]]
+    devices = set()
+    for path in reading_files(filters):
+        with db_connection(path) as conn:
+            # Daily rollups name every device at a fraction of the rows
+            table = "rollup_1d" if has_rollups(conn) else "sensor_readings"
+            devices.update(row[0] for row in conn.execute(f"SELECT DISTINCT device_id FROM {table}"))
+    return sorted(devices)
+
+
+def filled_series(stack, device, filters, method, step_ms):
+    """
+    One device's readings as a gap-filled series of FILL_COLUMNS rows
+    Spike and pre-calibration values flagged in reading_flags are dropped
+    before filling, so they are bridged like missing readings. Readings and
+    flags are both streamed in time order; the cursor is closed by stack.
+    """
+    filters = {**filters, "device": device}
+    files = reading_files(filters)
+    query_sql, params = build_reading_query(filters)
+    cursor = open_query(stack, files, query_sql, params, filters=filters)
+    columns = column_names(cursor)
+    where_sql, flag_params = build_where(flag_filters(filters))
+    flags = heapq.merge(*(stack.enter_context(db_connection(path)).execute(
+        f"SELECT ts, mask FROM reading_flags{where_sql} ORDER BY ts", flag_params)
+        for path in files), key=lambda flag: flag[0])
+    masks = {m: untrusted_mask(m) for m in METRICS}
+
+    def records():
+        flag = next(flags, None)
+        for rows in iter_chunks(cursor):
+            for row in rows:
+                record = dict(zip(columns, row))
+                while flag is not None and flag[0] < record["ts"]:
+                    flag = next(flags, None)
+                if flag is not None and flag[0] == record["ts"]:
+                    for m in METRICS:
+                        if flag[1] & masks[m]:
+                            record[m] = None
+                yield record
+
+    for point in fill_series(records(), METRICS, step_ms, method):
+        yield (device, point["ts"], format_ts(point["ts"]),
+               *(point[m] for m in METRICS), point["filled"])
+
+
+def stream_filled(filters, method, step_ms, limit, formatter):
+    """Gap-filled series of every matching device, merged in time order and formatted"""
+    with ExitStack() as stack:
+        series = [filled_series(stack, device, filters, method, step_ms)
+                  for device in series_devices(filters)]
+        rows = heapq.merge(*series, key=lambda row: row[1])
+        yield from formatter(RowsCursor(FILL_COLUMNS, islice(rows, limit)))
+
+
+def lookup_result(key):
+    """Cached result for a request key (or None), counted for /metrics"""
+    entry = query_cache.get(key)
+    QUERY_CACHE_LOOKUPS.inc(result="miss" if entry is None else "hit")
+    return entry
+
+
+def cached_response(entry, headers=None):
+    """Serve a cached body, or 304 Not Modified when the client already has it"""
+    if etag_matches(request.headers.get("If-None-Match"), entry.etag):
+        return Response(status=304, headers={"ETag": entry.etag})
+    return Response(entry.body, 200, {**(headers or {}), **entry.headers,
+                                      "Content-Type": entry.content_type, "ETag": entry.etag})
+
+
 @app.route("/query", methods=["GET"])
 def query():
     """
@@ -156,120 +852,257 @@ def query():
     - aqi_min, aqi_max: air quality index range
     - co2_min, co2_max: CO2 range (ppm)
     - start_date, end_date: date range (YYYY-MM-DD format)
-    - limit: max number of records (default: 1000)
-    - export_csv: if 'true', returns CSV format
+    - device: only readings from this device id
+    - limit: max number of records (default: 1000, no limit when streaming)
+    - format: json, csv or ndjson (default: json)
+    - export_csv: if 'true', returns CSV format (same as format=csv)
+    - stream: if 'true', streams the response in chunks
+    - page_size: return one page of this many records (max 10000) instead
+      of applying limit; the response carries the next page's cursor in
+      next_cursor (JSON) and the X-Next-Cursor header, absent on the last page
+    - cursor: next_cursor of the previous page, same filters otherwise
+    - fill: linear or previous, return an evenly spaced series per device
+      instead of the stored readings: values between readings are
+      interpolated or carried forward, spike and pre-calibration values
+      (/anomalies) are bridged the same way and points with no reading in
+      the step before them have filled=true (1 in CSV). Not combined with
+      paging
+    - step: spacing of the filled series in seconds (default: 60)
+    
+    Records are ordered by (ts, id, device_id) and pages resume after the
+    last record of the previous one with an index seek, so deep pages cost
+    the same as the first and readings arriving meanwhile are not skipped.
+    
+    CSV and NDJSON are always sent in chunks straight from the cursor.
+    Readings older than the raw retention window come from the 5-minute or
+    hourly rollup tier: one averaged row per bucket with a null id.
+    Finished results are cached with an ETag; send If-None-Match to get a
+    304 when nothing in the range has changed.
     """
     try:
         # Get query parameters
-        temp_min = request.args.get("temp_min", type=float)
-        temp_max = request.args.get("temp_max", type=float)
-        humidity_min = request.args.get("humidity_min", type=float)
-        humidity_max = request.args.get("humidity_max", type=float)
-        pressure_min = request.args.get("pressure_min", type=float)
-        pressure_max = request.args.get("pressure_max", type=float)
-        aqi_min = request.args.get("aqi_min", type=float)
-        aqi_max = request.args.get("aqi_max", type=float)
-        co2_min = request.args.get("co2_min", type=float)
-        co2_max = request.args.get("co2_max", type=float)
-        start_date = request.args.get("start_date")
-        end_date = request.args.get("end_date")
-        limit = request.args.get("limit", default=1000, type=int)
-        export_csv = request.args.get("export_csv", "false").lower() == "true"
+        filters = parse_filters(request.args)
+        stream = request.args.get("stream", "false").lower() == "true"
+        limit = request.args.get("limit", default=None if stream else 1000, type=int)
+        fmt = request.args.get("format", "json").lower()
+        if request.args.get("export_csv", "false").lower() == "true":
+            fmt = "csv"
+        if fmt not in QUERY_FORMATS:
+            raise ValueError(f"Unknown format: {fmt}")
+        page_size = parse_page(request.args, filters)
+        if page_size is not None:
+            limit = page_size + 1
+        fill, step_ms = parse_fill(request.args)
+        if fill and page_size is not None:
+            raise ValueError("fill can't be combined with page_size or cursor")
         
-        # Build SQL query
-        query_sql = "SELECT * FROM sensor_readings WHERE 1=1"
-        params = []
+        headers = {}
+        if fmt == "csv":
+            filename = f'sensor_data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+            headers['Content-Disposition'] = f'attachment; filename={filename}'
         
-        if temp_min is not None:
-            query_sql += " AND temperature >= ?"
-            params.append(temp_min)
-        if temp_max is not None:
-            query_sql += " AND temperature <= ?"
-            params.append(temp_max)
-        if humidity_min is not None:
-            query_sql += " AND humidity >= ?"
-            params.append(humidity_min)
-        if humidity_max is not None:
-            query_sql += " AND humidity <= ?"
-            params.append(humidity_max)
-        if pressure_min is not None:
-            query_sql += " AND pressure >= ?"
-            params.append(pressure_min)
-        if pressure_max is not None:
-            query_sql += " AND pressure <= ?"
-            params.append(pressure_max)
-        if aqi_min is not None:
-            query_sql += " AND aqi >= ?"
-            params.append(aqi_min)
-        if aqi_max is not None:
-            query_sql += " AND aqi <= ?"
-            params.append(aqi_max)
-        if co2_min is not None:
-            query_sql += " AND co2 >= ?"
-            params.append(co2_min)
-        if co2_max is not None:
-            query_sql += " AND co2 <= ?"
-            params.append(co2_max)
-        if start_date:
-            query_sql += " AND time >= ?"
-            params.append(f"{start_date} 00:00")
-        if end_date:
-            query_sql += " AND time <= ?"
-            params.append(f"{end_date} 23:59")
+        key = cache_key("/query", filters, fmt=fmt, stream=stream, limit=limit, page=page_size,
+                        fill=fill, step=step_ms)
+        entry = lookup_result(key)
+        if entry is not None:
+            return cached_response(entry, headers)
+        token = query_cache.token()
         
-        query_sql += " ORDER BY time ASC LIMIT ?"
-        params.append(limit)
+        if fill:
+            formatter, content_type = {"csv": (iter_csv, "text/csv"),
+                                       "ndjson": (iter_ndjson, "application/x-ndjson"),
+                                       "json": (iter_json, "application/json")}[fmt]
+            chunks = stream_filled(filters, fill, step_ms, limit, formatter)
+            return Response(query_cache.tee(key, token, filters, content_type, chunks), 200,
+                            {**headers, "Content-Type": content_type})
         
-        # Execute query
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(query_sql, params)
-        rows = cursor.fetchall()
-        conn.close()
+        # Build SQL query
+        query_sql, params = build_reading_query(filters, limit)
+        files = reading_files(filters)
         
-        if export_csv:
+        if page_size is not None:
+            # A page is small enough to build whole, then cached with its cursor
+            body, content_type, page_headers = query_page(files, query_sql, params, page_size,
+                                                          filters, fmt)
+            body = body.encode()
+            entry = query_cache.put(key, body, content_type, filters, token, page_headers)
+            if entry is not None:
+                return cached_response(entry, headers)
+            return Response(body, 200, {**headers, **page_headers, "Content-Type": content_type})
+        elif fmt == "csv":
             # Return as CSV
-            import csv
-            from io import StringIO
-            
-            output = StringIO()
-            writer = csv.writer(output)
-            
-            # Write header
-            if rows:
-                writer.writerow(rows[0].keys())
-                # Write data with formatted numbers
-                for row in rows:
-                    formatted_row = []
-                    for key in row.keys():
-                        value = row[key]
-                        # Format numeric columns with 1 decimal place
-                        if key in ['temperature', 'humidity', 'pressure', 'gas', 'aqi', 'co2']:
-                            formatted_row.append(f"{float(value):.1f}")
-                        else:
-                            formatted_row.append(value)
-                    writer.writerow(formatted_row)
-            
-            csv_content = output.getvalue()
-            output.close()
-            
-            return csv_content, 200, {
-                'Content-Type': 'text/csv',
-                'Content-Disposition': f'attachment; filename=sensor_data_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-            }
+            chunks = stream_query(files, query_sql, params, limit, iter_csv, filters)
+            return Response(query_cache.tee(key, token, filters, 'text/csv', chunks), 200, {
+                'Content-Type': 'text/csv', **headers
+            })
+        elif fmt == "ndjson":
+            chunks = stream_query(files, query_sql, params, limit, iter_ndjson, filters)
+            return Response(query_cache.tee(key, token, filters, 'application/x-ndjson', chunks),
+                            200, {'Content-Type': 'application/x-ndjson'})
+        elif stream:
+            chunks = stream_query(files, query_sql, params, limit, iter_json, filters)
+            return Response(query_cache.tee(key, token, filters, 'application/json', chunks),
+                            200, {'Content-Type': 'application/json'})
         else:
             # Return as JSON
+            with ExitStack() as stack:
+                rows = open_query(stack, files, query_sql, params, limit, filters).fetchall()
             result = [dict(row) for row in rows]
-            return jsonify({
+            response = jsonify({
                 "count": len(result),
                 "records": result
-            }), 200
+            })
+            entry = query_cache.put(key, response.get_data(), "application/json", filters, token)
+            if entry is not None:
+                return cached_response(entry)
+            return response, 200
             
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/aggregate", methods=["GET"])
+def aggregate():
+    """
+    Aggregate readings into time buckets or downsample them for charts
+    
+    Query parameters:
+    - bucket: 5m, 1h or 1d (default: 1h)
+    - metrics: comma separated, e.g. temperature,co2 (default: all)
+    - fn: comma separated avg, min, max, sum, count or pNN (default: avg)
+    - mode: 'lttb' returns at most `points` raw readings per metric instead
+    - points: max points per series in lttb mode (default: 500)
+    - same range, date and device filters as /query
+    
+    With SHARD_BY = "device" a device filter is required; month shards
+    never share a bucket, so their results are simply concatenated.
+    Results are cached with an ETag like /query.
+    """
+    try:
+        filters = parse_filters(request.args)
+        metrics = parse_list(request.args.get("metrics", ",".join(METRICS)), METRICS, "metric")
+        mode = request.args.get("mode", "bucket").lower()
+        files = reading_files(filters)
+        if len(files) > 1 and sensor_db.SHARD_BY == "device":
+            raise ValueError("device is required when storage is sharded by device")
+        
+        key = cache_key("/aggregate", filters, metrics=tuple(metrics), mode=mode,
+                        points=request.args.get("points", default=DEFAULT_POINTS, type=int),
+                        bucket=request.args.get("bucket", "1h"), fn=request.args.get("fn", "avg"))
+        entry = lookup_result(key)
+        if entry is not None:
+            return cached_response(entry)
+        token = query_cache.token()
+        
+        if mode == "lttb":
+            points = request.args.get("points", default=DEFAULT_POINTS, type=int)
+            if points < 3:
+                raise ValueError("points must be at least 3")
+            series = {m: [] for m in metrics}
+            for part in map_files(files, downsample, filters, metrics,
+                                  max(3, points // max(1, len(files)))):
+                for m in metrics:
+                    series[m].extend(part[m])
+            response = jsonify({"mode": "lttb", "points": points, "series": series})
+        elif mode != "bucket":
+            raise ValueError(f"Unknown mode: {mode}")
+        else:
+            bucket = request.args.get("bucket", "1h")
+            fns = parse_functions(request.args.get("fn", "avg"))
+            records = []
+            for part in map_files(files, aggregate_buckets, filters, bucket, metrics, fns):
+                records.extend(part)
+            response = jsonify({
+                "bucket": bucket,
+                "count": len(records),
+                "records": records
+            })
+        
+        entry = query_cache.put(key, response.get_data(), "application/json", filters, token)
+        if entry is not None:
+            return cached_response(entry)
+        return response, 200
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/alerts", methods=["GET"])
+def alerts():
+    """Alerts currently firing (rules are ALERT_RULES in alerts.py)"""
+    active = alert_engine.active()
+    return jsonify({"count": len(active), "alerts": active,
+                    "dropped_readings": alert_engine.dropped,
+                    "late_readings": alert_engine.skipped}), 200
+
+
+@app.route("/anomalies", methods=["GET"])
+def anomalies():
+    """
+    Flagged readings, newest first (flags are set by anomalies.py)
+    
+    Query parameters:
+    - device: only readings from this device id
+    - start_date, end_date: date range (YYYY-MM-DD format)
+    - limit: max number of flagged readings (default: 100)
+    """
+    try:
+        filters = {"device": request.args.get("device"),
+                   "start_date": request.args.get("start_date"),
+                   "end_date": request.args.get("end_date")}
+        limit = request.args.get("limit", default=100, type=int)
+        start_ms, end_ms = filter_range_ms(filters)
+        flags = []
+        for path in shard_files(DB_FILE, filters["device"], start_ms, end_ms):
+            with db_connection(path) as conn:
+                flags.extend(read_flags(conn, filters, limit))
+        flags.sort(key=lambda flag: flag["ts"], reverse=True)
+        flags = flags[:limit]
+        return jsonify({"count": len(flags), "anomalies": flags,
+                        "flagged_since_start": anomaly_detector.flagged}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text-format metrics"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug/profiler", methods=["GET", "POST"])
+def debug_profiler():
+    """
+    Sampling profiler and reading log switches
+    
+    GET returns the sampled stacks in collapsed (flamegraph) format.
+    POST parameters:
+    - profile: start or stop the profiler (interval_ms, default 10)
+    - log_readings: true or false to switch the per-reading log
+    """
+    if request.method == "GET":
+        header = f"# running={profiler.running()} samples={profiler.samples}\n"
+        limit = request.args.get("limit", type=int)
+        return Response(header + profiler.collapsed(limit), mimetype="text/plain")
+    
+    action = request.args.get("profile")
+    if action == "start":
+        if not ALLOW_PROFILER:
+            return jsonify({"error": "Profiler is disabled (ALLOW_PROFILER)"}), 403
+        profiler.start(request.args.get("interval_ms", type=int))
+    elif action == "stop":
+        profiler.stop()
+    elif action is not None:
+        return jsonify({"error": f"Unknown profile action: {action}"}), 400
+    
+    log_readings = request.args.get("log_readings")
+    if log_readings is not None:
+        reading_log.enabled = log_readings.lower() == "true"
+    
+    return jsonify({"profiling": profiler.running(), "samples": profiler.samples,
+                    "log_readings": reading_log.enabled}), 200
+
+
 if __name__ == "__main__":
     print("=" * 50)
     print("Air Quality Sensor Server (SQLite)")
@@ -277,18 +1110,38 @@ if __name__ == "__main__":
     
     # Initialize database
     init_database()
+    writer.start()
+    if RUN_ALERTS:
+        alert_engine.start()
+    if RUN_RETENTION:
+        if not ARCHIVE_MONTHS:
+            print("Warning: retention deletes raw readings older than "
+                  f"{RETENTION_DAYS['raw']} days without archiving them (ARCHIVE_MONTHS)")
+        compactor.start()
     
     print(f"\nDatabase file: {DB_FILE}")
     print("Server running on http://0.0.0.0:5020")
     print("\nEndpoints:")
     print("  POST /sensor_data    - Receive sensor data")
+    print("  POST /sensor_data/batch - Receive many readings (JSON array, NDJSON or device upload)")
     print("  GET  /status         - Check server status")
-    print("  GET  /latest         - Get most recent reading")
-    print("  GET  /query          - Query with filters")
+    print("  GET  /latest         - Get most recent reading (?device= for one device)")
+    print("  GET  /recent         - Most recent readings (?limit=60)")
+    print("  GET  /last24h        - Readings from the last 24 hours")
+    print("  GET  /stream         - Live readings as Server-Sent Events (?device=&metrics=&interval=)")
+    print("  GET  /query          - Query with filters (format=json|csv|ndjson, stream=true,\n"
+          "                         fill=linear|previous&step=60 for an evenly spaced series)")
+    print("  GET  /aggregate      - Time-bucket aggregates (bucket=5m|1h|1d, fn=avg,min,max,p95)")
+    print("  GET  /alerts         - Alerts currently firing")
+    print("  GET  /anomalies      - Flagged readings (spikes, stuck sensors, pre-calibration, gaps)")
+    print("  GET  /metrics        - Prometheus metrics")
+    print("  POST /debug/profiler - ?profile=start|stop, ?log_readings=true|false (GET for stacks)")
     print("\nExample query:")
     print("  http://192.168.8.100:5020/query?temp_min=32&temp_max=35&humidity_min=50&humidity_max=80&export_csv=true")
     print("\nPress Ctrl+C to stop")
     print("=" * 50)
     
-    # Start server
+    # Start server. HTTP/1.1 keeps connections open, so devices uploading
+    # their buffers reuse one connection instead of reconnecting per POST
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host="0.0.0.0", port=5020, debug=False)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Federated reads over every file that holds readings
+With sensor_db.SHARD_BY set, readings live in one file per month or per
+device, and archive.py moves closed months into archive files. A query
+first drops the files whose time span or devices can't match its filters
+(read from each file's ts index and daily rollups, cached until the file
+changes), then runs on read-only connections in a thread pool, one
+fetchmany chunk per task, while the chunks are merged in (ts, id,
+device_id) order as they arrive. SQLite releases the GIL while it steps
+a statement, so files are scanned on all cores; a process pool would
+have to pickle every row back. A query that touches a single file skips
+the pool and reads it directly.
+
+Usage:
+    python federated.py plan [db_file] [--device D] [--start-date YYYY-MM-DD]
+                             [--end-date YYYY-MM-DD]      files a query would read
+    python federated.py scan [db_file] [--device D] [--start-date ...] [--end-date ...]
+                             [--workers N]                read everything, report rows/s
+"""
+
+import argparse
+import heapq
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from itertools import islice
+
+from archive import archive_cursors
+from instrumentation import SQLITE_EXECUTE_SECONDS
+from rollups import has_rollups
+from sensor_db import (DB_FILE, READING_COLUMN_NAMES, db_connection, filter_range_ms, format_ts,
+                       order_key, shard_files, to_epoch_ms)
+
+# Threads reading files in parallel (shared by every query)
+WORKERS = os.cpu_count() or 4
+
+# Rows fetched per task; each file keeps at most two chunks in memory
+CHUNK_ROWS = 2000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# path -> (file stamp, span), see file_span
+_spans = {}
+_spans_lock = threading.Lock()
+
+
+def get_pool():
+    """The shared reader thread pool, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(WORKERS, thread_name_prefix="federated-reader")
+        return _pool
+
+
+def _stamp(path):
+    """Changes whenever the file or its write-ahead log is written"""
+    stamp = []
+    for name in (path, path + "-wal"):
+        try:
+            st = os.stat(name)
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append((st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+
+def file_span(path):
+    """
+    (start_ms, end_ms, devices) a database file holds readings for, or None if empty
+    Daily rollups outlive the raw rows retention deletes, so their buckets
+    widen the span. Cached until the file or its WAL changes.
+    """
+    stamp = _stamp(path)
+    with _spans_lock:
+        cached = _spans.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with db_connection(path, readonly=True) as conn:
+        # Separate subqueries, so each reads one end of the ts index
+        low, high = conn.execute("SELECT (SELECT MIN(ts) FROM sensor_readings), "
+                                 "(SELECT MAX(ts) FROM sensor_readings)").fetchone()
+        if has_rollups(conn):
+            first, last = conn.execute("SELECT MIN(bucket), MAX(bucket) FROM rollup_1d").fetchone()
+            first = to_epoch_ms(datetime.strptime(first, "%Y-%m-%d %H:%M"))
+            last = to_epoch_ms(datetime.strptime(last, "%Y-%m-%d %H:%M") + timedelta(days=1))
+            low = first if low is None else min(low, first)
+            high = last if high is None else max(high, last)
+            devices = {row[0] for row in conn.execute("SELECT DISTINCT device_id FROM rollup_1d")}
+        else:
+            devices = {row[0] for row in conn.execute(
+                "SELECT DISTINCT device_id FROM sensor_readings")}
+    span = None if low is None else (low, high, frozenset(devices))
+    with _spans_lock:
+        _spans[path] = (stamp, span)
+    return span
+
+
+def prune_files(paths, filters):
+    """The files among paths whose span and devices can match a filter dict"""
+    start_ms, end_ms = filter_range_ms(filters)
+    device = filters.get("device")
+    kept = []
+    for path in paths:
+        span = file_span(path)
+        if span is None:
+            continue
+        low, high, devices = span
+        if start_ms is not None and high < start_ms:
+            continue
+        if end_ms is not None and low >= end_ms:
+            continue
+        if device and device not in devices:
+            continue
+        kept.append(path)
+    return kept
+
+
+def query_files(db_file, filters):
+    """Database files a query with these filters has to read"""
+    start_ms, end_ms = filter_range_ms(filters)
+    return prune_files(shard_files(db_file, filters.get("device"), start_ms, end_ms), filters)
+
+
+class _Source:
+    """
+    One file's query, read a chunk per pool task
+    The next chunk is fetched while the merge consumes the current one.
+    Tasks never wait on each other, so any number of files share the pool.
+    """
+
+    def __init__(self, pool, open_cursor):
+        self._pool = pool
+        self._open = open_cursor
+        self._cursor = None
+        self._close = None
+        self._future = pool.submit(self._fetch)
+
+    def _fetch(self):
+        if self._cursor is None:
+            self._cursor, self._close = self._open()
+        return self._cursor.fetchmany(CHUNK_ROWS)
+
+    def __iter__(self):
+        while True:
+            rows = self._future.result()
+            if len(rows) < CHUNK_ROWS:
+                self._future = None
+                yield from rows
+                return
+            self._future = self._pool.submit(self._fetch)
+            yield from rows
+
+    def close(self):
+        if self._future is not None:
+            # A fetch still running owns the cursor until it returns
+            try:
+                self._future.result()
+            except Exception:
+                pass
+            self._future = None
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
+def _execute(path, query_sql, params):
+    """(cursor, close) for a query on a pooled read-only connection; close returns it"""
+    stack = ExitStack()
+    with stack:
+        conn = stack.enter_context(db_connection(path, readonly=True))
+        with SQLITE_EXECUTE_SECONDS.time(statement="query"):
+            cursor = conn.execute(query_sql, params)
+        stack.callback(cursor.close)
+        return cursor, stack.pop_all().close
+
+
+def _sqlite_source(path, query_sql, params):
+    return lambda: _execute(path, query_sql, params)
+
+
+def _archive_source(cursor):
+    return lambda: (cursor, cursor.close)
+
+
+class FederatedCursor:
+    """
+    Rows of one query run over several files in parallel, merged in
+    order_key order, behind the fetchmany/fetchall/close API the export
+    writers use (like sensor_db.MergedCursor)
+    """
+
+    def __init__(self, openers, limit=None, pool=None):
+        self.description = [(name,) for name in READING_COLUMN_NAMES]
+        pool = pool or get_pool()
+        self._sources = [_Source(pool, open_cursor) for open_cursor in openers]
+        self._rows = islice(heapq.merge(*self._sources, key=order_key), limit)
+
+    def __iter__(self):
+        return self._rows
+
+    def fetchmany(self, size):
+        return list(islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        for source in self._sources:
+            source.close()
+
+
+class _DirectCursor:
+    """SQLite cursor that hands its connection back to the pool when closed"""
+
+    def __init__(self, cursor, close):
+        self._cursor = cursor
+        self._close = close
+        self.description = cursor.description
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
+def open_federated(db_file, files, query_sql, params, limit=None, filters=None, pool=None):
+    """
+    Run a query over files (see query_files) and, with filters, the
+    archived months they touch; returns one cursor in time order
+    A single database file is read directly on a pooled read-only connection.
+    """
+    archives = archive_cursors(db_file, filters, limit) if filters is not None else []
+    if len(files) == 1 and not archives:
+        return _DirectCursor(*_execute(files[0], query_sql, params))
+    openers = [_sqlite_source(path, query_sql, params) for path in files]
+    openers += [_archive_source(cursor) for cursor in archives]
+    return FederatedCursor(openers, limit, pool)
+
+
+def map_files(files, fn, *args):
+    """fn(conn, *args) for every file on read-only connections, in parallel; results in file order"""
+    def run(path):
+        with db_connection(path, readonly=True) as conn:
+            return fn(conn, *args)
+    if len(files) == 1:
+        return [run(files[0])]
+    return list(get_pool().map(run, files))
+
+
+def count_federated(files, query_sql, params):
+    """Number of rows a query returns over every file"""
+    return sum(map_files(files, lambda conn: conn.execute(
+        f"SELECT COUNT(*) FROM ({query_sql})", params).fetchone()[0]))
+
+
+def main():
+    from retention import build_tiered_query
+    from rollups import read_cutoffs
+    from archive import archived_ranges
+
+    parser = argparse.ArgumentParser(description="Federated reads over sharded database files")
+    parser.add_argument("command", choices=["plan", "scan"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--device")
+    parser.add_argument("--start-date")
+    parser.add_argument("--end-date")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    filters = {"device": args.device, "start_date": args.start_date, "end_date": args.end_date}
+    started = time.monotonic()
+    files = query_files(args.db_file, filters)
+    if args.command == "plan":
+        for path in files:
+            low, high, devices = file_span(path)
+            print(f"{path}: {format_ts(low)} .. {format_ts(high)}, {len(devices)} devices")
+        for cursor in archive_cursors(args.db_file, filters):
+            print(f"{cursor._archive.path}: archived month")
+            cursor.close()
+        print(f"Planned in {(time.monotonic() - started) * 1000:.1f} ms")
+        return 0
+
+    with db_connection(args.db_file) as conn:
+        cutoffs = read_cutoffs(conn)
+    query_sql, params = build_tiered_query(filters, None, cutoffs, archived_ranges(args.db_file))
+    with ThreadPoolExecutor(args.workers) as pool:
+        cursor = open_federated(args.db_file, files, query_sql, params, filters=filters, pool=pool)
+        rows = 0
+        try:
+            while True:
+                chunk = cursor.fetchmany(CHUNK_ROWS)
+                if not chunk:
+                    break
+                rows += len(chunk)
+        finally:
+            cursor.close()
+    elapsed = time.monotonic() - started
+    print(f"{rows} rows from {len(files)} files in {elapsed:.2f}s "
+          f"({rows / elapsed if elapsed else 0:.0f} rows/s, {args.workers} workers)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Index advisor for sensor_readings
+Runs the filter combinations /query and the CLI commonly see through
+EXPLAIN QUERY PLAN and the clock, shows which index each one uses, flags
+sorts and full scans, and measures what every index costs at ingest. The
+index set in sensor_db.READING_INDEXES was chosen from these reports.
+
+Usage:
+    python index_advisor.py plans [db_file] [--repeat N]     plan and time every case
+    python index_advisor.py ingest-cost [db_file]             insert time added per index
+    python index_advisor.py apply [db_file]                   create READING_INDEXES, drop
+                                                              OBSOLETE_INDEXES, refresh stats
+"""
+
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+from ingest_writer import INSERT_SQL
+from sensor_db import (CREATE_READINGS_SQL, DB_FILE, build_query, build_where, connect,
+                       init_schema)
+
+# Row limit used for the listing cases (the /query default)
+QUERY_LIMIT = 1000
+
+# Readings copied into memory to measure index maintenance at ingest
+INGEST_SAMPLE = 20000
+
+# Inserts timed per index set; the fastest run is kept
+INGEST_RUNS = 5
+
+_INDEX_RE = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+
+def filter_cases(conn):
+    """
+    Common filter dicts, with dates relative to the newest reading so the
+    cases select comparable amounts of data on any database
+    """
+    newest = conn.execute("SELECT MAX(ts) FROM sensor_readings").fetchone()[0]
+    last = datetime.fromtimestamp(newest / 1000) if newest else datetime.now()
+    device = conn.execute("SELECT device_id FROM sensor_readings "
+                          "ORDER BY ts DESC LIMIT 1").fetchone()
+
+    def days_ago(days):
+        return (last - timedelta(days=days)).strftime("%Y-%m-%d")
+
+    cases = {
+        "last day": {"start_date": days_ago(1)},
+        "last month": {"start_date": days_ago(30), "end_date": days_ago(0)},
+        "temperature only": {"temp_min": 25},
+        "temperature, last month": {"temp_min": 25, "start_date": days_ago(30)},
+        "humidity band": {"humidity_min": 40, "humidity_max": 42},
+        "co2 over 1000": {"co2_min": 1000},
+        "co2 over 1000, last month": {"co2_min": 1000, "start_date": days_ago(30)},
+        "poor air quality": {"aqi_max": 50},
+        "several metrics, 90 days": {"temp_min": 22, "humidity_max": 45, "co2_max": 800,
+                                     "start_date": days_ago(90)},
+    }
+    if device:
+        cases["one device, last month"] = {"device": device[0], "start_date": days_ago(30)}
+    return cases
+
+
+def explain(conn, sql, params):
+    """EXPLAIN QUERY PLAN detail lines"""
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def plan_issues(plan):
+    """Problems worth an index: sorting in a temp b-tree, reading the whole table"""
+    issues = []
+    for line in plan:
+        if "TEMP B-TREE" in line:
+            issues.append("sort")
+        if line.startswith("SCAN ") and "INDEX" not in line:
+            issues.append("full scan")
+    return issues
+
+
+def time_query(conn, sql, params, repeat):
+    """Best wall time over `repeat` runs in milliseconds, and the row count"""
+    best, rows = None, 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = len(conn.execute(sql, params).fetchall())
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2), rows
+
+
+def case_queries(conn):
+    """(case, kind, sql, params) for every listing and count of the filter cases"""
+    queries = []
+    for name, filters in filter_cases(conn).items():
+        sql, params = build_query(filters, QUERY_LIMIT)
+        queries.append((name, "rows", sql, params))
+        where_sql, params = build_where(filters)
+        queries.append((name, "count", f"SELECT COUNT(*) FROM sensor_readings{where_sql}", params))
+    return queries
+
+
+def report_plans(conn, repeat=3):
+    """Plan, chosen index, issues and timing for every case"""
+    results = []
+    for name, kind, sql, params in case_queries(conn):
+        plan = explain(conn, sql, params)
+        ms, rows = time_query(conn, sql, params, repeat)
+        indexes = [m.group(1) for line in plan for m in _INDEX_RE.finditer(line)]
+        results.append({
+            "case": name,
+            "kind": kind,
+            "index": indexes[0] if indexes else None,
+            "issues": plan_issues(plan),
+            "ms": ms,
+            "rows": rows,
+            "plan": plan,
+        })
+    return results
+
+
+def reading_indexes(conn):
+    """{name: CREATE INDEX sql} of the indexes on sensor_readings"""
+    return dict(conn.execute("SELECT name, sql FROM sqlite_master "
+                             "WHERE type = 'index' AND tbl_name = 'sensor_readings' "
+                             "AND sql IS NOT NULL ORDER BY name"))
+
+
+def unused_indexes(conn, results):
+    """Indexes on sensor_readings that no case chose"""
+    used = {r["index"] for r in results}
+    return [name for name in reading_indexes(conn) if name not in used]
+
+
+def ingest_cost(conn, sample=INGEST_SAMPLE):
+    """
+    Insert time added by each index, in ms per 1000 readings
+    The newest `sample` readings are inserted into an in-memory copy of the
+    table with no index, with each index on its own and with all of them
+    Returns {"baseline": ms, index name: extra ms, ..., "all": extra ms}
+    """
+    rows = conn.execute("SELECT device_id, ts, temperature, humidity, pressure, gas, aqi, co2, "
+                        "calibrated FROM sensor_readings ORDER BY ts DESC LIMIT ?",
+                        (sample,)).fetchall()
+    rows = [tuple(row) for row in reversed(rows)]
+    if not rows:
+        return {}
+
+    def insert_ms(*index_sql):
+        mem = sqlite3.connect(":memory:")
+        mem.execute(CREATE_READINGS_SQL.format(table="sensor_readings"))
+        for sql in index_sql:
+            mem.execute(sql)
+        started = time.perf_counter()
+        with mem:
+            mem.executemany(INSERT_SQL, rows)
+        elapsed = time.perf_counter() - started
+        mem.close()
+        return elapsed * 1000 * 1000 / len(rows)
+
+    def best(*index_sql):
+        return min(insert_ms(*index_sql) for _ in range(INGEST_RUNS))
+
+    indexes = reading_indexes(conn)
+    baseline = best()
+    result = {"baseline": round(baseline, 2)}
+    for name, sql in indexes.items():
+        result[name] = round(best(sql) - baseline, 2)
+    result["all"] = round(best(*indexes.values()) - baseline, 2)
+    return result
+
+
+def apply(conn):
+    """Bring the indexes in line with sensor_db and refresh planner statistics"""
+    before = set(reading_indexes(conn))
+    init_schema(conn)
+    conn.execute("PRAGMA optimize")
+    after = set(reading_indexes(conn))
+    return {"created": sorted(after - before), "dropped": sorted(before - after)}
+
+
+def print_plans(results, unused):
+    for r in results:
+        issues = f"  [{', '.join(r['issues'])}]" if r["issues"] else ""
+        print(f"{r['case']:28} {r['kind']:5} {r['ms']:9.2f} ms {r['rows']:>8} rows  "
+              f"{r['index'] or '-'}{issues}")
+        for line in r["plan"]:
+            print(f"{'':36}{line}")
+    if unused:
+        print(f"\nNot used by any case: {', '.join(unused)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check query plans and index costs")
+    parser.add_argument("command", choices=["plans", "ingest-cost", "apply"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per case (plans)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    conn = connect(args.db_file)
+    try:
+        if args.command == "plans":
+            results = report_plans(conn, args.repeat)
+            report = {"cases": results, "unused_indexes": unused_indexes(conn, results)}
+        elif args.command == "ingest-cost":
+            report = ingest_cost(conn)
+        else:
+            report = apply(conn)
+    finally:
+        conn.close()
+
+    if args.json or args.command != "plans":
+        print(json.dumps(report, indent=2))
+    else:
+        print_plans(report["cases"], report["unused_indexes"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+Group-commit writer for sensor readings
+Buffers inserts from every request thread and writes them in one transaction
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from instrumentation import ROWS_PER_COMMIT, SQLITE_COMMIT_SECONDS, SQLITE_EXECUTE_SECONDS
+from rollups import init_rollup_tables, last_row_id, update_rollups
+from sensor_db import READING_COLUMNS, connect, init_schema, shard_path
+
+# Readings already stored under the same (device_id, ts) are skipped
+INSERT_SQL = """
+    INSERT INTO sensor_readings
+    (device_id, ts, temperature, humidity, pressure, gas, aqi, co2, calibrated)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT DO NOTHING
+"""
+
+# (device_id, ts) keys of recently stored readings remembered by the writer
+RECENT_KEYS = 65536
+
+# Queue marker telling the writer thread to flush and exit
+_STOP = object()
+
+
+class RecentKeys:
+    """
+    Bounded set of recently stored (device_id, ts) keys, oldest evicted first
+    Resent readings are nearly always recent, so most duplicates are
+    dropped here without an index lookup; the unique index catches the rest.
+    Only used from the writer thread.
+    """
+
+    def __init__(self, size=RECENT_KEYS):
+        self.size = size
+        self.hits = 0
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key):
+        self._keys[key] = None
+        if len(self._keys) > self.size:
+            self._keys.popitem(last=False)
+
+
+class GroupCommitWriter:
+    """
+    Background thread that collects rows submitted by request handlers and
+    flushes them with executemany every max_rows rows or max_delay_ms ms,
+    whichever comes first.
+
+    submit() returns a Future that resolves once the rows are committed, so
+    callers can choose to acknowledge on enqueue or on durable commit.
+    Readings whose (device_id, ts) is already stored are skipped; the
+    Future's result is the number of rows actually stored.
+    Rows start with (device_id, ts) and are routed to their shard file
+    when sensor_db.SHARD_BY is set. Functions in `pre_commit` are called
+    as hook(conn, new_rows) inside each flush's transaction, before the
+    rollups are updated, so rows they write commit together with the
+    readings; a hook that raises rolls back that file's flush and its
+    submissions' Futures get the exception. Functions in `listeners`
+    receive the committed rows (with their ids) after every flush.
+    """
+
+    def __init__(self, db_file, max_rows=500, max_delay_ms=200):
+        self.db_file = db_file
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._conns = {}
+        self.recent = RecentKeys()
+        self.duplicates = 0
+        # Called from the writer thread with the connection and new rows of
+        # each flush, inside its transaction
+        self.pre_commit = []
+        # Called from the writer thread with the committed rows of each flush
+        self.listeners = []
+
+    def start(self):
+        """Start the writer thread (safe to call more than once)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="group-commit-writer",
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Flush everything already queued, then stop the writer thread"""
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def submit(self, rows):
+        """
+        Queue rows for insertion
+        Returns a Future whose result is the number of rows stored
+        """
+        self.start()
+        future = Future()
+        self._queue.put((list(rows), future))
+        return future
+
+    def pending(self):
+        """Approximate number of submissions waiting to be flushed"""
+        return self._queue.qsize()
+
+    def _connection(self, path):
+        """Writer-thread connection for a database file, creating shard files on first use"""
+        conn = self._conns.get(path)
+        if conn is None:
+            conn = self._conns[path] = connect(path)
+            if path != self.db_file:
+                init_schema(conn)
+                init_rollup_tables(conn)
+        return conn
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+
+                # Keep collecting until the batch is full or the window closes
+                batch = [item]
+                count = len(item[0])
+                deadline = time.monotonic() + self.max_delay
+                while count < self.max_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    count += len(item[0])
+
+                try:
+                    self._flush(batch)
+                except Exception as e:
+                    # One bad flush must not stop ingest: fail its submissions
+                    # and keep serving the queue
+                    print(f"Error: flush of {len(batch)} submissions failed: {e}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+
+    def _flush(self, batch):
+        # Futures can't be cancelled once running; the rows of a submission
+        # whose caller already gave up are still written
+        live = [future.set_running_or_notify_cancel() for _, future in batch]
+
+        # Group each submission's rows by destination file (a single group
+        # unless sharding), dropping readings stored recently or repeated
+        # within this flush
+        groups = {}
+        seen = {}
+        # Submissions whose rows were dropped as copies of a row written to
+        # a file: they fail with it
+        owners = {}
+        for i, (rows, _) in enumerate(batch):
+            for row in rows:
+                key = (row[0], row[1])
+                if key in self.recent:
+                    self.recent.hits += 1
+                    continue
+                if key in seen:
+                    self.recent.hits += 1
+                    owners.setdefault(seen[key], set()).add(i)
+                    continue
+                path = seen[key] = shard_path(self.db_file, row[0], row[1])
+                groups.setdefault(path, {}).setdefault(i, []).append(row)
+
+        stored = [0] * len(batch)
+        failed = {}
+        for path, chunks in groups.items():
+            try:
+                counts = self._write(self._connection(path), chunks)
+            except Exception as e:
+                print(f"Error: batch of {sum(len(rows) for rows in chunks.values())} rows "
+                      f"not saved to {path}: {e}")
+                for i in set(chunks) | owners.get(path, set()):
+                    failed.setdefault(i, e)
+                continue
+            for i, count in counts.items():
+                stored[i] += count
+            for rows in chunks.values():
+                for row in rows:
+                    self.recent.add((row[0], row[1]))
+
+        for i, (rows, future) in enumerate(batch):
+            if not live[i]:
+                continue
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                self.duplicates += len(rows) - stored[i]
+                future.set_result(stored[i])
+
+    def _write(self, conn, chunks):
+        """
+        Insert {submission index: rows} and return {submission index: rows stored}
+        One transaction (and one fsync) for all of them, with the rollup
+        tables updated from the new rows in the same commit
+        """
+        counts = {}
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            before = last_row_id(conn)
+            with SQLITE_EXECUTE_SECONDS.time(statement="insert"):
+                for i, rows in chunks.items():
+                    counts[i] = conn.executemany(INSERT_SQL, rows).rowcount
+            if self.listeners or self.pre_commit:
+                committed = conn.execute(f"SELECT {READING_COLUMNS} FROM sensor_readings "
+                                         "WHERE id > ? ORDER BY id", (before,)).fetchall()
+            # A failing hook rolls the readings back with its own rows: committing
+            # without e.g. their anomaly flags would roll spikes up as trusted
+            for hook in self.pre_commit:
+                hook(conn, committed)
+            with SQLITE_EXECUTE_SECONDS.time(statement="rollup"):
+                update_rollups(conn, before)
+            with SQLITE_COMMIT_SECONDS.time():
+                conn.commit()
+        ROWS_PER_COMMIT.observe(sum(counts.values()))
+
+        for listener in self.listeners:
+            try:
+                listener(committed)
+            except Exception as e:
+                print(f"Error: commit listener failed: {e}")
+        return counts
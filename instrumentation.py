@@ -0,0 +1,272 @@
+"""
+Observability for the sensor server
+Prometheus text-format metrics, a sampling profiler that can be switched on
+at runtime and a rate-limited structured log for ingested readings
+"""
+
+import bisect
+import json
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+
+# Latency buckets in seconds (Prometheus histogram "le" bounds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Rows-per-commit buckets for the group-commit writer
+ROWS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, _label_text(self.labels, key), value
+
+
+class Gauge:
+    """
+    Gauge read from a callback at scrape time
+    fn returns a number, or a dict of {label value (or tuple of values): number}
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            if value is not None:
+                yield self.name, "", value
+            return
+        for key, v in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            yield self.name, _label_text(self.labels, key), v
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets and optional labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                yield (f"{self.name}_bucket",
+                       _label_text(self.labels + ("le",), key + (_number(bound),)), cumulative)
+            yield f"{self.name}_sum", _label_text(self.labels, key), total
+            yield f"{self.name}_count", _label_text(self.labels, key), count
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics shared by the server and the ingest writer
+REGISTRY = Registry()
+
+SQLITE_EXECUTE_SECONDS = REGISTRY.register(Histogram(
+    "sensor_sqlite_execute_seconds", "Time spent executing SQLite statements", ("statement",)))
+SQLITE_COMMIT_SECONDS = REGISTRY.register(Histogram(
+    "sensor_sqlite_commit_seconds", "Time spent committing ingest transactions"))
+ROWS_PER_COMMIT = REGISTRY.register(Histogram(
+    "sensor_ingest_rows_per_commit", "Readings written per ingest transaction",
+    buckets=ROWS_BUCKETS))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that snapshots every thread's stack at an interval
+    Stacks are counted in the collapsed "frame;frame;frame count" format
+    that flamegraph tools read. Cheap enough to leave running briefly on a
+    live server; it only costs anything while started.
+    """
+
+    def __init__(self, interval_ms=10):
+        self.interval = interval_ms / 1000.0
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms=None):
+        """Start sampling (clears previous samples)"""
+        if interval_ms:
+            self.interval = interval_ms / 1000.0
+        self.stop()
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running():
+            self._stop.set()
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            with self._lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    stack = [f"{fs.name} ({fs.filename.rsplit('/', 1)[-1]}:{fs.lineno})"
+                             for fs in traceback.extract_stack(frame)]
+                    self._stacks[";".join([names.get(ident, str(ident))] + stack)] += 1
+
+    def collapsed(self, limit=None):
+        """Sampled stacks in collapsed format, most frequent first"""
+        with self._lock:
+            items = self._stacks.most_common(limit)
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+
+class RateLimitedLog:
+    """
+    One-line JSON log that emits at most `per_minute` events per minute
+    Events over the limit are counted and reported with the next line
+    """
+
+    def __init__(self, per_minute=10, out=None):
+        self.per_minute = per_minute
+        self.out = out
+        self.enabled = True
+        self._window = 0
+        self._sent = 0
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def log(self, event, **fields):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            window = int(now // 60)
+            if window != self._window:
+                self._window = window
+                self._sent = 0
+            if self._sent >= self.per_minute:
+                self._suppressed += 1
+                return
+            self._sent += 1
+            suppressed, self._suppressed = self._suppressed, 0
+
+        record = {"time": round(now, 3), "event": event, **fields}
+        if suppressed:
+            record["suppressed"] = suppressed
+        print(json.dumps(record), file=self.out or sys.stdout, flush=True)
@@ -0,0 +1,159 @@
+"""
+In-memory cache of recent readings for the hot read endpoints
+Keeps the latest reading per device, a running record count and a ring
+buffer of about 24 hours of readings per device, all updated on ingest
+"""
+
+import heapq
+import threading
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
+
+# Readings kept per device: 24 hours at one reading per minute plus headroom
+RING_SIZE = 1600
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class LiveCache:
+    """
+    Latest-reading cache, record counter and per-device ring buffers
+
+    Readings are stored as plain dicts shaped like a /query record. The
+    cache only answers a request when it is sure to hold every matching
+    reading; otherwise the caller counts a miss and falls back to SQLite.
+    """
+
+    def __init__(self, ring_size=RING_SIZE):
+        self.ring_size = ring_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._rings = {}
+        self._count = None
+        # Readings at or after this ts were loaded from disk when priming
+        self._primed_since = None
+
+    def prime(self, count, rows, since_ms):
+        """Load the record count and the readings at or after since_ms"""
+        with self._lock:
+            self._count = count
+            self._primed_since = since_ms
+        self.add(rows, count=False)
+
+    def add(self, rows, count=True):
+        """Record newly committed readings (any mapping with device_id and ts)"""
+        with self._lock:
+            for row in rows:
+                record = dict(row)
+                device = record["device_id"]
+                ring = self._rings.get(device)
+                if ring is None:
+                    ring = self._rings[device] = deque(maxlen=self.ring_size)
+                self._insert(ring, record)
+                latest = self._latest.get(device)
+                if latest is None or (record["ts"], record["id"]) >= (latest["ts"], latest["id"]):
+                    self._latest[device] = record
+            if count and self._count is not None:
+                self._count += len(rows)
+
+    @staticmethod
+    def _insert(ring, record):
+        """
+        Put a record at its (ts, id) position in a ring
+        Buffered device uploads arrive out of time order; a record older
+        than everything in a full ring is dropped, like an evicted one
+        """
+        key = (record["ts"], record["id"])
+        if not ring or key >= (ring[-1]["ts"], ring[-1]["id"]):
+            ring.append(record)
+            return
+        if len(ring) == ring.maxlen:
+            if key < (ring[0]["ts"], ring[0]["id"]):
+                return
+            ring.popleft()
+        ring.insert(bisect_left(ring, key, key=lambda r: (r["ts"], r["id"])), record)
+
+    def count(self):
+        """Total number of stored readings, or None before priming"""
+        with self._lock:
+            if self._count is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return self._count
+
+    def latest(self, device=None):
+        """Most recent reading (of one device), or None on a miss"""
+        with self._lock:
+            if device:
+                record = self._latest.get(device)
+            else:
+                record = max(self._latest.values(), default=None,
+                             key=lambda r: (r["ts"], r["id"]))
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return record
+
+    def last_seen(self):
+        """{device: ts of its latest reading} without touching the hit counters"""
+        with self._lock:
+            return {device: record["ts"] for device, record in self._latest.items()}
+
+    def _complete_since(self, device):
+        """Earliest ts from which the ring holds every reading of device"""
+        ring = self._rings.get(device)
+        if ring is not None and len(ring) == ring.maxlen:
+            return ring[0]["ts"]
+        return self._primed_since
+
+    def recent(self, limit, device=None):
+        """Newest `limit` readings (newest first), or None on a miss"""
+        with self._lock:
+            devices = [device] if device else list(self._rings)
+            rings = [self._rings.get(d, ()) for d in devices]
+            merged = heapq.merge(*(reversed(ring) for ring in rings),
+                                 key=lambda r: (r["ts"], r["id"]), reverse=True)
+            records = list(islice(merged, limit))
+            # Short of `limit` is only complete if the cache saw all of history
+            if len(records) < limit and not self._covers(devices, 0):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return records
+
+    def since(self, since_ms, device=None):
+        """Readings at or after since_ms in time order, or None on a miss"""
+        with self._lock:
+            devices = [device] if device else list(self._rings)
+            if self._primed_since is None or not self._covers(devices, since_ms):
+                self.misses += 1
+                return None
+            rings = [self._rings.get(d, ()) for d in devices]
+            records = [r for r in heapq.merge(*rings, key=lambda r: (r["ts"], r["id"]))
+                       if r["ts"] >= since_ms]
+            self.hits += 1
+            return records
+
+    def _covers(self, devices, since_ms):
+        for device in devices:
+            start = self._complete_since(device)
+            if start is None or start > since_ms:
+                return False
+        return True
+
+    def stats(self):
+        """Hit/miss counters and sizes"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+                "devices": len(self._rings),
+                "buffered": sum(len(ring) for ring in self._rings.values()),
+            }
@@ -0,0 +1,180 @@
+"""
+Push readings to live subscribers (Server-Sent Events)
+The group-commit writer hands every committed batch to Broadcaster.publish,
+which fans it out in memory to each subscriber's queue, so idle
+subscribers cost no database work at all. A subscriber can follow one
+device, a subset of metrics, and coalesce updates to at most one per
+device every `interval` seconds.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+# Readings queued per subscriber before the oldest are dropped
+QUEUE_SIZE = 1000
+
+# Seconds between keep-alive comments on an idle stream
+KEEPALIVE = 15
+
+# Subscribers allowed at once
+MAX_SUBSCRIBERS = 2000
+
+# Fields every pushed reading keeps when a metric subset is requested
+BASE_FIELDS = ("id", "device_id", "ts", "time")
+
+
+class Subscription:
+    """
+    One subscriber's filters and pending readings
+
+    With interval=0 every matching reading is queued. With an interval only
+    the newest reading of each device is kept and released at most once per
+    interval. `wakeup` (optional) is called whenever readings are queued,
+    for waiters that can't block on the condition (the ASGI server).
+    """
+
+    def __init__(self, device=None, metrics=None, interval=0, queue_size=QUEUE_SIZE):
+        self.device = device
+        self.metrics = metrics
+        self.interval = interval
+        self.dropped = 0
+        self.closed = False
+        self.wakeup = None
+        self._queue = deque(maxlen=queue_size)
+        self._latest = {}
+        self._sent_at = 0.0
+        self._cond = threading.Condition()
+
+    def shape(self, record):
+        """A reading trimmed to the requested metrics"""
+        if not self.metrics:
+            return record
+        return {k: record.get(k) for k in BASE_FIELDS + tuple(self.metrics)}
+
+    def offer(self, records):
+        """Queue the readings this subscriber wants"""
+        matching = [self.shape(r) for r in records
+                    if not self.device or r["device_id"] == self.device]
+        if not matching:
+            return
+        with self._cond:
+            if self.interval:
+                for record in matching:
+                    self._latest[record["device_id"]] = record
+            else:
+                overflow = len(self._queue) + len(matching) - self._queue.maxlen
+                if overflow > 0:
+                    self.dropped += overflow
+                self._queue.extend(matching)
+            self._cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def due_in(self):
+        """Seconds until coalesced readings may be released (0 if now)"""
+        if not self.interval:
+            return 0.0
+        return max(0.0, self._sent_at + self.interval - time.monotonic())
+
+    def pending(self):
+        """True if readings are waiting (coalesced ones may not be due yet)"""
+        with self._cond:
+            return bool(self._queue or self._latest)
+
+    def take(self):
+        """Readings ready to send now, without blocking"""
+        with self._cond:
+            return self._take()
+
+    def _take(self):
+        if self.interval:
+            if not self._latest or self.due_in() > 0:
+                return []
+            records = sorted(self._latest.values(), key=lambda r: (r["ts"], r["id"]))
+            self._latest.clear()
+            self._sent_at = time.monotonic()
+            return records
+        records = list(self._queue)
+        self._queue.clear()
+        return records
+
+    def wait(self, timeout):
+        """Block until readings are ready or timeout passes, returns them (maybe [])"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self.closed:
+                records = self._take()
+                if records:
+                    return records
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                # Coalesced readings become due before the deadline
+                if self._latest:
+                    remaining = min(remaining, self.due_in())
+                self._cond.wait(remaining)
+            return []
+
+
+class Broadcaster:
+    """Fan-out of committed readings to every Subscription, all in memory"""
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self.published = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, device=None, metrics=None, interval=0):
+        """New Subscription, or None when max_subscribers are already connected"""
+        subscription = Subscription(device, metrics, interval)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, rows):
+        """Writer listener: offer newly committed readings to every subscriber"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        records = [dict(row) for row in rows]
+        for subscription in subscribers:
+            subscription.offer(records)
+        self.published += len(records)
+
+    def close(self):
+        """End every stream (server shutdown)"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.close()
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+def sse_event(record):
+    """One reading as a Server-Sent Events message"""
+    event_id = "" if record.get("id") is None else f"id: {record['id']}\n"
+    return f"event: reading\n{event_id}data: {json.dumps(record)}\n\n"
+
+
+def sse_keepalive():
+    return ": keepalive\n\n"
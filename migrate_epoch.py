@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Convert an existing database from TEXT minute timestamps to epoch milliseconds
+Rows are copied in chunks while the old server keeps writing; only the final
+catch-up and table swap holds the write lock
+
+Usage:
+    python migrate_epoch.py [db_file] [--chunk N]
+"""
+
+import argparse
+import sys
+import time
+
+from rollups import backfill
+from sensor_db import CREATE_READINGS_SQL, DB_FILE, connect, init_schema, is_legacy_schema
+
+NEW_TABLE = "sensor_readings_epoch"
+
+# Old 'YYYY-MM-DD HH:MM' local time -> epoch milliseconds
+# (the 'utc' modifier treats its input as local time and converts it to UTC)
+COPY_SQL = f"""
+    INSERT INTO {NEW_TABLE}
+    (id, ts, temperature, humidity, pressure, gas, aqi, co2, calibrated)
+    SELECT id, CAST(strftime('%s', time, 'utc') AS INTEGER) * 1000,
+           temperature, humidity, pressure, gas, aqi, co2, calibrated
+    FROM sensor_readings
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def copy_chunk(conn, after_id, chunk_size):
+    """
+    Copy the next chunk of rows after after_id
+    Returns (rows copied, highest id copied)
+    """
+    count = conn.execute(COPY_SQL, (after_id, chunk_size)).rowcount
+    if count <= 0:
+        return 0, after_id
+    return count, conn.execute(f"SELECT MAX(id) FROM {NEW_TABLE}").fetchone()[0]
+
+
+def migrate(conn, chunk_size=50000):
+    """Migrate sensor_readings in place, returns the number of rows converted"""
+    if not is_legacy_schema(conn):
+        print("Database already uses epoch timestamps, nothing to do")
+        return 0
+
+    conn.execute(CREATE_READINGS_SQL.format(table=NEW_TABLE))
+    conn.commit()
+
+    # Resume after whatever an interrupted run already copied
+    last_id, copied = conn.execute(
+        f"SELECT COALESCE(MAX(id), 0), COUNT(*) FROM {NEW_TABLE}").fetchone()
+
+    # Bulk of the copy: short transactions so ingest keeps running
+    while True:
+        with conn:
+            count, last_id = copy_chunk(conn, last_id, chunk_size)
+        if not count:
+            break
+        copied += count
+        print(f"  copied {copied} rows (up to id {last_id})")
+
+    # Catch up on rows written meanwhile and swap the tables atomically
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        count = 1
+        while count:
+            count, last_id = copy_chunk(conn, last_id, chunk_size)
+            copied += count
+        conn.execute("DROP TABLE sensor_readings")
+        conn.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO sensor_readings")
+
+    init_schema(conn)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert TEXT timestamps to epoch milliseconds")
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    parser.add_argument("--chunk", type=int, default=50000, help="rows copied per transaction")
+    args = parser.parse_args()
+
+    conn = connect(args.db_file)
+    started = time.monotonic()
+    print(f"Migrating {args.db_file}...")
+    copied = migrate(conn, args.chunk)
+
+    if copied:
+        # Rollup buckets are derived from the new timestamps
+        print("Rebuilding rollups...")
+        backfill(conn)
+        print(f"Converted {copied} rows in {time.monotonic() - started:.1f}s")
+
+    conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Cache of finished /query and /aggregate response bodies
+Entries are keyed on the normalized request and kept in LRU order under a
+byte cap. A commit drops the entries whose date range (and device) covers
+any of its readings, so ranges that ended in the past stay cached until
+they are evicted while ranges reaching the current minute are refreshed
+by new readings. Open-ended ranges also expire after LIVE_TTL seconds.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+
+from sensor_db import filter_range_ms, now_ms
+
+# Total size of cached bodies
+MAX_BYTES = 64 * 1024 * 1024
+
+# Larger results are served but not cached
+MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Seconds an entry whose range has no end (or ends in the future) is kept
+LIVE_TTL = 60
+
+# Recent invalidations remembered so a result computed while a commit
+# landed is not cached stale
+INVALIDATION_LOG = 1024
+
+
+def cache_key(route, filters, **options):
+    """Hashable key for a request: route, filters that are set and other options"""
+    return (route,
+            tuple(sorted((k, v) for k, v in filters.items() if v is not None)),
+            tuple(sorted(options.items())))
+
+
+def make_etag(body):
+    """Strong ETag for a response body"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value names etag (or is *)"""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class CachedResult:
+    """A finished response body and the readings it depends on"""
+
+    def __init__(self, body, content_type, filters, expires, headers=None):
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.etag = make_etag(body)
+        self.start_ms, self.end_ms = filter_range_ms(filters)
+        self.device = filters.get("device")
+        self.expires = expires
+
+    def covers(self, device, first_ts, last_ts):
+        """True if readings of device between first_ts and last_ts can change this result"""
+        if self.device and device != self.device:
+            return False
+        return ((self.end_ms is None or first_ts < self.end_ms) and
+                (self.start_ms is None or last_ts >= self.start_ms))
+
+
+class QueryCache:
+    """
+    LRU of response bodies with a byte cap, invalidated by committed readings
+
+    Callers take a token() before running a query and pass it to put(), so
+    a result that raced a commit touching its range is not stored.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, max_entry_bytes=MAX_ENTRY_BYTES, live_ttl=LIVE_TTL):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.live_ttl = live_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._sequence = 0
+        self._log = deque(maxlen=INVALIDATION_LOG)
+
+    def get(self, key):
+        """Cached result for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None and entry.expires < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def token(self):
+        """Marker of the invalidations seen so far, taken before running a query"""
+        with self._lock:
+            return self._sequence
+
+    def put(self, key, body, content_type, filters, token, headers=None):
+        """
+        Store a finished body (bytes) and any extra response headers, returns
+        the CachedResult, or None if the body is too large or readings in its
+        range arrived meanwhile
+        """
+        if len(body) > self.max_entry_bytes:
+            return None
+        _, end_ms = filter_range_ms(filters)
+        live = end_ms is None or end_ms > now_ms()
+        entry = CachedResult(body, content_type, filters,
+                             time.monotonic() + self.live_ttl if live else None, headers)
+        with self._lock:
+            if self._sequence - token > len(self._log):
+                return None
+            for sequence, device, first_ts, last_ts in self._log:
+                if sequence > token and entry.covers(device, first_ts, last_ts):
+                    return None
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, rows):
+        """Drop entries covering newly committed readings (mappings with device_id and ts)"""
+        ranges = {}
+        for row in rows:
+            device, ts = row["device_id"], row["ts"]
+            first, last = ranges.get(device, (ts, ts))
+            ranges[device] = (min(first, ts), max(last, ts))
+        with self._lock:
+            for device, (first_ts, last_ts) in ranges.items():
+                self._sequence += 1
+                self._log.append((self._sequence, device, first_ts, last_ts))
+                stale = [key for key, entry in self._entries.items()
+                         if entry.covers(device, first_ts, last_ts)]
+                for key in stale:
+                    self._remove(key)
+
+    def clear(self):
+        """Drop every entry (after retention rewrote stored readings)"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            # Results computed before the clear must not be stored either
+            self._sequence += len(self._log) + 1
+            self._log.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+
+    def tee(self, key, token, filters, content_type, chunks):
+        """Pass text chunks through and cache the whole body once it completed"""
+        parts, size = [], 0
+        try:
+            for chunk in chunks:
+                if parts is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_bytes:
+                        parts = None
+                    else:
+                        parts.append(chunk)
+                yield chunk
+        finally:
+            chunks.close()
+        if parts is not None:
+            self.put(key, "".join(parts).encode(), content_type, filters, token)
+
+    def stats(self):
+        """Hit/miss counters and sizes"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "evictions": self.evictions,
+            }
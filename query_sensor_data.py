@@ -2,67 +2,123 @@
 """
 Simple command-line tool to query sensor data
 Makes it easy to filter and export data without needing URLs
+
+Usage:
+    python query_sensor_data.py                       interactive menu
+    python query_sensor_data.py [--db FILE] COMMAND [options]
+
+Commands (output goes to stdout, see --help of each command):
+    stats                                   totals, date range, temperature/humidity
+    latest [--device D]                     newest reading
+    recent [--limit 60] [--device D]        newest readings, oldest first
+    last24h [--device D]                    24-hour summary (or the readings with --format)
+    query [--temp-min X ...] [--start-date YYYY-MM-DD] [--limit N]
+          [--format csv|ndjson|json|text] [--out FILE|-] [--count]
+          [--page-size N [--cursor C]]      one page; the next cursor goes to stderr
+    analyze [--start-date ...] [--end-date ...] [--device D] [--window 60]
+
+latest, recent, last24h and query take --watch SECONDS to keep one
+connection open and print readings as they arrive (--repeat N stops after
+N polls). The database is --db, else $SENSOR_DB, else sensor_db.DB_FILE.
 """
 
-import sqlite3
+import argparse
 import csv
+import heapq
+import json
 import sys
 import os
+import time
 from datetime import datetime, timedelta
+from itertools import islice
+
+# Only sensor_db is imported up front; the modules behind queries, exports
+# and analysis (NumPy among them) are imported by the functions that need
+# them, so quick commands like 'latest' start fast
+import sensor_db
+from sensor_db import (RANGE_FILTERS, READING_COLUMN_NAMES, READING_COLUMNS, build_where,
+                       check_page_size, db_connection, decode_cursor, fetch_page, format_ts,
+                       order_key, to_epoch_ms)
 
 # Use absolute path so script can run from any directory
-DB_FILE = os.path.expanduser("/home/terry/env_home/sensor_data.db")
+DB_FILE = os.path.expanduser(os.environ.get("SENSOR_DB") or sensor_db.DB_FILE)
 
+# Output formats of the commands; text is the human-readable form
+OUTPUT_FORMATS = ("text", "csv", "ndjson", "json")
 
-def show_stats():
-    """Show basic statistics about the data"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Total records
-    cursor.execute("SELECT COUNT(*) FROM sensor_readings")
-    total = cursor.fetchone()[0]
-    
-    # Date range
-    cursor.execute("SELECT MIN(time), MAX(time) FROM sensor_readings")
-    min_date, max_date = cursor.fetchone()
+# Readings fetched per poll step in --watch mode
+WATCH_CHUNK = 1000
+
+
+def database_stats():
+    """Reading count, time range and per-metric summary of every database file"""
+    from federated import map_files, query_files
+    from rollups import combine_summaries, has_rollups, summarize_all, summarize_raw
     
-    # Temperature stats
-    cursor.execute("SELECT MIN(temperature), MAX(temperature), AVG(temperature) FROM sensor_readings")
-    temp_stats = cursor.fetchone()
+    def file_stats(conn):
+        # Date range (separate MIN/MAX subqueries each read one end of idx_ts_metrics)
+        min_ts, max_ts = conn.execute("""
+            SELECT (SELECT MIN(ts) FROM sensor_readings),
+                   (SELECT MAX(ts) FROM sensor_readings)
+        """).fetchone()
+        # Totals come from the daily rollup instead of scanning every row
+        if has_rollups(conn):
+            return min_ts, max_ts, summarize_all(conn), True
+        return min_ts, max_ts, summarize_raw(conn), False
     
-    # Humidity stats
-    cursor.execute("SELECT MIN(humidity), MAX(humidity), AVG(humidity) FROM sensor_readings")
-    humidity_stats = cursor.fetchone()
+    parts = map_files(query_files(DB_FILE, {}), file_stats)
+    if any(summary["count"] and not rolled_up for _, _, summary, rolled_up in parts):
+        print("\nNote: rollups are empty, run 'python rollups.py backfill' for faster stats",
+              file=sys.stderr)
     
-    conn.close()
+    summary = combine_summaries(part[2] for part in parts)
+    summary["first_ts"] = min((part[0] for part in parts if part[0] is not None), default=None)
+    summary["last_ts"] = max((part[1] for part in parts if part[1] is not None), default=None)
+    return summary
+
+
+def show_stats():
+    """Show basic statistics about the data"""
+    summary = database_stats()
+    min_ts, max_ts = summary["first_ts"], summary["last_ts"]
+    total = summary["count"]
+    temp_stats = summary["temperature"]
+    humidity_stats = summary["humidity"]
     
     print("\n" + "=" * 60)
     print("DATABASE STATISTICS")
     print("=" * 60)
     print(f"Total Records: {total}")
     if total > 0:
-        print(f"Date Range: {min_date} to {max_date}")
-        print(f"\nTemperature: {temp_stats[0]:.1f}°C to {temp_stats[1]:.1f}°C (avg: {temp_stats[2]:.1f}°C)")
-        print(f"Humidity: {humidity_stats[0]:.1f}% to {humidity_stats[1]:.1f}% (avg: {humidity_stats[2]:.1f}%)")
+        print(f"Date Range: {format_ts(min_ts)} to {format_ts(max_ts)}")
+        print(f"\nTemperature: {temp_stats['min']:.1f}°C to {temp_stats['max']:.1f}°C (avg: {temp_stats['avg']:.1f}°C)")
+        print(f"Humidity: {humidity_stats['min']:.1f}% to {humidity_stats['max']:.1f}% (avg: {humidity_stats['avg']:.1f}%)")
     print("=" * 60 + "\n")
 
 
-def latest_reading():
-    """Show the latest reading"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+def get_latest_reading(device=None):
+    """Newest reading (of one device) over every database file, or None"""
+    from federated import map_files, query_files
     
-    cursor.execute("SELECT * FROM sensor_readings ORDER BY time DESC LIMIT 1")
-    row = cursor.fetchone()
-    conn.close()
+    filters = {"device": device}
+    where_sql, params = build_where(filters)
+    query_sql = (f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                 "ORDER BY ts DESC, id DESC LIMIT 1")
+    rows = map_files(query_files(DB_FILE, filters),
+                     lambda conn: conn.execute(query_sql, params).fetchone())
+    return max((row for row in rows if row is not None), key=order_key, default=None)
+
+
+def latest_reading(device=None):
+    """Show the latest reading"""
+    row = get_latest_reading(device)
     
     if row:
         print("\n" + "=" * 60)
         print("LATEST READING")
         print("=" * 60)
         print(f"Time: {row['time']}")
+        print(f"Device: {row['device_id']}")
         print(f"Temperature: {row['temperature']:.1f}°C")
         print(f"Humidity: {row['humidity']:.1f}%")
         print(f"Pressure: {row['pressure']:.1f} hPa")
@@ -75,132 +131,293 @@ def latest_reading():
         print("No data available\n")
 
 
+def make_filters(temp_min=None, temp_max=None, humidity_min=None, humidity_max=None,
+                 aqi_min=None, aqi_max=None, co2_min=None, co2_max=None,
+                 start_date=None, end_date=None, device=None, cursor=None):
+    """
+    Collect query arguments into the filter dict used by sensor_db
+    cursor (a next_cursor from /query or query_page) starts after that reading
+    """
+    return {
+        "device": device,
+        "temp_min": temp_min, "temp_max": temp_max,
+        "humidity_min": humidity_min, "humidity_max": humidity_max,
+        "aqi_min": aqi_min, "aqi_max": aqi_max,
+        "co2_min": co2_min, "co2_max": co2_max,
+        "start_date": start_date, "end_date": end_date,
+        "after": decode_cursor(cursor) if cursor else None,
+    }
+
+
 def query_data(temp_min=None, temp_max=None, humidity_min=None, humidity_max=None,
                aqi_min=None, aqi_max=None, co2_min=None, co2_max=None,
-               start_date=None, end_date=None, limit=1440):
+               start_date=None, end_date=None, limit=1440, device=None, cursor=None):
     """
     Query the database with filters
-    Returns matching records
+    Returns matching records (limit=None returns all of them), starting
+    after cursor if one is given
     """
-    query_sql = "SELECT * FROM sensor_readings WHERE 1=1"
-    params = []
-    
-    if temp_min is not None:
-        query_sql += " AND temperature >= ?"
-        params.append(temp_min)
-    if temp_max is not None:
-        query_sql += " AND temperature <= ?"
-        params.append(temp_max)
-    if humidity_min is not None:
-        query_sql += " AND humidity >= ?"
-        params.append(humidity_min)
-    if humidity_max is not None:
-        query_sql += " AND humidity <= ?"
-        params.append(humidity_max)
-    if aqi_min is not None:
-        query_sql += " AND aqi >= ?"
-        params.append(aqi_min)
-    if aqi_max is not None:
-        query_sql += " AND aqi <= ?"
-        params.append(aqi_max)
-    if co2_min is not None:
-        query_sql += " AND co2 >= ?"
-        params.append(co2_min)
-    if co2_max is not None:
-        query_sql += " AND co2 <= ?"
-        params.append(co2_max)
-    if start_date:
-        query_sql += " AND time >= ?"
-        params.append(f"{start_date} 00:00")
-    if end_date:
-        query_sql += " AND time <= ?"
-        params.append(f"{end_date} 23:59")
-    
-    query_sql += " ORDER BY time ASC LIMIT ?"
-    params.append(limit)
-    
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(query_sql, params)
+    filters = make_filters(temp_min, temp_max, humidity_min, humidity_max,
+                           aqi_min, aqi_max, co2_min, co2_max, start_date, end_date, device,
+                           cursor)
+    
+    cursor = open_readings(filters, limit)
     rows = cursor.fetchall()
-    conn.close()
+    cursor.close()
     
     return rows
 
 
-def get_recent_readings(limit=60):
+def query_page(filters, page_size=1000, cursor=None):
+    """
+    One page of the readings matching filters, starting after cursor
+    Returns (rows, next cursor or None on the last page); pass the cursor
+    back with the same filters for the next page
+    """
+    filters = dict(filters, after=decode_cursor(cursor) if cursor else filters.get("after"))
+    page_size = check_page_size(page_size)
+    cursor = open_readings(filters, page_size + 1)
+    page = fetch_page(cursor, page_size)
+    cursor.close()
+    return page
+
+
+def reading_query(filters, limit=None):
+    """Tiered query for filters (see retention.build_tiered_query) and the files it reads"""
+    from archive import archived_ranges
+    from federated import query_files
+    from retention import build_tiered_query
+    from rollups import read_cutoffs
+    
+    with db_connection(DB_FILE) as conn:
+        cutoffs = read_cutoffs(conn)
+    query_sql, params = build_tiered_query(filters, limit, cutoffs, archived_ranges(DB_FILE))
+    return query_sql, params, query_files(DB_FILE, filters)
+
+
+def open_readings(filters, limit=None, conn=None):
+    """
+    Cursor over the readings matching filters: rows from every database
+    file (raw or retention tier) merged in time order with archived months.
+    Shards that can't match are skipped and the rest are read in parallel
+    (federated.py). An unsharded database is read on conn when one is
+    given, so the rows come from its open read snapshot.
+    """
+    from archive import archive_cursors
+    from federated import open_federated
+    from sensor_db import MergedCursor
+    
+    query_sql, params, files = reading_query(filters, limit)
+    if conn is None or sensor_db.SHARD_BY is not None:
+        return open_federated(DB_FILE, files, query_sql, params, limit, filters)
+    cursors = [conn.execute(query_sql, params)] + archive_cursors(DB_FILE, filters, limit)
+    if len(cursors) == 1:
+        return cursors[0]
+    return MergedCursor(cursors, limit)
+
+
+def count_data(filters, limit=None):
+    """Count the records a query would return without fetching them"""
+    from archive import count_archived
+    from federated import count_federated
+    
+    query_sql, params, files = reading_query(filters)
+    count = count_federated(files, query_sql, params) + count_archived(DB_FILE, filters)
+    return count if limit is None else min(count, limit)
+
+
+def get_recent_readings(limit=60, device=None):
     """
     Get the most recent readings (newest first for display)
+    Each database file returns its newest `limit`, merged newest first
     """
-    query_sql = "SELECT * FROM sensor_readings ORDER BY time DESC LIMIT ?"
+    from federated import map_files, query_files
     
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(query_sql, (limit,))
-    rows = cursor.fetchall()
-    conn.close()
+    filters = {"device": device}
+    where_sql, params = build_where(filters)
+    query_sql = (f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                 "ORDER BY ts DESC, id DESC LIMIT ?")
     
-    return rows
+    parts = map_files(query_files(DB_FILE, filters),
+                      lambda conn: conn.execute(query_sql, params + [limit]).fetchall())
+    return list(islice(heapq.merge(*parts, key=order_key, reverse=True), limit))
 
 
-def get_last_24_hours():
+def get_last_24_hours(device=None):
     """
     Get all readings from the last 24 hours
     """
+    from federated import open_federated, query_files
+    
     # Calculate time 24 hours ago from now
     now = datetime.now()
     twenty_four_hours_ago = now - timedelta(hours=24)
     
-    # Format for SQL query
+    # Format for display
     cutoff_time = twenty_four_hours_ago.strftime('%Y-%m-%d %H:%M')
     
-    query_sql = "SELECT * FROM sensor_readings WHERE time >= ? ORDER BY time ASC"
+    filters = {"device": device, "start_date": twenty_four_hours_ago.strftime("%Y-%m-%d")}
+    where_sql, params = build_where({"device": device})
+    query_sql = (f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} AND ts >= ? "
+                 "ORDER BY ts ASC, id ASC")
     
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(query_sql, (cutoff_time,))
-    rows = cursor.fetchall()
-    conn.close()
+    cursor = open_federated(DB_FILE, query_files(DB_FILE, filters), query_sql,
+                            params + [to_epoch_ms(twenty_four_hours_ago)])
+    try:
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
     
     return rows, cutoff_time
 
 
-def export_to_csv(rows, filename=None):
-    """Export query results to CSV"""
-    # Create queries directory if it doesn't exist
-    queries_dir = os.path.expanduser("/home/terry/env_home/queries")
+def get_last_24_hours_summary(device=None):
+    """
+    Summarize the last 24 hours from the hourly rollup of every database file
+    Returns (summary dict, cutoff_time)
+    """
+    from federated import map_files, query_files
+    from rollups import combine_summaries, has_rollups, summarize_raw, summarize_since
+    
+    cutoff = datetime.now() - timedelta(hours=24)
+    
+    def file_summary(conn):
+        if has_rollups(conn):
+            return summarize_since(conn, cutoff, device)
+        where_sql, params = build_where({"device": device})
+        return summarize_raw(conn, f"{where_sql} AND ts >= ?", params + [to_epoch_ms(cutoff)])
+    
+    files = query_files(DB_FILE, {"device": device, "start_date": cutoff.strftime("%Y-%m-%d")})
+    summary = combine_summaries(map_files(files, file_summary))
+    return summary, cutoff.strftime('%Y-%m-%d %H:%M')
+
+
+def export_path(filename, default_prefix):
+    """Full path for an export file in the queries folder"""
+    # Create queries directory (next to the database) if it doesn't exist
+    queries_dir = os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "queries")
     os.makedirs(queries_dir, exist_ok=True)
     
     if not filename:
-        filename = f"sensor_export_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        filename = f"{default_prefix}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
     
     # Full path to save in queries folder
-    filepath = os.path.join(queries_dir, filename)
+    return os.path.join(queries_dir, filename)
+
+
+def export_to_csv(rows, filename=None):
+    """Export query results to CSV"""
+    from sensor_export import format_csv_rows
+    
+    filepath = export_path(filename, "sensor_export")
     
     with open(filepath, 'w', newline='') as f:
         if rows:
             writer = csv.writer(f)
             # Write header
-            writer.writerow(rows[0].keys())
+            columns = rows[0].keys()
+            writer.writerow(columns)
             
             # Write data with formatted numbers
-            for row in rows:
-                formatted_row = []
-                for key in row.keys():
-                    value = row[key]
-                    # Format numeric columns with 1 decimal place
-                    if key in ['temperature', 'humidity', 'pressure', 'gas', 'aqi', 'co2']:
-                        formatted_row.append(f"{float(value):.1f}")
-                    else:
-                        formatted_row.append(value)
-                writer.writerow(formatted_row)
+            writer.writerows(format_csv_rows(columns, rows))
     
     return filepath
 
 
+def export_query_to_csv(filters, limit=None, filename=None):
+    """
+    Stream a query straight into a CSV file in chunks
+    Works for exports larger than memory
+    Returns (filepath, row count)
+    """
+    from sensor_export import write_csv
+    
+    filepath = export_path(filename, "sensor_export")
+    
+    with open(filepath, 'w', newline='') as f:
+        cursor = open_readings(filters, limit)
+        count = write_csv(cursor, f)
+        cursor.close()
+    
+    return filepath, count
+
+
+def load_analysis(start_date=None, end_date=None, device=None):
+    """Load matching readings column-wise for the analytics functions"""
+    import analytics
+    
+    filters = make_filters(start_date=start_date, end_date=end_date, device=device)
+    with db_connection(DB_FILE) as conn:
+        return analytics.load_columns(conn, filters)
+
+
+def show_analysis(cols, window=60):
+    """Print summary percentiles, peak averages, daily/weekly profiles and correlations"""
+    import analytics
+    
+    metrics = ("temperature", "humidity", "aqi", "co2")
+    summary = analytics.summarize(cols)
+    
+    print("\n" + "=" * 60)
+    print(f"ANALYSIS ({len(cols)} readings)")
+    print("=" * 60)
+    print(f"{'':12} {'min':>8} {'p5':>8} {'median':>8} {'p95':>8} {'max':>8} {'mean':>8} {'std':>7}")
+    for m in metrics:
+        s = summary[m]
+        if s["count"]:
+            print(f"{m:12} {s['min']:8.1f} {s['p5']:8.1f} {s['p50']:8.1f} {s['p95']:8.1f} "
+                  f"{s['max']:8.1f} {s['mean']:8.1f} {s['std']:7.2f}")
+    
+    print(f"\nHighest {window}-reading average:")
+    for m in metrics:
+        peak, ts = analytics.peak_window(cols, m, window)
+        if peak is not None:
+            print(f"  {m:12} {peak:8.1f}  (ending {format_ts(ts)})")
+    
+    profile = analytics.profiles(cols, metrics)
+    print("\nAverage by hour of day:")
+    print("  hour " + "".join(f"{m:>12}" for m in metrics))
+    for hour in range(24):
+        cells = [profile["hour"][m][hour] for m in metrics]
+        if any(c is not None for c in cells):
+            print(f"  {hour:02d}   " + "".join(f"{c:12.1f}" if c is not None else f"{'-':>12}"
+                                              for c in cells))
+    
+    print("\nAverage by day of week:")
+    print("  day  " + "".join(f"{m:>12}" for m in metrics))
+    for day, name in enumerate(analytics.WEEKDAYS):
+        cells = [profile["weekday"][m][day] for m in metrics]
+        if any(c is not None for c in cells):
+            print(f"  {name}  " + "".join(f"{c:12.1f}" if c is not None else f"{'-':>12}"
+                                           for c in cells))
+    
+    print("\nCorrelations (Pearson r):")
+    for (a, b), r in analytics.correlation_matrix(cols, metrics).items():
+        if r is not None:
+            print(f"  {a} vs {b}: {r:+.2f}")
+    print("=" * 60 + "\n")
+
+
+def show_last_24_hours_summary(summary, cutoff_time):
+    """Print the summary returned by get_last_24_hours_summary()"""
+    print(f"\nFound {summary['count']} records from the last 24 hours")
+    print(f"Period: {cutoff_time} to {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    
+    temps = summary['temperature']
+    humidities = summary['humidity']
+    aqis = summary['aqi']
+    co2s = summary['co2']
+    
+    print("\n" + "=" * 60)
+    print("24-HOUR SUMMARY")
+    print("=" * 60)
+    print(f"Temperature: {temps['min']:.1f}°C to {temps['max']:.1f}°C (avg: {temps['avg']:.1f}°C)")
+    print(f"Humidity: {humidities['min']:.1f}% to {humidities['max']:.1f}% (avg: {humidities['avg']:.1f}%)")
+    print(f"AQI: {aqis['min']:.1f} to {aqis['max']:.1f} (avg: {aqis['avg']:.1f})")
+    print(f"CO2: {co2s['min']:.1f} to {co2s['max']:.1f} ppm (avg: {co2s['avg']:.1f} ppm)")
+    print("=" * 60)
+
+
 def print_menu():
     """Print the interactive menu"""
     print("\n" + "=" * 60)
@@ -211,15 +428,16 @@ def print_menu():
     print("3. Query and export data")
     print("4. Show last 60 readings")
     print("5. Show last 24 hours")
-    print("6. Exit")
+    print("6. Analyze readings (percentiles, profiles, correlations)")
+    print("7. Exit")
     print("=" * 60)
 
 
-def main():
+def interactive():
     """Main interactive menu"""
     while True:
         print_menu()
-        choice = input("\nSelect option (1-6): ").strip()
+        choice = input("\nSelect option (1-7): ").strip()
         
         if choice == "1":
             show_stats()
@@ -260,25 +478,31 @@ def main():
             end_date = input("  End date (YYYY-MM-DD): ").strip()
             end_date = end_date if end_date else None
             
-            limit = input("  Max results (default 1440): ").strip()
+            limit = input("  Max results (default 1440, 0 for no limit): ").strip()
             limit = int(limit) if limit else 1440
+            limit = limit if limit > 0 else None
+            
+            filters = make_filters(temp_min, temp_max, humidity_min, humidity_max,
+                                   aqi_min, aqi_max, co2_min, co2_max,
+                                   start_date, end_date)
             
             print("\nQuerying database...")
-            rows = query_data(temp_min, temp_max, humidity_min, humidity_max,
-                            aqi_min, aqi_max, co2_min, co2_max,
-                            start_date, end_date, limit)
+            total = count_data(filters, limit)
             
-            print(f"\nFound {len(rows)} matching records")
+            print(f"\nFound {total} matching records")
             
-            if rows:
+            if total:
                 export = input("Export to CSV? (y/n): ").strip().lower()
                 if export == 'y':
-                    filename = export_to_csv(rows)
+                    filename, _ = export_query_to_csv(filters, limit)
                     print(f"\nExported to: {filename}")
                 else:
                     # Show first 5 records
+                    rows = query_data(temp_min, temp_max, humidity_min, humidity_max,
+                                      aqi_min, aqi_max, co2_min, co2_max,
+                                      start_date, end_date, min(limit or 5, 5))
                     print("\nFirst 5 records:")
-                    for i, row in enumerate(rows[:5]):
+                    for i, row in enumerate(rows):
                         print(f"\n  Record {i+1}:")
                         print(f"    Time: {row['time']}")
                         print(f"    Temp: {row['temperature']:.1f}°C, Humidity: {row['humidity']:.1f}%")
@@ -296,48 +520,314 @@ def main():
         
         elif choice == "5":
             print("\nFetching last 24 hours of data...")
-            rows, cutoff_time = get_last_24_hours()
+            summary, cutoff_time = get_last_24_hours_summary()
             
-            if rows:
-                print(f"\nFound {len(rows)} records from the last 24 hours")
-                print(f"Period: {cutoff_time} to {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-                
-                # Calculate some quick stats
-                temps = [row['temperature'] for row in rows]
-                humidities = [row['humidity'] for row in rows]
-                aqis = [row['aqi'] for row in rows]
-                co2s = [row['co2'] for row in rows]
-                
-                print("\n" + "=" * 60)
-                print("24-HOUR SUMMARY")
-                print("=" * 60)
-                print(f"Temperature: {min(temps):.1f}°C to {max(temps):.1f}°C (avg: {sum(temps)/len(temps):.1f}°C)")
-                print(f"Humidity: {min(humidities):.1f}% to {max(humidities):.1f}% (avg: {sum(humidities)/len(humidities):.1f}%)")
-                print(f"AQI: {min(aqis):.1f} to {max(aqis):.1f} (avg: {sum(aqis)/len(aqis):.1f})")
-                print(f"CO2: {min(co2s):.1f} to {max(co2s):.1f} ppm (avg: {sum(co2s)/len(co2s):.1f} ppm)")
-                print("=" * 60)
+            if summary["count"]:
+                show_last_24_hours_summary(summary, cutoff_time)
                 
                 export = input("\nExport to CSV? (y/n): ").strip().lower()
                 if export == 'y':
+                    rows, _ = get_last_24_hours()
                     filename = export_to_csv(rows, f"last_24h_{datetime.now().strftime('%Y%m%d_%H%M')}.csv")
                     print(f"\nExported to: {filename}")
             else:
                 print("\nNo data found for the last 24 hours")
         
         elif choice == "6":
+            print("\nEnter a date range (press Enter to skip):")
+            start_date = input("  Start date (YYYY-MM-DD): ").strip() or None
+            end_date = input("  End date (YYYY-MM-DD): ").strip() or None
+            device = input("  Device id: ").strip() or None
+            window = input("  Rolling window in readings (default 60): ").strip()
+            window = int(window) if window else 60
+            
+            print("\nLoading readings...")
+            cols = load_analysis(start_date, end_date, device)
+            if len(cols):
+                show_analysis(cols, window)
+            else:
+                print("\nNo data found for that range")
+        
+        elif choice == "7":
             print("\nGoodbye!\n")
             break
         
         else:
-            print("\nInvalid choice. Please select 1-6.")
+            print("\nInvalid choice. Please select 1-7.")
 
 
-if __name__ == "__main__":
+def reading_line(reading):
+    """One line of text for a reading dict"""
+    def value(name):
+        return "-" if reading[name] is None else f"{reading[name]:.1f}"
+    return (f"{reading['time']}  {reading['device_id']}  {value('temperature')}°C  "
+            f"{value('humidity')}%  {value('pressure')} hPa  AQI {value('aqi')}  "
+            f"CO2 {value('co2')} ppm")
+
+
+def write_rows(columns, rows, fmt, out):
+    """Append rows to out without a header (text, csv or ndjson)"""
+    from sensor_export import format_csv_rows
+    
+    if fmt == "csv":
+        csv.writer(out).writerows(format_csv_rows(columns, rows))
+    elif fmt == "ndjson":
+        out.write("".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows))
+    else:
+        out.write("".join(reading_line(dict(zip(columns, row))) + "\n" for row in rows))
+
+
+def write_cursor(cursor, fmt, out):
+    """Stream every row of a cursor to out in fmt, chunk by chunk"""
+    from sensor_export import column_names, iter_chunks, iter_csv, iter_json, iter_ndjson
+    
+    if fmt == "text":
+        columns = column_names(cursor)
+        for rows in iter_chunks(cursor):
+            write_rows(columns, rows, fmt, out)
+        return
+    writers = {"csv": iter_csv, "ndjson": iter_ndjson, "json": iter_json}
+    for chunk in writers[fmt](cursor):
+        out.write(chunk)
+    if fmt == "json":
+        out.write("\n")
+
+
+def follow(conn, filters, fmt, out, last_id, interval, repeat=None):
+    """
+    Poll for readings stored after last_id and write them as they arrive
+    Uses the row id rather than ts so late readings (uploaded from a
+    device's buffer) are still shown. Stops after repeat polls if given.
+    """
+    where_sql, params = build_where(filters)
+    query_sql = (f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} AND id > ? "
+                 "ORDER BY id LIMIT ?")
+    columns = None
+    polls = 0
+    while repeat is None or polls < repeat:
+        time.sleep(interval)
+        polls += 1
+        while True:
+            cursor = conn.execute(query_sql, params + [last_id, WATCH_CHUNK])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            columns = columns or [d[0] for d in cursor.description]
+            write_rows(columns, rows, fmt, out)
+            last_id = rows[-1]["id"]
+            if len(rows) < WATCH_CHUNK:
+                break
+        out.flush()
+
+
+def run_readings(args, filters, query_sql=None, params=(), rows=None):
+    """
+    Write the readings of a command to args.out, then follow new ones with --watch
+    query_sql selects from the live table; without it the full (tiered and
+    archived) query for filters is used. When readings are sharded over
+    several files, rows() gives the first output from all of them instead
+    of query_sql.
+    """
+    watch = args.watch if args.watch is not None else (2.0 if args.repeat else None)
+    if watch is not None and args.format == "json":
+        print("Error: --watch can't be used with --format json (use ndjson)", file=sys.stderr)
+        return 2
+    
+    out = sys.stdout if args.out == "-" else open(args.out, "w", newline="")
+    try:
+        with db_connection(DB_FILE) as conn:
+            # One read snapshot for the first output and the id it ends at,
+            # so following neither repeats nor skips a reading
+            conn.execute("BEGIN")
+            try:
+                last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM sensor_readings").fetchone()[0]
+                if query_sql is None:
+                    cursor = open_readings(filters, args.limit, conn)
+                elif rows is not None and sensor_db.SHARD_BY is not None:
+                    from sensor_export import RowsCursor
+                    cursor = RowsCursor(READING_COLUMN_NAMES, rows())
+                else:
+                    cursor = conn.execute(query_sql, params)
+                write_cursor(cursor, args.format, out)
+                cursor.close()
+            finally:
+                conn.rollback()
+            out.flush()
+            if watch is not None:
+                follow(conn, filters, args.format, out, last_id, watch, args.repeat)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def cmd_stats(args):
+    if args.format == "json":
+        json.dump(database_stats(), sys.stdout)
+        print()
+    else:
+        show_stats()
+    return 0
+
+
+def cmd_latest(args):
+    if args.format == "text" and args.watch is None and not args.repeat:
+        latest_reading(args.device)
+        return 0
+    where_sql, params = build_where({"device": args.device})
+    return run_readings(args, {"device": args.device},
+                        f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                        "ORDER BY ts DESC, id DESC LIMIT 1", params,
+                        lambda: [row for row in [get_latest_reading(args.device)] if row])
+
+
+def cmd_recent(args):
+    # Newest readings, written oldest first
+    where_sql, params = build_where({"device": args.device})
+    return run_readings(args, {"device": args.device},
+                        f"SELECT * FROM (SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} "
+                        "ORDER BY ts DESC, id DESC LIMIT ?) ORDER BY ts, id",
+                        params + [args.limit],
+                        lambda: get_recent_readings(args.limit, args.device)[::-1])
+
+
+def cmd_last24h(args):
+    if args.format == "text" and args.watch is None and not args.repeat:
+        summary, cutoff_time = get_last_24_hours_summary(args.device)
+        if summary["count"]:
+            show_last_24_hours_summary(summary, cutoff_time)
+        else:
+            print("\nNo data found for the last 24 hours")
+        return 0
+    where_sql, params = build_where({"device": args.device})
+    cutoff = to_epoch_ms(datetime.now() - timedelta(hours=24))
+    return run_readings(args, {"device": args.device},
+                        f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql} AND ts >= ? "
+                        "ORDER BY ts, id", params + [cutoff],
+                        lambda: get_last_24_hours(args.device)[0])
+
+
+def cmd_query(args):
+    filters = {name: getattr(args, name) for name in RANGE_FILTERS}
+    filters.update(device=args.device, start_date=args.start_date, end_date=args.end_date)
+    if args.count:
+        print(count_data(filters, args.limit))
+        return 0
+    if args.page_size is None and args.cursor is None:
+        return run_readings(args, filters)
+    if args.watch is not None or args.repeat:
+        print("Error: --watch can't be used with --page-size/--cursor", file=sys.stderr)
+        return 2
+    
+    from sensor_export import RowsCursor
+    
+    rows, next_cursor = query_page(filters, args.page_size or 1000, args.cursor)
+    out = sys.stdout if args.out == "-" else open(args.out, "w", newline="")
+    try:
+        write_cursor(RowsCursor(READING_COLUMN_NAMES, rows), args.format, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    # stderr, so stdout stays a clean page for pipes
+    print(f"next cursor: {next_cursor}" if next_cursor else "last page", file=sys.stderr)
+    return 0
+
+
+def cmd_analyze(args):
+    cols = load_analysis(args.start_date, args.end_date, args.device)
+    if not len(cols):
+        print("\nNo data found for that range")
+        return 1
+    show_analysis(cols, args.window)
+    return 0
+
+
+def cmd_menu(args):
+    interactive()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Query the sensor database")
+    parser.add_argument("--db", help=f"database file (default $SENSOR_DB or {sensor_db.DB_FILE})")
+    commands = parser.add_subparsers(dest="command")
+    
+    def add_output(sub, default_format="text", formats=OUTPUT_FORMATS):
+        sub.add_argument("--format", choices=formats, default=default_format)
+        sub.add_argument("--out", default="-", help="output file, - for stdout (default)")
+        sub.add_argument("--watch", type=float, metavar="SECONDS",
+                         help="keep polling every SECONDS and print new readings")
+        sub.add_argument("--repeat", type=int, metavar="N",
+                         help="stop watching after N polls (implies --watch 2)")
+    
+    sub = commands.add_parser("stats", help="totals, date range and temperature/humidity")
+    sub.add_argument("--format", choices=("text", "json"), default="text")
+    sub.set_defaults(func=cmd_stats)
+    
+    sub = commands.add_parser("latest", help="newest reading")
+    sub.add_argument("--device")
+    add_output(sub)
+    sub.set_defaults(func=cmd_latest)
+    
+    sub = commands.add_parser("recent", help="newest readings, oldest first")
+    sub.add_argument("--device")
+    sub.add_argument("--limit", type=int, default=60)
+    add_output(sub)
+    sub.set_defaults(func=cmd_recent)
+    
+    sub = commands.add_parser("last24h", help="summary (or readings) of the last 24 hours")
+    sub.add_argument("--device")
+    add_output(sub)
+    sub.set_defaults(func=cmd_last24h)
+    
+    sub = commands.add_parser("query", help="filtered readings, archives included")
+    for name in RANGE_FILTERS:
+        sub.add_argument("--" + name.replace("_", "-"), dest=name, type=float)
+    sub.add_argument("--device")
+    sub.add_argument("--start-date", help="YYYY-MM-DD")
+    sub.add_argument("--end-date", help="YYYY-MM-DD (inclusive)")
+    sub.add_argument("--limit", type=int, help="maximum rows (default all)")
+    sub.add_argument("--count", action="store_true", help="only print the number of matches")
+    sub.add_argument("--page-size", type=int, help="print one page of this many readings")
+    sub.add_argument("--cursor", help="start after this cursor (printed with the previous page)")
+    add_output(sub, default_format="csv")
+    sub.set_defaults(func=cmd_query)
+    
+    sub = commands.add_parser("analyze", help="percentiles, profiles and correlations")
+    sub.add_argument("--device")
+    sub.add_argument("--start-date", help="YYYY-MM-DD")
+    sub.add_argument("--end-date", help="YYYY-MM-DD (inclusive)")
+    sub.add_argument("--window", type=int, default=60, help="rolling window in readings")
+    sub.set_defaults(func=cmd_analyze)
+    
+    sub = commands.add_parser("menu", help="interactive menu (the default)")
+    sub.set_defaults(func=cmd_menu)
+    return parser
+
+
+def main(argv=None):
+    global DB_FILE
+    
+    args = build_parser().parse_args(argv)
+    if args.db:
+        DB_FILE = os.path.abspath(os.path.expanduser(args.db))
+    
     # Check if database exists
-    import os
     if not os.path.exists(DB_FILE):
-        print(f"\nError: Database file '{DB_FILE}' not found!")
-        print("Make sure the server has run at least once to create the database.\n")
-        sys.exit(1)
+        print(f"\nError: Database file '{DB_FILE}' not found!", file=sys.stderr)
+        print("Make sure the server has run at least once to create the database.\n", file=sys.stderr)
+        return 1
     
-    main()
+    try:
+        return getattr(args, "func", cmd_menu)(args)
+    except BrokenPipeError:
+        # Output piped into head & co. which exited early; point stdout at
+        # devnull so the interpreter's final flush doesn't fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Tiered retention for sensor readings
+Raw rows are kept for RETENTION_DAYS["raw"] days; after that a reading only
+lives on in the rollup tables, whose 5-minute and hourly tiers are trimmed
+the same way. The rollups are maintained at ingest, so compaction never has
+to aggregate anything: it moves the tier cutoff forward, deletes rows older
+than it in small batches and hands freed pages back with incremental vacuum.
+
+Usage:
+    python retention.py compact [db_file]           apply the retention policy once
+    python retention.py enable-vacuum [db_file]     one-off VACUUM to switch an
+                                                    existing database to incremental vacuum
+"""
+
+import argparse
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from rollups import METRICS, ROLLUP_LEVELS, has_rollups, read_cutoffs
+from sensor_db import (CREATE_FLAGS_SQL, DB_FILE, READING_COLUMNS, RANGE_FILTERS, build_query,
+                       build_where, connect, filter_range_ms, format_bucket, shard_files,
+                       to_epoch_ms)
+
+# Days each tier is kept (None keeps it forever). Readings older than the raw
+# window are served from rollup_5m, older than the 5m window from rollup_1h,
+# and from rollup_1d once the hourly window has passed too
+RETENTION_DAYS = {"raw": 30, "5m": 365, "1h": None}
+
+# Finest to coarsest: the tier a range falls in is the finest one still kept
+TIERS = ("raw", "5m", "1h", "1d")
+
+# Rows deleted per transaction, and the pause between transactions so the
+# ingest writer can take the write lock in between
+DELETE_BATCH = 5000
+BATCH_PAUSE = 0.05
+
+# Pages released per PRAGMA incremental_vacuum step
+VACUUM_PAGES = 2000
+
+# Seconds between runs of the background compaction job
+COMPACT_INTERVAL = 3600
+
+STATE_SQL = """
+    CREATE TABLE IF NOT EXISTS retention_state (
+        tier TEXT PRIMARY KEY,
+        cutoff_ms INTEGER NOT NULL
+    )
+"""
+
+
+def tier_cutoffs(now=None):
+    """
+    Cutoff (epoch ms, local midnight) for every tier with a retention window
+    Cutting at midnight means no 5m, hourly or daily bucket is ever split
+    between raw rows and a rollup tier
+    """
+    today = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    return {tier: to_epoch_ms(today - timedelta(days=days))
+            for tier, days in RETENTION_DAYS.items() if days is not None}
+
+
+def delete_batches(conn, sql, params, pause=BATCH_PAUSE):
+    """
+    Run a DELETE taking a trailing LIMIT parameter until it stops matching
+    Returns rows deleted
+    """
+    deleted = 0
+    while True:
+        with conn:
+            count = conn.execute(sql, params + [DELETE_BATCH]).rowcount
+        deleted += count
+        if count < DELETE_BATCH:
+            return deleted
+        time.sleep(pause)
+
+
+def incremental_vacuum(conn, pause=BATCH_PAUSE):
+    """Release free pages in small steps, returns pages released"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    released = 0
+    while True:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            return released
+        # executescript steps the pragma to completion; execute() would
+        # release a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        released += min(free, VACUUM_PAGES)
+        time.sleep(pause)
+
+
+def compact(conn, now=None, pause=BATCH_PAUSE):
+    """
+    Apply the retention policy to one database file
+    Returns {"raw": rows deleted, "5m": ..., "vacuumed_pages": ...}
+    """
+    if not has_rollups(conn) and conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM sensor_readings)").fetchone()[0]:
+        raise RuntimeError("Rollups are empty, run 'python rollups.py backfill' before compacting")
+
+    conn.execute(STATE_SQL)
+    conn.execute(CREATE_FLAGS_SQL)
+    conn.commit()
+    current = read_cutoffs(conn)
+    result = {}
+
+    for tier, cutoff in tier_cutoffs(now).items():
+        # Never move a cutoff backwards: those rows are already gone
+        cutoff = max(cutoff, current.get(tier, 0))
+
+        # Readers switch tiers as soon as the cutoff is recorded, so rows
+        # still waiting to be deleted are never counted twice
+        with conn:
+            conn.execute("INSERT INTO retention_state (tier, cutoff_ms) VALUES (?, ?) "
+                         "ON CONFLICT(tier) DO UPDATE SET cutoff_ms = excluded.cutoff_ms",
+                         (tier, cutoff))
+
+        if tier == "raw":
+            sql = ("DELETE FROM sensor_readings WHERE id IN "
+                   "(SELECT id FROM sensor_readings WHERE ts < ? ORDER BY ts LIMIT ?)")
+            params = [cutoff]
+            # Flags (anomalies.py) go with their readings
+            delete_batches(conn, "DELETE FROM reading_flags WHERE (device_id, ts) IN "
+                           "(SELECT device_id, ts FROM reading_flags WHERE ts < ? LIMIT ?)",
+                           [cutoff], pause)
+        else:
+            table, _ = ROLLUP_LEVELS[tier]
+            sql = (f"DELETE FROM {table} WHERE rowid IN "
+                   f"(SELECT rowid FROM {table} WHERE bucket < ? LIMIT ?)")
+            params = [format_bucket(cutoff)]
+        result[tier] = delete_batches(conn, sql, params, pause)
+
+    result["vacuumed_pages"] = incremental_vacuum(conn, pause)
+    return result
+
+
+def compact_all(db_file=DB_FILE, now=None):
+    """Compact every database file, returns {path: result}"""
+    results = {}
+    paths = shard_files(db_file)
+    if db_file not in paths:
+        # The main file records the cutoffs readers use even when sharded
+        paths = [db_file] + paths
+    for path in paths:
+        conn = connect(path)
+        try:
+            results[path] = compact(conn, now)
+        finally:
+            conn.close()
+    return results
+
+
+class RetentionJob:
+    """
+    Background thread running compact_all every `interval` seconds
+    Functions in `tasks` are called with the database file before each run,
+    functions in `listeners` with compact_all's results after it
+    """
+
+    def __init__(self, db_file, interval=COMPACT_INTERVAL):
+        self.db_file = db_file
+        self.interval = interval
+        self.tasks = []
+        self.listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                for task in self.tasks:
+                    task(self.db_file)
+                results = compact_all(self.db_file)
+                for path, result in results.items():
+                    if any(result.values()):
+                        print(f"Retention: {path} {result}")
+                for listener in self.listeners:
+                    listener(results)
+            except Exception as e:
+                print(f"Error: retention compaction failed: {e}")
+            self._stop.wait(self.interval)
+
+
+# ----- reading across tiers -----
+
+def _tier_select(tier, filters, start_ms, end_ms):
+    """SELECT over a rollup tier shaped like READING_COLUMNS (id and calibrated are NULL)"""
+    table, _ = ROLLUP_LEVELS[tier]
+    averages = {m: f"{m}_sum / NULLIF({m}_count, 0)" for m in METRICS}
+    ts_sql = "CAST(strftime('%s', bucket, 'utc') AS INTEGER) * 1000"
+    sql = (f"SELECT NULL AS id, device_id, {ts_sql} AS ts, "
+           f"bucket || ':00' AS time, "
+           f"{', '.join(f'{expr} AS {m}' for m, expr in averages.items())}, "
+           f"NULL AS calibrated FROM {table} WHERE 1=1")
+    params = []
+    if filters.get("device"):
+        sql += " AND device_id = ?"
+        params.append(filters["device"])
+    for name, (column, op) in RANGE_FILTERS.items():
+        value = filters.get(name)
+        if value is not None:
+            sql += f" AND {averages[column]} {op} ?"
+            params.append(value)
+    if start_ms is not None:
+        sql += " AND bucket >= ?"
+        params.append(format_bucket(start_ms))
+    if end_ms is not None:
+        sql += " AND bucket < ?"
+        params.append(format_bucket(end_ms))
+    if filters.get("after"):
+        # start_ms already seeks to the cursor's bucket; tier rows sort as id 0
+        sql += f" AND ({ts_sql}, 0, device_id) > (?, ?, ?)"
+        params.extend(filters["after"])
+    return sql, params
+
+
+def _later(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _earlier(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _subtract(start, end, ranges):
+    """Parts of [start, end) not covered by sorted (start, end) ranges (None = open end)"""
+    if start is not None and end is not None and start >= end:
+        return []
+    parts = []
+    for lo, hi in ranges:
+        if (end is not None and lo >= end) or (start is not None and hi <= start):
+            continue
+        if start is None or lo > start:
+            parts.append((start, lo))
+        start = _later(start, hi)
+    if start is None or end is None or start < end:
+        parts.append((start, end))
+    return parts
+
+
+def build_tiered_query(filters, limit=None, cutoffs=None, archived=()):
+    """
+    Like sensor_db.build_query, but ranges reaching past the raw retention
+    window are filled from the rollup tiers (one averaged row per bucket),
+    and ranges in `archived` (sorted (start_ms, end_ms) pairs held by
+    archive.py) are left out for the caller to merge in
+    Returns (sql, params)
+    """
+    cutoffs = cutoffs or {}
+    start_ms, end_ms = filter_range_ms(filters)
+    archived = [(lo, hi) for lo, hi in archived
+                if (end_ms is None or lo < end_ms) and (start_ms is None or hi > start_ms)]
+    if not archived and ("raw" not in cutoffs or
+                         (start_ms is not None and start_ms >= cutoffs["raw"])):
+        return build_query(filters, limit)
+
+    # Each tier covers [its own cutoff, the next finer tier's cutoff); a
+    # tier without a cutoff reaches back to the start of history
+    parts = []
+    params = []
+    upper = None
+    for tier in TIERS:
+        lower = cutoffs.get(tier)
+        for seg_start, seg_end in _subtract(_later(lower, start_ms), _earlier(upper, end_ms), archived):
+            if tier == "raw":
+                where_sql, where_params = build_where(filters)
+                if seg_start is not None:
+                    where_sql += " AND ts >= ?"
+                    where_params.append(seg_start)
+                if seg_end is not None:
+                    where_sql += " AND ts < ?"
+                    where_params.append(seg_end)
+                parts.append(f"SELECT {READING_COLUMNS} FROM sensor_readings{where_sql}")
+                params += where_params
+            else:
+                sql, tier_params = _tier_select(tier, filters, seg_start, seg_end)
+                parts.append(sql)
+                params += tier_params
+        if lower is None:
+            break
+        upper = lower
+
+    if not parts:
+        # Everything requested is archived
+        parts.append(f"SELECT {READING_COLUMNS} FROM sensor_readings WHERE 0")
+    # device_id orders the id-less tier rows of one bucket
+    query_sql = " UNION ALL ".join(parts) + " ORDER BY ts ASC, id ASC, device_id ASC"
+    if limit is not None:
+        query_sql += " LIMIT ?"
+        params.append(limit)
+    return query_sql, params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the tiered retention policy")
+    parser.add_argument("command", choices=["compact", "enable-vacuum"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    if args.command == "enable-vacuum":
+        conn = connect(args.db_file)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        print(f"Rewriting {args.db_file} (the server must be stopped)...")
+        conn.execute("VACUUM")
+        conn.close()
+    else:
+        for path, result in compact_all(args.db_file).items():
+            print(f"{path}: {result}")
+    print(f"Done in {time.monotonic() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Precomputed rollups of sensor_readings at 5-minute, hourly and daily resolution
+Each bucket keeps min/max/sum/count per metric so statistics over any span
+can be answered from a handful of rows instead of scanning raw readings
+
+Usage:
+    python rollups.py backfill [db_file]    rebuild every rollup from raw data
+"""
+
+import argparse
+import sys
+import time
+from datetime import timedelta
+
+from sensor_db import CREATE_FLAGS_SQL, DB_FILE, connect, format_bucket, to_epoch_ms
+
+# Metrics summarized in every rollup bucket
+METRICS = ('temperature', 'humidity', 'pressure', 'gas', 'aqi', 'co2')
+
+# Bits of reading_flags.mask, set by anomalies.py. A value is left out of
+# the rollups and raw aggregates when its metric's spike bit is set, or for
+# PRECAL_METRICS when the sensor had not finished calibrating; the reading
+# itself (and its other metrics) still counts. Stuck bits are informational:
+# a steady room repeats the same rounded value for hours
+FLAG_SPIKE = {m: 1 << i for i, m in enumerate(METRICS)}
+FLAG_STUCK = {m: 1 << (len(METRICS) + i) for i, m in enumerate(METRICS)}
+FLAG_PRECAL = 1 << (2 * len(METRICS))
+FLAG_GAP = FLAG_PRECAL << 1
+
+# Gas-based metrics (BME688 gas resistance, AQI, estimated CO2) are
+# meaningless until the firmware's baseline calibration has finished
+PRECAL_METRICS = ('gas', 'aqi', 'co2')
+
+# Join giving reading queries the flags of each row (flags.mask is NULL
+# for readings that were never flagged)
+FLAGS_JOIN = " LEFT JOIN reading_flags AS flags USING (device_id, ts)"
+
+# Resolution -> (table, SQL expression giving the bucket start for a raw row).
+# Bucket keys are local 'YYYY-MM-DD HH:MM' text so daily buckets follow local
+# midnight; every UTC offset is a multiple of 5 minutes, so 5m buckets can be
+# cut on the epoch value directly
+ROLLUP_LEVELS = {
+    "5m": ("rollup_5m", "strftime('%Y-%m-%d %H:%M', ts / 300000 * 300, 'unixepoch', 'localtime')"),
+    "1h": ("rollup_1h", "strftime('%Y-%m-%d %H:00', ts / 1000, 'unixepoch', 'localtime')"),
+    "1d": ("rollup_1d", "strftime('%Y-%m-%d 00:00', ts / 1000, 'unixepoch', 'localtime')"),
+}
+
+# Bucket of each level from the local 'YYYY-MM-DD HH:MM' key of a 5-minute
+# bucket, which never straddles a local hour
+SLOT_BUCKETS = {
+    "5m": "bucket",
+    "1h": "substr(bucket, 1, 14) || '00'",
+    "1d": "substr(bucket, 1, 11) || '00:00'",
+}
+
+# Raw rows aggregated per statement during a backfill
+BACKFILL_CHUNK = 100000
+
+
+def untrusted_mask(metric):
+    """Flag bits that make a metric's value untrustworthy"""
+    return FLAG_SPIKE[metric] | (FLAG_PRECAL if metric in PRECAL_METRICS else 0)
+
+
+def trusted_sql(metric):
+    """SQL for a metric's value, NULL where it is flagged (needs FLAGS_JOIN)"""
+    return f"CASE WHEN COALESCE(flags.mask, 0) & {untrusted_mask(metric)} THEN NULL ELSE {metric} END"
+
+
+def _metric_columns():
+    return [f"{m}_{agg}" for m in METRICS for agg in ("min", "max", "sum", "count")]
+
+
+def init_rollup_tables(conn):
+    """
+    Create the rollup tables if they don't exist
+    Returns True if they were (re)created empty and need a backfill
+    """
+    columns = ",\n            ".join(
+        f"{name} {'INTEGER NOT NULL DEFAULT 0' if name.endswith('_count') else 'REAL'}"
+        for name in _metric_columns())
+    created = False
+    for table, _ in ROLLUP_LEVELS.values():
+        existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if existing and "device_id" not in existing:
+            # Rollups from before multi-device support are rebuilt per device
+            conn.execute(f"DROP TABLE {table}")
+            existing = []
+        created = created or not existing
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+            device_id TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            {columns},
+            PRIMARY KEY (device_id, bucket)
+            )
+        """)
+    # Rollups leave flagged values out, so they read the flags table
+    conn.execute(CREATE_FLAGS_SQL)
+    conn.commit()
+    return created and conn.execute("SELECT EXISTS (SELECT 1 FROM sensor_readings)").fetchone()[0] == 1
+
+
+def _slots_sql(where_sql):
+    selects = ", ".join(f"MIN({v}), MAX({v}), TOTAL({v}), COUNT({v})"
+                        for v in map(trusted_sql, METRICS))
+    # Grouped on the epoch slot; the local bucket text is only formatted
+    # once per group rather than once per row and level. Slot first, or the
+    # planner walks idx_device_ts for the grouping instead of the id range
+    return f"""
+        INSERT INTO temp.rollup_slots
+        SELECT device_id, {ROLLUP_LEVELS["5m"][1]}, COUNT(*), {selects}
+        FROM sensor_readings{FLAGS_JOIN}
+        {where_sql}
+        GROUP BY ts / 300000, device_id
+    """
+
+
+def _upsert_sql(table, bucket_expr):
+    selects = ", ".join(f"MIN({m}_min), MAX({m}_max), TOTAL({m}_sum), SUM({m}_count)"
+                        for m in METRICS)
+    updates = ["count = count + excluded.count"]
+    for m in METRICS:
+        # Scalar min()/max() return NULL if either side is NULL, so fall back
+        # to whichever side has a value
+        updates.append(f"{m}_min = min(coalesce({m}_min, excluded.{m}_min), "
+                       f"coalesce(excluded.{m}_min, {m}_min))")
+        updates.append(f"{m}_max = max(coalesce({m}_max, excluded.{m}_max), "
+                       f"coalesce(excluded.{m}_max, {m}_max))")
+        updates.append(f"{m}_sum = {m}_sum + excluded.{m}_sum")
+        updates.append(f"{m}_count = {m}_count + excluded.{m}_count")
+
+    return f"""
+        INSERT INTO {table} (device_id, bucket, count, {", ".join(_metric_columns())})
+        SELECT device_id, {bucket_expr}, SUM(count), {selects}
+        FROM temp.rollup_slots
+        GROUP BY 1, 2
+        ON CONFLICT(device_id, bucket) DO UPDATE SET {", ".join(updates)}
+    """
+
+
+def last_row_id(conn):
+    """Highest id in sensor_readings (0 when empty)"""
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM sensor_readings").fetchone()[0]
+
+
+def read_cutoffs(conn):
+    """
+    Tier cutoffs recorded by retention.py as {tier: epoch ms}
+    Rows of a tier older than its cutoff have been deleted
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'retention_state'").fetchone()
+    if not exists:
+        return {}
+    return {tier: cutoff for tier, cutoff in conn.execute("SELECT tier, cutoff_ms FROM retention_state")}
+
+
+def update_rollups(conn, after_id, upto_id=None, since_ms=None):
+    """
+    Fold raw rows with after_id < id <= upto_id (and ts >= since_ms) into
+    every rollup level
+    Runs inside the caller's transaction
+    """
+    where_sql = "WHERE id > ?"
+    params = [after_id]
+    if upto_id is not None:
+        where_sql += " AND id <= ?"
+        params.append(upto_id)
+    if since_ms is not None:
+        where_sql += " AND ts >= ?"
+        params.append(since_ms)
+
+    # The rows are summarized into 5-minute slots once, and every level is
+    # built from the slots
+    columns = ", ".join(f"{name} {'INTEGER' if name.endswith('_count') else 'REAL'}"
+                        for name in _metric_columns())
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_slots "
+                 f"(device_id TEXT, bucket TEXT, count INTEGER, {columns})")
+    conn.execute(_slots_sql(where_sql), params)
+    for level, (table, _) in ROLLUP_LEVELS.items():
+        conn.execute(_upsert_sql(table, SLOT_BUCKETS[level]))
+    conn.execute("DELETE FROM temp.rollup_slots")
+
+
+def backfill(conn, chunk_size=BACKFILL_CHUNK):
+    """
+    Rebuild every rollup table from the raw readings, returns rows folded in
+    Buckets older than the raw retention cutoff only exist in the rollups,
+    so they are kept and just the span still held as raw rows is rebuilt
+    """
+    init_rollup_tables(conn)
+    since_ms = read_cutoffs(conn).get("raw")
+
+    # Rows committed after this transaction are folded in by the ingest writer
+    with conn:
+        for table, _ in ROLLUP_LEVELS.values():
+            if since_ms is None:
+                conn.execute(f"DELETE FROM {table}")
+            else:
+                conn.execute(f"DELETE FROM {table} WHERE bucket >= ?", (format_bucket(since_ms),))
+        upto = last_row_id(conn)
+
+    start = 0
+    while start < upto:
+        end = min(start + chunk_size, upto)
+        with conn:
+            update_rollups(conn, start, end, since_ms)
+        start = end
+
+    return conn.execute("SELECT COALESCE(SUM(count), 0) FROM rollup_1d").fetchone()[0]
+
+
+def has_rollups(conn):
+    """True if the rollup tables exist and have been populated"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_1d'").fetchone()
+    return bool(exists) and conn.execute("SELECT EXISTS (SELECT 1 FROM rollup_1d)").fetchone()[0] == 1
+
+
+def empty_summary():
+    return {"count": 0, **{m: {"min": None, "max": None, "sum": 0.0, "count": 0} for m in METRICS}}
+
+
+def merge_summary(summary, row):
+    """Fold one rollup-shaped row (count plus per-metric min/max/sum/count) into summary"""
+    summary["count"] += int(row["count"] or 0)
+    for m in METRICS:
+        stats = summary[m]
+        low, high = row[f"{m}_min"], row[f"{m}_max"]
+        if low is not None:
+            stats["min"] = low if stats["min"] is None else min(stats["min"], low)
+        if high is not None:
+            stats["max"] = high if stats["max"] is None else max(stats["max"], high)
+        stats["sum"] += row[f"{m}_sum"] or 0.0
+        stats["count"] += int(row[f"{m}_count"] or 0)
+    return summary
+
+
+def finish_summary(summary):
+    """Add an 'avg' to every metric of a merged summary"""
+    for m in METRICS:
+        stats = summary[m]
+        stats["avg"] = stats["sum"] / stats["count"] if stats["count"] else None
+    return summary
+
+
+def combine_summaries(summaries):
+    """One finished summary from the finished summaries of several database files"""
+    total = empty_summary()
+    for summary in summaries:
+        row = {"count": summary["count"]}
+        for m in METRICS:
+            for key in ("min", "max", "sum", "count"):
+                row[f"{m}_{key}"] = summary[m][key]
+        merge_summary(total, row)
+    return finish_summary(total)
+
+
+def _rollup_totals_sql(table, where_sql=""):
+    aggs = ", ".join(f"MIN({m}_min) AS {m}_min, MAX({m}_max) AS {m}_max, "
+                     f"TOTAL({m}_sum) AS {m}_sum, TOTAL({m}_count) AS {m}_count"
+                     for m in METRICS)
+    return f"SELECT TOTAL(count) AS count, {aggs} FROM {table} {where_sql}"
+
+
+def _raw_totals_sql(where_sql):
+    aggs = ", ".join(f"MIN({v}) AS {m}_min, MAX({v}) AS {m}_max, "
+                     f"TOTAL({v}) AS {m}_sum, COUNT({v}) AS {m}_count"
+                     for m, v in zip(METRICS, map(trusted_sql, METRICS)))
+    return f"SELECT COUNT(*) AS count, {aggs} FROM sensor_readings{FLAGS_JOIN} {where_sql}"
+
+
+def summarize_raw(conn, where_sql="", params=()):
+    """Statistics computed directly from raw rows (for databases without rollups)"""
+    summary = merge_summary(empty_summary(), conn.execute(_raw_totals_sql(where_sql), params).fetchone())
+    return finish_summary(summary)
+
+
+def summarize_all(conn, device=None):
+    """Statistics over the whole history, read from the daily rollup"""
+    where_sql, params = ("WHERE device_id = ?", (device,)) if device else ("", ())
+    summary = merge_summary(empty_summary(), conn.execute(
+        _rollup_totals_sql("rollup_1d", where_sql), params).fetchone())
+    return finish_summary(summary)
+
+
+def summarize_since(conn, start, device=None):
+    """
+    Statistics for readings at or after start (a naive local datetime)
+    The partial first hour is read from raw rows, whole hours from rollup_1h
+    """
+    head_end = start.replace(minute=0, second=0, microsecond=0)
+    if head_end < start:
+        head_end += timedelta(hours=1)
+    device_sql, device_params = (" AND device_id = ?", [device]) if device else ("", [])
+
+    summary = empty_summary()
+    if head_end > start:
+        merge_summary(summary, conn.execute(
+            _raw_totals_sql("WHERE ts >= ? AND ts < ?" + device_sql),
+            [to_epoch_ms(start), to_epoch_ms(head_end)] + device_params).fetchone())
+    merge_summary(summary, conn.execute(
+        _rollup_totals_sql("rollup_1h", "WHERE bucket >= ?" + device_sql),
+        [head_end.strftime('%Y-%m-%d %H:%M')] + device_params).fetchone())
+    return finish_summary(summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain sensor_readings rollup tables")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("db_file", nargs="?", default=DB_FILE)
+    args = parser.parse_args()
+
+    conn = connect(args.db_file)
+    started = time.monotonic()
+    rows = backfill(conn)
+    conn.close()
+    print(f"Rolled up {rows} readings in {time.monotonic() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
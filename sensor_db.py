@@ -0,0 +1,483 @@
+"""
+Shared SQLite storage layer for the server and the command-line tool
+Keeps a pool of open connections in WAL mode with tuned pragmas
+"""
+
+import base64
+import glob
+import heapq
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+# Default database location used by both entry points
+DB_FILE = "/home/terry/env_home/sensor_data.db"
+
+# Applied to every new connection. WAL lets readers run while the ingest
+# writer commits; synchronous=NORMAL only fsyncs at checkpoints, which is
+# safe against application crashes (use FULL to survive power loss too).
+# auto_vacuum must come before the switch to WAL; it only takes effect on a
+# new database (existing ones: 'python retention.py enable-vacuum').
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",  # lets retention.py release freed pages
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",      # 64 MB page cache per connection
+    "PRAGMA mmap_size=268435456",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Pragmas that would write to the file, skipped on read-only connections
+WRITE_PRAGMAS = ("auto_vacuum", "journal_mode", "synchronous")
+
+# Prepared statements kept per connection, keyed by SQL text
+STATEMENT_CACHE_SIZE = 256
+
+# Idle connections kept open per database file
+POOL_SIZE = 8
+
+# Device id stored for readings that arrive without one
+DEFAULT_DEVICE = "default"
+
+# Optional sharding of readings into separate files next to DB_FILE:
+# None keeps everything in DB_FILE, "device" writes one file per device,
+# "month" writes one file per calendar month (local time)
+SHARD_BY = None
+
+CREATE_READINGS_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        device_id TEXT NOT NULL DEFAULT 'default',
+        ts INTEGER NOT NULL,
+        temperature REAL,
+        humidity REAL,
+        pressure REAL,
+        gas REAL,
+        aqi REAL,
+        co2 REAL,
+        calibrated TEXT
+    )
+"""
+
+# Readings flagged by anomalies.py: a bitmask per (device_id, ts) (layout in
+# rollups.py) and, for the first reading after a gap, the gap's length.
+# Only flagged readings have a row, so the table stays small
+CREATE_FLAGS_SQL = """
+    CREATE TABLE IF NOT EXISTS reading_flags (
+        device_id TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        mask INTEGER NOT NULL,
+        gap_ms INTEGER,
+        PRIMARY KEY (device_id, ts)
+    ) WITHOUT ROWID
+"""
+
+# Indexes on sensor_readings: name -> (columns, partial-index condition).
+# Chosen from 'python index_advisor.py plans' over a year of readings:
+# idx_ts_metrics starts with (ts, id), the ORDER BY of every reading query,
+# and carries the range-filtered metrics so filters are checked in the index
+# and only matching rows are read from the table (COUNT(*) never reads it).
+# No partial indexes: SQLite only uses one when the query repeats its
+# literal condition, and /query binds thresholds as parameters.
+READING_INDEXES = {
+    "idx_ts_metrics": ("ts, id, temperature, humidity, pressure, aqi, co2", None),
+}
+
+# A reading is identified by its device and timestamp. The unique index
+# also serves per-device queries; ingest inserts with ON CONFLICT DO
+# NOTHING, so a reading sent twice is stored once. Databases that already
+# hold duplicates keep the plain idx_device_ts index until
+# 'python dedup_readings.py' has cleaned them up
+READING_KEY_INDEX = "idx_reading_key"
+READING_KEY_COLUMNS = "device_id, ts"
+LEGACY_KEY_INDEX = "idx_device_ts"
+
+# Indexes created by earlier versions and dropped by init_schema: idx_ts is
+# a prefix of idx_ts_metrics, the single-metric indexes cost an index write
+# per reading while leading the planner into sorting whole ranges, and no
+# query matched the partial idx_co2_high
+OBSOLETE_INDEXES = ("idx_ts", "idx_temperature", "idx_humidity", "idx_co2_high")
+
+# Readings store epoch-millisecond timestamps; the local 'YYYY-MM-DD HH:MM:SS'
+# text form is only produced on output
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIME_TEXT_SQL = "strftime('%Y-%m-%d %H:%M:%S', ts / 1000, 'unixepoch', 'localtime')"
+
+# Column list returned by every reading query
+READING_COLUMN_NAMES = ("id", "device_id", "ts", "time", "temperature", "humidity",
+                        "pressure", "gas", "aqi", "co2", "calibrated")
+READING_COLUMNS = ", ".join(f"{TIME_TEXT_SQL} AS time" if name == "time" else name
+                            for name in READING_COLUMN_NAMES)
+
+
+# Largest page of readings a keyset-paged query returns
+MAX_PAGE_SIZE = 10000
+
+
+def now_ms():
+    """Current time as epoch milliseconds"""
+    return int(time.time() * 1000)
+
+
+def to_epoch_ms(dt):
+    """Naive local datetime to epoch milliseconds"""
+    return int(dt.timestamp() * 1000)
+
+
+def format_ts(ts):
+    """Epoch milliseconds to local 'YYYY-MM-DD HH:MM:SS' text"""
+    return datetime.fromtimestamp(ts / 1000).strftime(TIME_FORMAT)
+
+
+def format_bucket(ts):
+    """Rollup bucket key ('YYYY-MM-DD HH:MM' local time) for an epoch-ms timestamp"""
+    return datetime.fromtimestamp(ts / 1000).strftime("%Y-%m-%d %H:%M")
+
+
+def date_start_ms(date_text, days=0):
+    """Epoch milliseconds of local midnight at the start of a YYYY-MM-DD date"""
+    day = datetime.strptime(date_text, "%Y-%m-%d") + timedelta(days=days)
+    return to_epoch_ms(day)
+
+
+def connect(db_file=DB_FILE, readonly=False):
+    """
+    Open a new connection with the storage pragmas applied
+    readonly opens the file in SQLite's read-only mode (it must exist)
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_file))}?mode=ro",
+                               uri=True, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(db_file, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        if not (readonly and pragma.split()[1].split("=")[0] in WRITE_PRAGMAS):
+            conn.execute(pragma)
+    return conn
+
+
+def is_legacy_schema(conn):
+    """True if sensor_readings still stores minute-resolution TEXT times"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(sensor_readings)")]
+    return "time" in columns and "ts" not in columns
+
+
+def init_schema(conn):
+    """Create the sensor_readings table and its indexes if they don't exist"""
+    if is_legacy_schema(conn):
+        raise RuntimeError("Database uses the old TEXT time column, "
+                           "run 'python migrate_epoch.py' to convert it")
+
+    # ts is epoch milliseconds (UTC). Rows are appended in time order, so the
+    # rowid order matches time order and range scans read adjacent pages.
+    conn.execute(CREATE_READINGS_SQL.format(table="sensor_readings"))
+    conn.execute(CREATE_FLAGS_SQL)
+
+    # Databases created before multi-device support get the column added in
+    # place; existing rows belong to DEFAULT_DEVICE
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(sensor_readings)")]
+    if "device_id" not in columns:
+        conn.execute("ALTER TABLE sensor_readings "
+                     f"ADD COLUMN device_id TEXT NOT NULL DEFAULT '{DEFAULT_DEVICE}'")
+
+    for name in OBSOLETE_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, (columns, where) in READING_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON sensor_readings({columns})"
+                     + (f" WHERE {where}" if where else ""))
+    conn.commit()
+    create_key_index(conn)
+
+
+def create_key_index(conn):
+    """
+    Create the unique (device_id, ts) index, returns True if it exists
+    Fails softly on a database with duplicate readings, which then keeps a
+    plain index on the same columns
+    """
+    try:
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {READING_KEY_INDEX} "
+                     f"ON sensor_readings({READING_KEY_COLUMNS})")
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {LEGACY_KEY_INDEX} "
+                     f"ON sensor_readings({READING_KEY_COLUMNS})")
+        conn.commit()
+        print("Warning: sensor_readings holds duplicate readings, so resent readings are not "
+              "rejected. Run 'python dedup_readings.py' to remove them")
+        return False
+    conn.execute(f"DROP INDEX IF EXISTS {LEGACY_KEY_INDEX}")
+    conn.commit()
+    return True
+
+
+class ConnectionPool:
+    """
+    Pool of open connections to one database file
+
+    Connections are checked out for the duration of a `with` block and then
+    returned, so their page cache and prepared statements survive between
+    requests. Flask's threaded server starts a new thread per request, so
+    connections are handed between threads rather than pinned to one.
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE, readonly=False):
+        self.db_file = db_file
+        self.readonly = readonly
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = connect(self.db_file, self.readonly)
+
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_file=DB_FILE, readonly=False):
+    """Return the shared pool for a database file (read-only connections have their own)"""
+    with _pools_lock:
+        pool = _pools.get((db_file, readonly))
+        if pool is None:
+            pool = _pools[db_file, readonly] = ConnectionPool(db_file, readonly=readonly)
+        return pool
+
+
+def db_connection(db_file=DB_FILE, readonly=False):
+    """Context manager yielding a pooled connection for db_file"""
+    return get_pool(db_file, readonly).connection()
+
+
+def close_all():
+    """Close the idle connections of every pool"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+
+
+# Range filters shared by /query and the CLI: parameter -> (column, operator)
+RANGE_FILTERS = {
+    "temp_min": ("temperature", ">="),
+    "temp_max": ("temperature", "<="),
+    "humidity_min": ("humidity", ">="),
+    "humidity_max": ("humidity", "<="),
+    "pressure_min": ("pressure", ">="),
+    "pressure_max": ("pressure", "<="),
+    "aqi_min": ("aqi", ">="),
+    "aqi_max": ("aqi", "<="),
+    "co2_min": ("co2", ">="),
+    "co2_max": ("co2", "<="),
+}
+
+
+def build_where(filters):
+    """
+    Build the WHERE clause for a filter dict
+    Keys are RANGE_FILTERS names, device, start_date/end_date (YYYY-MM-DD)
+    and after (an order_key, see decode_cursor)
+    Returns (sql, params)
+    """
+    where_sql = " WHERE 1=1"
+    params = []
+
+    if filters.get("device"):
+        where_sql += " AND device_id = ?"
+        params.append(filters["device"])
+
+    for name, (column, op) in RANGE_FILTERS.items():
+        value = filters.get(name)
+        if value is not None:
+            where_sql += f" AND {column} {op} ?"
+            params.append(value)
+
+    if filters.get("start_date"):
+        where_sql += " AND ts >= ?"
+        params.append(date_start_ms(filters["start_date"]))
+    if filters.get("end_date"):
+        # end_date is inclusive, so stop at the following midnight
+        where_sql += " AND ts < ?"
+        params.append(date_start_ms(filters["end_date"], days=1))
+
+    if filters.get("after"):
+        # Keyset paging: a row-value comparison seeks idx_ts_metrics (ts, id)
+        where_sql += " AND (ts, id, device_id) > (?, ?, ?)"
+        params.extend(filters["after"])
+
+    return where_sql, params
+
+
+def build_query(filters, limit=None):
+    """
+    Build the filtered SELECT used by /query and the CLI
+    limit=None returns every matching row
+    Returns (sql, params)
+    """
+    where_sql, params = build_where(filters)
+    query_sql = f"SELECT {READING_COLUMNS} FROM sensor_readings" + where_sql + " ORDER BY ts ASC, id ASC"
+    if limit is not None:
+        query_sql += " LIMIT ?"
+        params.append(limit)
+    return query_sql, params
+
+
+def filter_range_ms(filters):
+    """(start_ms, end_ms) covered by a filter dict's dates, None for open ends"""
+    start_ms = date_start_ms(filters["start_date"]) if filters.get("start_date") else None
+    end_ms = date_start_ms(filters["end_date"], days=1) if filters.get("end_date") else None
+    if filters.get("after"):
+        # A page starts at its cursor, so earlier shards, tiers and archived
+        # months are skipped entirely
+        after_ts = filters["after"][0]
+        start_ms = after_ts if start_ms is None else max(start_ms, after_ts)
+    return start_ms, end_ms
+
+
+def order_key(row):
+    """
+    Sort key of a reading: (ts, id, device_id)
+    Rollup tier rows have no id (0 here, NULL sorts first in SQL too) and
+    device shards number their rows separately, so device_id breaks ties
+    """
+    return row["ts"], row["id"] or 0, row["device_id"]
+
+
+def encode_cursor(row):
+    """Opaque next-page cursor resuming after row"""
+    text = json.dumps(list(order_key(row)), separators=(",", ":"))
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """order_key tuple from a cursor made by encode_cursor, ValueError if it is not one"""
+    try:
+        ts, row_id, device = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}") from None
+    if not (isinstance(ts, int) and isinstance(row_id, int) and isinstance(device, str)):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return ts, row_id, device
+
+
+def fetch_page(cursor, page_size):
+    """
+    Read one page from a cursor opened with limit page_size + 1
+    Returns (rows, next cursor or None on the last page)
+    """
+    rows = cursor.fetchmany(page_size + 1)
+    if len(rows) > page_size:
+        return rows[:page_size], encode_cursor(rows[page_size - 1])
+    return rows, None
+
+
+def check_page_size(page_size):
+    """Validate a requested page size, returns it"""
+    if page_size is None or not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+    return page_size
+
+
+def _shard_prefix(db_file):
+    root, ext = os.path.splitext(db_file)
+    return root, ext or ".db"
+
+
+def shard_path(db_file, device_id, ts):
+    """File that stores a reading under the current SHARD_BY setting"""
+    if SHARD_BY is None:
+        return db_file
+    root, ext = _shard_prefix(db_file)
+    if SHARD_BY == "device":
+        return f"{root}-device-{re.sub(r'[^A-Za-z0-9_.-]', '_', device_id)}{ext}"
+    if SHARD_BY == "month":
+        return f"{root}-{datetime.fromtimestamp(ts / 1000):%Y-%m}{ext}"
+    raise ValueError(f"Unknown SHARD_BY setting: {SHARD_BY}")
+
+
+def shard_files(db_file, device=None, start_ms=None, end_ms=None):
+    """
+    Existing database files that can hold readings for a device/time range
+    Month shards come back in time order
+    """
+    if SHARD_BY is None:
+        return [db_file]
+
+    root, ext = _shard_prefix(db_file)
+    if SHARD_BY == "device":
+        if device:
+            path = shard_path(db_file, device, 0)
+            return [path] if os.path.exists(path) else []
+        return sorted(glob.glob(f"{glob.escape(root)}-device-*{ext}"))
+
+    files = []
+    for path in sorted(glob.glob(f"{glob.escape(root)}-[0-9][0-9][0-9][0-9]-[0-9][0-9]{ext}")):
+        month = datetime.strptime(path[len(root) + 1:-len(ext)], "%Y-%m")
+        month_start = to_epoch_ms(month)
+        month_end = to_epoch_ms((month + timedelta(days=32)).replace(day=1))
+        if (start_ms is None or month_end > start_ms) and (end_ms is None or month_start < end_ms):
+            files.append(path)
+    return files
+
+
+class MergedCursor:
+    """
+    Read-only cursor over the same query run against several databases
+    Rows are merged in order_key order and exposed through fetchmany/fetchall
+    so the export writers can consume them like a single cursor
+    """
+
+    def __init__(self, cursors, limit=None):
+        if cursors:
+            self.description = cursors[0].description
+        else:
+            self.description = [(name,) for name in READING_COLUMN_NAMES]
+        rows = heapq.merge(*cursors, key=order_key)
+        self._rows = itertools.islice(rows, limit)
+        self._cursors = cursors
+
+    def __iter__(self):
+        return self._rows
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        for cursor in self._cursors:
+            cursor.close()
@@ -0,0 +1,112 @@
+"""
+Chunked CSV/NDJSON writers for query results
+Rows are pulled from a cursor with fetchmany so exports never hold the
+whole result set in memory
+"""
+
+import csv
+import json
+from io import StringIO
+from itertools import islice
+
+# Rows fetched from SQLite per chunk
+CHUNK_SIZE = 1000
+
+# Columns written with 1 decimal place
+NUMERIC_COLUMNS = ('temperature', 'humidity', 'pressure', 'gas', 'aqi', 'co2')
+
+# Boolean columns, written as 0/1
+FLAG_COLUMNS = ('filled',)
+
+
+class RowsCursor:
+    """Rows that were already fetched, behind the cursor API the writers use"""
+
+    def __init__(self, columns, rows):
+        self.description = [(name,) for name in columns]
+        self._rows = iter(rows)
+
+    def fetchmany(self, size):
+        return list(islice(self._rows, size))
+
+    def close(self):
+        pass
+
+
+def iter_chunks(cursor, chunk_size=CHUNK_SIZE):
+    """Yield lists of rows from a cursor until it is exhausted"""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def column_names(cursor):
+    """Column names of the cursor's current result set"""
+    return [d[0] for d in cursor.description]
+
+
+def format_csv_rows(columns, rows):
+    """Format rows for CSV, numeric columns with 1 decimal place and flags as 0/1"""
+    numeric = [i for i, name in enumerate(columns) if name in NUMERIC_COLUMNS]
+    flags = [i for i, name in enumerate(columns) if name in FLAG_COLUMNS]
+    for row in rows:
+        values = list(row)
+        for i in numeric:
+            value = values[i]
+            values[i] = "" if value is None else f"{value:.1f}"
+        for i in flags:
+            value = values[i]
+            values[i] = "" if value is None else int(value)
+        yield values
+
+
+def iter_csv(cursor, chunk_size=CHUNK_SIZE):
+    """Yield CSV text for a cursor: the header, then one string per chunk"""
+    columns = column_names(cursor)
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    for rows in iter_chunks(cursor, chunk_size):
+        writer.writerows(format_csv_rows(columns, rows))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # Header only when nothing matched
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_ndjson(cursor, chunk_size=CHUNK_SIZE):
+    """Yield newline-delimited JSON for a cursor, one string per chunk"""
+    columns = column_names(cursor)
+    for rows in iter_chunks(cursor, chunk_size):
+        yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+def iter_json(cursor, chunk_size=CHUNK_SIZE):
+    """Yield a {"records": [...], "count": n} JSON document chunk by chunk"""
+    columns = column_names(cursor)
+    count = 0
+    yield '{"records": ['
+    for rows in iter_chunks(cursor, chunk_size):
+        body = ", ".join(json.dumps(dict(zip(columns, row))) for row in rows)
+        yield (", " if count else "") + body
+        count += len(rows)
+    yield f'], "count": {count}}}'
+
+
+def write_csv(cursor, f, chunk_size=CHUNK_SIZE):
+    """Write a cursor to an open text file as CSV, returns the row count"""
+    columns = column_names(cursor)
+    writer = csv.writer(f)
+    writer.writerow(columns)
+
+    count = 0
+    for rows in iter_chunks(cursor, chunk_size):
+        writer.writerows(format_csv_rows(columns, rows))
+        count += len(rows)
+    return count
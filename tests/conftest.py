@@ -0,0 +1,57 @@
+"""
+Shared fixtures for the test suite
+The server modules live in the repository root and bind sensor_db.DB_FILE
+when they are imported, so it is pointed at a scratch directory before any
+test module imports them.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sensor_db  # noqa: E402
+
+sensor_db.DB_FILE = os.path.join(tempfile.mkdtemp(prefix="sensor-tests-"), "sensor_data.db")
+
+from ingest_writer import GroupCommitWriter  # noqa: E402
+from rollups import init_rollup_tables  # noqa: E402
+
+# A fixed day well inside every accepted range, 2024-03-01 12:00 UTC
+BASE_TS = 1709294400000
+
+
+def reading(device_id, ts, temperature=21.5):
+    """A sensor_readings row tuple as the ingest writer takes it"""
+    return (device_id, ts, temperature, 45.0, 1013.2, 50000.0, 40.0, 600.0, "true")
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    """Empty database with the reading and rollup tables"""
+    path = str(tmp_path / "sensor_data.db")
+    conn = sensor_db.connect(path)
+    sensor_db.init_schema(conn)
+    init_rollup_tables(conn)
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def writer(db_file):
+    """Group-commit writer on db_file, stopped after the test"""
+    writer = GroupCommitWriter(db_file, max_rows=100, max_delay_ms=20)
+    yield writer
+    writer.stop(timeout=5)
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Flask test client of env_server on the scratch database"""
+    import env_server
+    env_server.init_database()
+    return env_server.app.test_client()
@@ -0,0 +1,146 @@
+"""Bucket aggregates, LTTB downsampling and gap filling of /query series"""
+
+import time
+
+import pytest
+
+import sensor_db
+from aggregate import _from_raw_rows, _from_raw_sql, aggregate_buckets, fill_series, lttb
+from conftest import BASE_TS, reading
+
+STEP = 60000
+
+
+def records(*points):
+    """{"ts", "temperature"} records from (minute, value) pairs"""
+    return [{"ts": minute * STEP, "temperature": value} for minute, value in points]
+
+
+def series(points, method):
+    return [(p["ts"] // STEP, p["temperature"], p["filled"])
+            for p in fill_series(records(*points), ["temperature"], STEP, method)]
+
+
+def readings_db(writer, db_file):
+    """Two devices, one reading a minute for three hours, temperatures cycling 0..9"""
+    rows = [reading(device, BASE_TS + m * STEP, float((m * 7 + offset) % 10))
+            for m in range(180) for offset, device in enumerate(("dev-a", "dev-b"))]
+    assert writer.submit(rows).result(timeout=5) == len(rows)
+    writer.stop(timeout=5)
+    return sensor_db.connect(db_file)
+
+
+def test_lttb_keeps_the_ends_and_the_peaks():
+    points = [(x, 1000.0 if x == 37 else float(x % 5), str(x)) for x in range(100)]
+    sampled = lttb(points, 10)
+    assert len(sampled) == 10
+    assert sampled[0] == points[0] and sampled[-1] == points[-1]
+    assert points[37] in sampled
+    assert [p[0] for p in sampled] == sorted(p[0] for p in sampled)
+
+
+def test_lttb_returns_short_series_unchanged():
+    points = [(x, float(x), str(x)) for x in range(5)]
+    assert lttb(points, 5) == points
+    assert lttb(points, 2) == points
+
+
+def test_rollup_buckets_match_the_raw_rows(writer, db_file):
+    conn = readings_db(writer, db_file)
+    try:
+        fns = ["avg", "min", "max", "sum", "count"]
+        for bucket in ("5m", "1h", "1d"):
+            for filters in ({}, {"device": "dev-b"}):
+                rollup = aggregate_buckets(conn, filters, bucket, ["temperature"], fns)
+                raw = list(_from_raw_sql(conn, filters, bucket, ["temperature"], fns))
+                assert len(rollup) == len(raw) > 0
+                for a, b in zip(rollup, raw):
+                    assert a == {k: pytest.approx(v) if isinstance(v, float) else v
+                                 for k, v in b.items()}
+    finally:
+        conn.close()
+
+
+def test_percentile_buckets_agree_with_the_rollups(writer, db_file):
+    conn = readings_db(writer, db_file)
+    try:
+        fns = ["avg", "min", "max", "count"]
+        rollup = aggregate_buckets(conn, {}, "1h", ["temperature"], fns)
+        with_percentiles = aggregate_buckets(conn, {}, "1h", ["temperature"],
+                                             fns + ["p0", "p50", "p99.9"])
+        raw = list(_from_raw_rows(conn, {}, "1h", ["temperature"], fns))
+    finally:
+        conn.close()
+
+    assert len(with_percentiles) == len(rollup) == len(raw)
+    for a, b in zip(with_percentiles, rollup):
+        assert a["time"] == b["time"] and a["count"] == b["count"]
+        for fn in fns:
+            assert a[f"temperature_{fn}"] == pytest.approx(b[f"temperature_{fn}"])
+        assert a["temperature_p0"] == a["temperature_min"]
+        assert a["temperature_p50"] <= a["temperature_p99.9"] <= a["temperature_max"]
+        # Every value 0..9 appears equally often in each full hour
+        assert a["count"] == 120
+        assert a["temperature_p50"] == 4.5
+
+
+def test_aggregate_endpoint(client):
+    now = int(time.time() * 1000) // STEP * STEP - 60 * STEP
+    readings = [{"device_id": "agg-q", "ts": now + m * STEP, "temperature": float(m % 4)}
+                for m in range(40)]
+    assert client.post("/sensor_data/batch?ack=commit", json=readings).status_code == 200
+
+    body = client.get("/aggregate?device=agg-q&bucket=1d&metrics=temperature"
+                      "&fn=avg,p50,count").get_json()
+    # The readings may straddle midnight, so check the day buckets together
+    assert sum(r["count"] for r in body["records"]) == 40
+    assert sum(r["temperature_avg"] * r["count"] for r in body["records"]) == 60.0
+    assert all(0.0 <= r["temperature_p50"] <= 3.0 for r in body["records"])
+
+    body = client.get("/aggregate?device=agg-q&mode=lttb&points=10&metrics=temperature").get_json()
+    assert len(body["series"]["temperature"]) == 10
+    assert client.get("/aggregate?device=agg-q&fn=p101").status_code == 400
+    assert client.get("/aggregate?device=agg-q&mode=lttb&points=2").status_code == 400
+
+
+def test_previous_carries_values_forward():
+    assert series([(0, 20.0), (3, 23.0)], "previous") == [
+        (0, 20.0, False), (1, 20.0, True), (2, 20.0, True), (3, 23.0, False)]
+
+
+def test_linear_interpolates_between_readings():
+    assert series([(0, 20.0), (3, 23.0)], "linear") == [
+        (0, 20.0, False), (1, 21.0, True), (2, 22.0, True), (3, 23.0, False)]
+
+
+def test_flagged_values_are_bridged_like_missing_readings():
+    # A None value (flagged as a spike) is interpolated over, but the point
+    # still had a reading so it isn't marked filled
+    assert series([(0, 20.0), (1, None), (2, 22.0)], "linear") == [
+        (0, 20.0, False), (1, 21.0, False), (2, 22.0, False)]
+
+
+def test_nothing_is_extrapolated():
+    assert series([(0, None), (1, 20.0), (2, None)], "linear") == [
+        (0, None, False), (1, 20.0, False), (2, None, False)]
+
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        list(fill_series(records((0, 20.0)), ["temperature"], STEP, "spline"))
+
+
+def test_query_fills_only_when_asked(client):
+    now = int(time.time() * 1000) // STEP * STEP
+    readings = [{"device_id": "fill-q", "ts": now - 10 * STEP, "temperature": 20.0},
+                {"device_id": "fill-q", "ts": now - 6 * STEP, "temperature": 24.0}]
+    client.post("/sensor_data/batch?ack=commit", json=readings)
+
+    stored = client.get("/query?device=fill-q").get_json()
+    assert [r["temperature"] for r in stored["records"]] == [20.0, 24.0]
+
+    for method, expected in (("previous", [20.0, 20.0, 20.0, 20.0, 24.0]),
+                             ("linear", [20.0, 21.0, 22.0, 23.0, 24.0])):
+        filled = client.get(f"/query?device=fill-q&fill={method}&step=60").get_json()
+        assert [r["temperature"] for r in filled["records"]] == expected
+        assert [r["filled"] for r in filled["records"]] == [False, True, True, True, False]
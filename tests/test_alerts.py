@@ -0,0 +1,101 @@
+"""Alert rules: hysteresis, clearing, re-firing and late readings"""
+
+from alerts import AlertEngine, RateRule, SilenceRule, ThresholdRule
+from conftest import BASE_TS
+
+MINUTE = 60000
+
+
+class ListSink:
+    def __init__(self):
+        self.events = []
+
+    def send(self, event):
+        self.events.append(event)
+
+
+def engine(rule):
+    sink = ListSink()
+    return AlertEngine([rule], [sink]), sink
+
+
+def co2(minute, value, device="dev-a"):
+    return {"device_id": device, "ts": BASE_TS + minute * MINUTE, "co2": value,
+            "humidity": None}
+
+
+def states(sink):
+    return [(event["state"], (event["ts"] - BASE_TS) // MINUTE) for event in sink.events]
+
+
+def test_threshold_fires_after_its_duration_and_clears_with_hysteresis():
+    alerts, sink = engine(ThresholdRule("co2_high", "co2", above=1200, clear=1100, duration=300))
+    values = [1250, 1300, 1150, 1300, 1300, 1300, 1300, 1300, 1250, 1150, 1050, 1000]
+    alerts.evaluate([co2(i, v) for i, v in enumerate(values)])
+
+    # Dipping under 1200 restarts the wait; above 1100 doesn't clear a firing alert
+    assert states(sink) == [("firing", 8), ("resolved", 10)]
+    assert alerts.active() == []
+
+
+def test_threshold_fires_again_after_resolving():
+    alerts, sink = engine(ThresholdRule("co2_high", "co2", above=1200, clear=1100))
+    alerts.evaluate([co2(i, v) for i, v in enumerate([1300, 1400, 1000, 1300])])
+
+    assert states(sink) == [("firing", 0), ("resolved", 2), ("firing", 3)]
+    assert [event["device"] for event in alerts.active()] == ["dev-a"]
+
+
+def test_threshold_below():
+    alerts, sink = engine(ThresholdRule("co2_low", "co2", below=400, clear=450))
+    alerts.evaluate([co2(i, v) for i, v in enumerate([500, 390, 420, 460])])
+
+    assert states(sink) == [("firing", 1), ("resolved", 3)]
+
+
+def test_rate_is_measured_over_its_window():
+    rule = RateRule("humidity_swing", "humidity", per_hour=15, clear_per_hour=10, window=600)
+    alerts, sink = engine(rule)
+    rows = [{"device_id": "dev-a", "ts": BASE_TS + i * MINUTE, "humidity": h}
+            for i, h in ((0, 40.0), (5, 45.0), (10, 44.0), (20, 45.0), (30, 46.0))]
+    alerts.evaluate(rows)
+
+    # 4 %/10 min = 24 %/h fires, 1 %/10 min = 6 %/h clears
+    assert states(sink) == [("firing", 10), ("resolved", 20)]
+    assert [event["value"] for event in sink.events] == [24.0, 6.0]
+
+
+def test_silence_fires_once_and_resolves_on_the_next_reading():
+    alerts, sink = engine(SilenceRule("device_silent", after=300))
+    alerts.evaluate([co2(0, 600)])
+    alerts.check_silence(BASE_TS + 4 * MINUTE)
+    alerts.check_silence(BASE_TS + 6 * MINUTE)
+    alerts.check_silence(BASE_TS + 7 * MINUTE)
+    alerts.evaluate([co2(8, 600)])
+
+    assert states(sink) == [("firing", 6), ("resolved", 8)]
+
+
+def test_silence_gap_seen_on_replay_fires_and_resolves():
+    alerts, sink = engine(SilenceRule("device_silent", after=300))
+    alerts.evaluate([co2(0, 600), co2(20, 600)])
+
+    assert states(sink) == [("firing", 5), ("resolved", 20)]
+
+
+def test_late_upload_does_not_make_a_device_look_silent():
+    alerts, sink = engine(SilenceRule("device_silent", after=300))
+    alerts.evaluate([co2(60, 600)])
+    # A buffered reading from an hour ago arrives after the live one
+    alerts.evaluate([co2(0, 600)])
+    alerts.check_silence(BASE_TS + 62 * MINUTE)
+
+    assert sink.events == []
+    assert alerts.skipped == 1
+
+
+def test_readings_of_one_commit_are_evaluated_in_time_order():
+    alerts, sink = engine(ThresholdRule("co2_high", "co2", above=1200, clear=1100, duration=120))
+    alerts.evaluate([co2(2, 1300), co2(0, 1300), co2(1, 1300), co2(3, 1000)])
+
+    assert states(sink) == [("firing", 2), ("resolved", 3)]
@@ -0,0 +1,73 @@
+"""Anomaly flags: spikes, gaps and the two ends of stuck runs"""
+
+import sensor_db
+from anomalies import STUCK_READINGS, AnomalyDetector, read_flags
+from conftest import BASE_TS, reading
+from rollups import FLAG_GAP, FLAG_SPIKE, FLAG_STUCK, METRICS
+
+MINUTE = 60000
+
+
+def record(i, temperature, ts=None):
+    """A reading with only a temperature, i minutes after BASE_TS"""
+    row = {m: None for m in METRICS}
+    row.update(device_id="dev-a", ts=BASE_TS + i * MINUTE if ts is None else ts,
+               temperature=temperature, calibrated="true")
+    return row
+
+
+def flags_by_minute(flags):
+    return {(ts - BASE_TS) // MINUTE: mask for _, ts, mask, _ in flags}
+
+
+def test_spike_is_flagged_once_the_window_is_full():
+    detector = AnomalyDetector()
+    rows = [record(i, 21.0 + 0.1 * (i % 2)) for i in range(20)]
+    rows += [record(20, 30.0), record(21, 21.0)]
+
+    flags = flags_by_minute(detector.check(rows))
+
+    assert flags == {20: FLAG_SPIKE["temperature"]}
+
+
+def test_late_reading_after_a_gap_is_flagged():
+    detector = AnomalyDetector()
+    rows = [record(i, 21.0 + 0.1 * (i % 2)) for i in range(10)]
+    rows.append(record(30, 21.0))
+
+    flags = detector.check(rows)
+
+    assert [(ts, mask, gap_ms) for _, ts, mask, gap_ms in flags] == [
+        (BASE_TS + 30 * MINUTE, FLAG_GAP, 21 * MINUTE)]
+
+
+def test_stuck_run_is_flagged_at_detection_and_at_its_end():
+    detector = AnomalyDetector()
+    run = STUCK_READINGS["temperature"] + 10
+    rows = [record(i, 21.0) for i in range(run)] + [record(run, 21.3)]
+
+    flags = flags_by_minute(detector.check(rows))
+
+    stuck = FLAG_STUCK["temperature"]
+    assert flags == {STUCK_READINGS["temperature"] - 1: stuck, run - 1: stuck}
+    assert detector.flagged["stuck"] == 1
+
+
+def test_run_end_is_merged_into_stored_flags(writer, db_file):
+    # The run's last reading already has a precal flag when a later
+    # transaction marks it as the end of the run
+    detector = AnomalyDetector()
+    writer.pre_commit.append(detector.flag)
+    rows = [reading("dev-s", BASE_TS + i * MINUTE, 21.0) for i in range(70)]
+    rows[-1] = rows[-1][:-1] + ("false",)
+    assert writer.submit(rows).result(timeout=5) == 70
+    assert writer.submit([reading("dev-s", BASE_TS + 70 * MINUTE, 21.4)]).result(timeout=5) == 1
+
+    conn = sensor_db.connect(db_file)
+    try:
+        flags = read_flags(conn, {"device": "dev-s"})
+    finally:
+        conn.close()
+    stuck = [flag for flag in flags if "stuck:temperature" in flag["flags"]]
+    assert [(flag["ts"] - BASE_TS) // MINUTE for flag in stuck] == [69, 59]
+    assert "precal" in stuck[0]["flags"]
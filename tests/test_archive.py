@@ -0,0 +1,90 @@
+"""Archive files: a closed month written out and read back unchanged"""
+
+import os
+
+import pytest
+
+import query_sensor_data
+import sensor_db
+from archive import ArchiveCursor, ArchiveFile, archive_month, archive_path, write_archive
+from conftest import BASE_TS
+
+MONTH = "2024-03"
+
+
+def month_rows():
+    """
+    Two devices sharing every timestamp, with NULLs, a column that is NULL
+    throughout, values needing 1, 2 or unlimited decimals and all three
+    calibrated states
+    """
+    rows = []
+    for i in range(200):
+        rows.append((
+            "dev-a" if i % 2 else "dev-b",
+            BASE_TS + (i // 2) * 60000,
+            round(20 + i * 0.1, 1),
+            None if i % 7 == 0 else 45.5,
+            1013.25 - i / 100,
+            50000 + i / 3,
+            None,
+            400.0 + i,
+            ("true", "false", None)[i % 3],
+        ))
+    return rows
+
+
+def stored(db_file):
+    conn = sensor_db.connect(db_file)
+    try:
+        return [tuple(row) for row in conn.execute(
+            f"SELECT {sensor_db.READING_COLUMNS} FROM sensor_readings ORDER BY ts, id")]
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def month_db(writer, db_file):
+    assert writer.submit(month_rows()).result(timeout=5) == 200
+    writer.stop(timeout=5)
+    return db_file
+
+
+def test_written_rows_read_back_unchanged(month_db, tmp_path):
+    source = stored(month_db)
+    path = str(tmp_path / "archive" / f"{MONTH}.sca")
+
+    assert write_archive(path, source) == len(source)
+    archive = ArchiveFile(path)
+    try:
+        assert len(archive) == len(source)
+        # gas needs more than MAX_DECIMALS and is kept as doubles
+        assert archive.header["scales"]["gas"] is None
+        assert archive.header["scales"]["temperature"] == 10
+    finally:
+        archive.close()
+
+    cursor = ArchiveCursor(path, {})
+    try:
+        assert [tuple(row) for row in cursor.fetchall()] == source
+    finally:
+        cursor.close()
+
+
+def test_archived_month_replaces_its_raw_rows(month_db, monkeypatch):
+    monkeypatch.setattr(query_sensor_data, "DB_FILE", month_db)
+    source = stored(month_db)
+
+    assert archive_month(month_db, MONTH) == len(source)
+    assert stored(month_db) == []
+    assert os.path.exists(archive_path(month_db, MONTH))
+
+    # Reads merge the archive back in, in (ts, id) order
+    rows = [tuple(row) for row in query_sensor_data.open_readings({}).fetchall()]
+    assert rows == source
+
+    cursor = ArchiveCursor(archive_path(month_db, MONTH), {"device": "dev-a"})
+    try:
+        assert [tuple(row) for row in cursor.fetchall()] == [r for r in source if r[1] == "dev-a"]
+    finally:
+        cursor.close()
@@ -0,0 +1,58 @@
+"""Bulk import of readings that share a minute-resolution time"""
+
+import csv
+
+import sensor_db
+from bulk_import import Importer, read_csv
+
+# Legacy export rows timed to the minute: two readings of 12:00 differ,
+# one is an exact copy of the first
+ROWS = [
+    ("dev-a", "2024-03-01 12:00", 20.0, 40.0),
+    ("dev-a", "2024-03-01 12:00", 20.5, 41.0),
+    ("dev-a", "2024-03-01 12:00", 20.0, 40.0),
+    ("dev-a", "2024-03-01 12:01", 21.0, 42.0),
+    ("dev-a", "2024-03-01 12:00", 20.7, 41.0),
+]
+
+
+def write_csv(path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["device_id", "time", "temperature", "humidity"])
+        writer.writerows(ROWS)
+
+
+def import_csv(db_file, path, batch):
+    importer = Importer(db_file, batch)
+    try:
+        importer.import_records(read_csv(path))
+    finally:
+        importer.finish()
+    return importer.stats
+
+
+def stored_temperatures(db_file):
+    conn = sensor_db.connect(db_file)
+    try:
+        return [tuple(row) for row in conn.execute(
+            "SELECT ts, temperature FROM sensor_readings ORDER BY ts")]
+    finally:
+        conn.close()
+
+
+def test_readings_sharing_a_minute_are_moved_apart(db_file, tmp_path):
+    path = str(tmp_path / "legacy.csv")
+    write_csv(path)
+
+    stats = import_csv(db_file, path, batch=2)
+    assert (stats["stored"], stats["duplicates"], stats["moved"]) == (4, 1, 2)
+    rows = stored_temperatures(db_file)
+    minute = rows[0][0]
+    assert rows == [(minute, 20.0), (minute + 1, 20.5), (minute + 2, 20.7),
+                    (minute + 60000, 21.0)]
+
+    # Importing the file again finds every reading already stored
+    stats = import_csv(db_file, path, batch=2)
+    assert (stats["stored"], stats["duplicates"], stats["moved"]) == (0, 5, 0)
+    assert stored_temperatures(db_file) == rows
@@ -0,0 +1,90 @@
+"""Federated reads: k-way merge and paging across shard files"""
+
+from datetime import datetime
+
+import pytest
+
+import federated
+import query_sensor_data
+import sensor_db
+from conftest import reading
+from sensor_db import order_key, to_epoch_ms
+
+# Five minutes either side of a month boundary, so month shards split them
+START = to_epoch_ms(datetime(2024, 3, 31, 23, 57))
+DEVICES = ("dev-a", "dev-b", "dev-c")
+
+
+@pytest.fixture(params=["device", "month"])
+def sharded_db(request, writer, db_file, monkeypatch):
+    """Three devices reporting at the same instants, one shard per device or month"""
+    monkeypatch.setattr(sensor_db, "SHARD_BY", request.param)
+    monkeypatch.setattr(query_sensor_data, "DB_FILE", db_file)
+    # Small chunks, so every source is refilled while the merge runs
+    monkeypatch.setattr(federated, "CHUNK_ROWS", 2)
+    rows = [reading(device, START + m * 60000, 20.0 + i)
+            for m in range(6) for i, device in enumerate(DEVICES)]
+    assert writer.submit(rows).result(timeout=5) == len(rows)
+    return db_file
+
+
+def keys(rows):
+    return [(row["ts"], row["device_id"]) for row in rows]
+
+
+def test_merge_orders_equal_timestamps_across_files(sharded_db):
+    files = federated.query_files(sharded_db, {})
+    assert len(files) >= 2
+
+    cursor = federated.open_federated(sharded_db, files, f"SELECT {sensor_db.READING_COLUMNS} "
+                                      "FROM sensor_readings ORDER BY ts, id", [])
+    try:
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    assert len(rows) == 6 * len(DEVICES)
+    assert [order_key(row) for row in rows] == sorted(order_key(row) for row in rows)
+    # Ties on ts come out once each, ordered by id and then device
+    assert keys(rows) == [(START + m * 60000, device) for m in range(6) for device in DEVICES]
+
+
+def test_files_are_pruned_by_device(sharded_db):
+    if sensor_db.SHARD_BY != "device":
+        pytest.skip("month shards hold every device")
+    assert len(federated.query_files(sharded_db, {"device": "dev-b"})) == 1
+    rows = query_sensor_data.open_readings({"device": "dev-b"}).fetchall()
+    assert {row["device_id"] for row in rows} == {"dev-b"}
+    assert len(rows) == 6
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 4, 7])
+def test_pages_resume_across_files(sharded_db, page_size):
+    expected = keys(query_sensor_data.open_readings({}).fetchall())
+    assert len(expected) == 6 * len(DEVICES)
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = query_sensor_data.query_page({}, page_size, cursor)
+        seen += keys(rows)
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_latest_and_recent_merge_every_file(sharded_db):
+    everything = sorted(query_sensor_data.open_readings({}).fetchall(), key=order_key,
+                        reverse=True)
+
+    latest = query_sensor_data.get_latest_reading()
+    assert order_key(latest) == order_key(everything[0])
+    assert query_sensor_data.get_latest_reading("dev-a")["device_id"] == "dev-a"
+
+    recent = query_sensor_data.get_recent_readings(5)
+    assert [order_key(row) for row in recent] == [order_key(row) for row in everything[:5]]
+
+    stats = query_sensor_data.database_stats()
+    assert stats["count"] == len(everything)
+    assert (stats["first_ts"], stats["last_ts"]) == (START, START + 5 * 60000)
+    assert stats["temperature"]["min"] == 20.0
+    assert stats["temperature"]["max"] == 22.0
@@ -0,0 +1,166 @@
+"""Ingest: duplicate readings and group-commit futures"""
+
+import asyncio
+import json
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+import sensor_db
+from conftest import BASE_TS, reading
+
+
+def stored_count(db_file, device_id):
+    conn = sensor_db.connect(db_file)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM sensor_readings WHERE device_id = ?",
+                            (device_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_resent_batch_is_stored_once(writer, db_file):
+    rows = [reading("dev-a", BASE_TS + i * 60000) for i in range(5)]
+    assert writer.submit(rows).result(timeout=5) == 5
+    assert writer.submit(rows).result(timeout=5) == 0
+    assert writer.duplicates == 5
+    assert stored_count(db_file, "dev-a") == 5
+
+
+def test_repeats_within_one_submission_are_stored_once(writer, db_file):
+    row = reading("dev-a", BASE_TS)
+    assert writer.submit([row, row, reading("dev-b", BASE_TS)]).result(timeout=5) == 2
+    assert stored_count(db_file, "dev-a") == 1
+
+
+def test_resent_batch_reports_duplicates(client):
+    now = int(time.time() * 1000)
+    readings = [{"device_id": "dup-http", "ts": now - i * 60000, "temperature": 20.0 + i}
+                for i in range(3)]
+    body = json.dumps(readings)
+
+    first = client.post("/sensor_data/batch?ack=commit", data=body,
+                        content_type="application/json").get_json()
+    second = client.post("/sensor_data/batch?ack=commit", data=body,
+                         content_type="application/json").get_json()
+
+    assert (first["stored"], first["duplicates"]) == (3, 0)
+    assert (second["stored"], second["duplicates"]) == (0, 3)
+    assert stored_count(sensor_db.DB_FILE, "dup-http") == 3
+
+
+def test_bad_row_does_not_reject_its_batch(client):
+    now = int(time.time() * 1000)
+    readings = [{"device_id": "bad-row", "ts": now, "temperature": 20.0},
+                {"device_id": "bad-row", "ts": 1000, "temperature": 20.0}]
+    response = client.post("/sensor_data/batch?ack=commit", data=json.dumps(readings),
+                           content_type="application/json")
+
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result["stored"] == 1
+    assert [r["index"] for r in result["rejected"]] == [1]
+
+
+def test_future_resolves_after_ack_timeout(writer):
+    # Slow flushes: the awaiting side gives up long before the commit
+    writer.max_delay = 0.3
+    future = writer.submit([reading("dev-t", BASE_TS)])
+
+    async def wait():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), 0.01)
+
+    asyncio.run(wait())
+    assert future.result(timeout=5) == 1
+    assert writer.submit([reading("dev-t", BASE_TS + 60000)]).result(timeout=5) == 1
+
+
+def test_cancelled_future_does_not_stop_the_writer(writer, db_file):
+    writer.max_delay = 0.3
+    cancelled = writer.submit([reading("dev-c", BASE_TS)])
+    assert cancelled.cancel()
+
+    later = writer.submit([reading("dev-c", BASE_TS + 60000)])
+    assert later.result(timeout=5) == 1
+    with pytest.raises(CancelledError):
+        cancelled.result()
+    # Rows of a cancelled submission are still written
+    assert stored_count(db_file, "dev-c") == 2
+    assert writer._thread.is_alive()
+
+
+def test_failed_flush_fails_its_futures_only(writer, monkeypatch):
+    flush = writer._flush
+    calls = []
+
+    def failing_once(batch):
+        if not calls:
+            calls.append(batch)
+            raise RuntimeError("disk on fire")
+        flush(batch)
+
+    monkeypatch.setattr(writer, "_flush", failing_once)
+    with pytest.raises(RuntimeError):
+        writer.submit([reading("dev-f", BASE_TS)]).result(timeout=5)
+    assert writer.submit([reading("dev-f", BASE_TS + 60000)]).result(timeout=5) == 1
+
+
+def test_reading_without_device_is_stored_as_default(client):
+    now = int(time.time() * 1000)
+    response = client.post("/sensor_data/batch?ack=commit",
+                           data=json.dumps([{"ts": now, "temperature": 20.0}]),
+                           content_type="application/json",
+                           environ_base={"REMOTE_ADDR": "192.0.2.7"})
+
+    assert response.get_json()["stored"] == 1
+    assert stored_count(sensor_db.DB_FILE, "192.0.2.7") == 0
+    assert stored_count(sensor_db.DB_FILE, sensor_db.DEFAULT_DEVICE) >= 1
+
+
+def test_batch_readings_without_time_are_rejected(client):
+    readings = [{"device_id": "no-ts", "temperature": 20.0 + i} for i in range(5)]
+    bodies = [(json.dumps(readings), "application/json", 5),
+              ("\n".join(json.dumps(r) for r in readings[:3]), "application/x-ndjson", 3)]
+    for body, content_type, count in bodies:
+        result = client.post("/sensor_data/batch?ack=commit", data=body,
+                             content_type=content_type).get_json()
+        assert (result["stored"], result["duplicates"]) == (0, 0)
+        assert [r["index"] for r in result["rejected"]] == list(range(count))
+    assert stored_count(sensor_db.DB_FILE, "no-ts") == 0
+
+
+def test_readings_without_time_get_distinct_stamps(client):
+    import env_server
+    received_ms = int(time.time() * 1000)
+    rows = [env_server.parse_reading({"temperature": 20.0}, "no-ts-single", received_ms)
+            for _ in range(3)]
+    assert [row[1] for row in rows] == [received_ms, received_ms + 1, received_ms + 2]
+
+
+def test_failing_pre_commit_hook_fails_the_flush(writer, db_file):
+    def failing(conn, rows):
+        raise RuntimeError("flags not written")
+
+    writer.pre_commit.append(failing)
+    with pytest.raises(RuntimeError):
+        writer.submit([reading("dev-h", BASE_TS)]).result(timeout=5)
+    assert stored_count(db_file, "dev-h") == 0
+
+    writer.pre_commit.remove(failing)
+    assert writer.submit([reading("dev-h", BASE_TS)]).result(timeout=5) == 1
+
+
+def test_backfill_within_the_age_limit_is_accepted(client):
+    import env_server
+    now = int(time.time() * 1000)
+    oldest = now - env_server.MAX_READING_AGE_DAYS * 86400000
+    readings = [{"device_id": "backfill", "ts": ts, "temperature": 20.0}
+                for ts in (now - 3 * 86400000, oldest + 60000, oldest - 60000)]
+    result = client.post("/sensor_data/batch?ack=commit", data=json.dumps(readings),
+                         content_type="application/json").get_json()
+
+    assert result["stored"] == 2
+    assert [r["index"] for r in result["rejected"]] == [2]
+    assert "bulk_import.py" in result["rejected"][0]["message"]
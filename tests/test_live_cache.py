@@ -0,0 +1,67 @@
+"""Live cache: per-device ring buffers and when they may answer a read"""
+
+from conftest import BASE_TS
+from live_cache import LiveCache
+
+MINUTE = 60000
+
+
+def record(device, minute, id=None):
+    return {"id": minute + 1 if id is None else id, "device_id": device,
+            "ts": BASE_TS + minute * MINUTE, "temperature": 20.0 + minute}
+
+
+def minutes(records):
+    return [(r["ts"] - BASE_TS) // MINUTE for r in records]
+
+
+def test_full_ring_evicts_the_oldest_readings():
+    cache = LiveCache(ring_size=3)
+    cache.prime(0, [], BASE_TS)
+    cache.add([record("dev-a", m) for m in range(5)])
+
+    assert minutes(cache.recent(3, "dev-a")) == [4, 3, 2]
+    assert cache.stats()["buffered"] == 3
+    assert cache.count() == 5
+    # Evicted readings can't be served any more, the ring start can
+    assert cache.since(BASE_TS, "dev-a") is None
+    assert minutes(cache.since(BASE_TS + 2 * MINUTE, "dev-a")) == [2, 3, 4]
+
+
+def test_recent_short_of_the_limit_misses_once_the_ring_is_full():
+    cache = LiveCache(ring_size=3)
+    cache.prime(0, [], 0)
+    cache.add([record("dev-a", m) for m in range(2)])
+    assert minutes(cache.recent(5, "dev-a")) == [1, 0]
+
+    cache.add([record("dev-a", m) for m in range(2, 4)])
+    assert cache.recent(5, "dev-a") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_late_readings_are_placed_in_time_order():
+    cache = LiveCache(ring_size=4)
+    cache.prime(0, [], BASE_TS)
+    cache.add([record("dev-a", m) for m in (1, 3, 5, 7)])
+
+    # Inside the ring: inserted in place, pushing the oldest out
+    cache.add([record("dev-a", 4, id=9)])
+    assert minutes(cache.since(BASE_TS + 3 * MINUTE, "dev-a")) == [3, 4, 5, 7]
+    # Older than a full ring: dropped like an evicted reading
+    cache.add([record("dev-a", 0, id=10)])
+    assert minutes(cache.recent(4, "dev-a")[::-1]) == [3, 4, 5, 7]
+    # The latest reading is still the newest, not the last added
+    assert minutes([cache.latest("dev-a")]) == [7]
+
+
+def test_rings_are_kept_per_device():
+    cache = LiveCache(ring_size=2)
+    cache.prime(0, [], BASE_TS)
+    cache.add([record("dev-a", m) for m in range(4)] + [record("dev-b", 1, id=20)])
+
+    assert minutes(cache.recent(1, "dev-b")) == [1]
+    assert [(r["device_id"], r["id"]) for r in cache.recent(3)] == [
+        ("dev-a", 4), ("dev-a", 3), ("dev-b", 20)]
+    # dev-a lost minutes 0 and 1, so a merged read from BASE_TS misses
+    assert cache.since(BASE_TS) is None
+    assert cache.stats()["devices"] == 2
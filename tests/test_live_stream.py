@@ -0,0 +1,89 @@
+"""Live stream: fan-out of committed readings and cleanup of gone subscribers"""
+
+import env_server
+from conftest import BASE_TS, reading
+from live_stream import Broadcaster, Subscription, sse_event
+
+
+def record(device, i, temperature=20.0):
+    return {"id": i, "device_id": device, "ts": BASE_TS + i * 1000, "time": None,
+            "temperature": temperature, "co2": 600.0}
+
+
+def test_publish_fans_out_to_every_matching_subscriber():
+    broadcaster = Broadcaster()
+    everything = broadcaster.subscribe()
+    only_b = broadcaster.subscribe(device="dev-b", metrics=["co2"])
+
+    broadcaster.publish([record("dev-a", 1), record("dev-b", 2)])
+
+    assert [r["id"] for r in everything.take()] == [1, 2]
+    assert only_b.take() == [{"id": 2, "device_id": "dev-b", "ts": BASE_TS + 2000,
+                              "time": None, "co2": 600.0}]
+    assert broadcaster.published == 2
+
+
+def test_interval_keeps_the_newest_reading_per_device():
+    subscription = Broadcaster().subscribe(interval=60)
+    subscription.offer([record("dev-a", 1), record("dev-b", 2), record("dev-a", 3)])
+    assert [r["id"] for r in subscription.take()] == [2, 3]
+    subscription.offer([record("dev-a", 4)])
+    # Not due again for another interval
+    assert subscription.take() == []
+    assert subscription.pending()
+
+
+def test_slow_subscriber_drops_the_oldest_readings():
+    subscription = Subscription(queue_size=3)
+    subscription.offer([record("dev-a", i) for i in range(5)])
+    assert [r["id"] for r in subscription.take()] == [2, 3, 4]
+    assert subscription.dropped == 2
+
+
+def test_subscriber_limit():
+    broadcaster = Broadcaster(max_subscribers=1)
+    first = broadcaster.subscribe()
+    assert broadcaster.subscribe() is None
+    broadcaster.unsubscribe(first)
+    assert broadcaster.subscribe() is not None
+
+
+def test_committed_readings_reach_a_waiting_subscriber(writer):
+    broadcaster = Broadcaster()
+    writer.listeners.append(broadcaster.publish)
+    subscription = broadcaster.subscribe(device="dev-a")
+
+    writer.submit([reading("dev-a", BASE_TS), reading("dev-b", BASE_TS)]).result(timeout=5)
+
+    records = subscription.wait(2)
+    assert [(r["device_id"], r["ts"]) for r in records] == [("dev-a", BASE_TS)]
+    assert records[0]["id"] is not None
+
+
+def test_close_wakes_waiting_subscribers():
+    broadcaster = Broadcaster()
+    subscription = broadcaster.subscribe()
+    broadcaster.close()
+    assert subscription.wait(5) == []
+    assert subscription.closed
+
+
+def test_disconnected_stream_unsubscribes():
+    before = env_server.broadcaster.subscribers()
+    subscription = env_server.broadcaster.subscribe(device="sse-test")
+    assert env_server.broadcaster.subscribers() == before + 1
+
+    events = env_server.iter_sse(subscription)
+    subscription.offer([record("sse-test", 1)])
+    assert next(events) == sse_event(record("sse-test", 1))
+
+    # The server closes the generator when the client goes away
+    events.close()
+    assert env_server.broadcaster.subscribers() == before
+    env_server.broadcaster.publish([record("sse-test", 2)])
+    assert subscription.take() == []
+
+
+def test_stream_rejects_bad_arguments(client):
+    assert client.get("/stream?interval=-1").status_code == 400
+    assert client.get("/stream?metrics=nope").status_code == 400
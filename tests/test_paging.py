@@ -0,0 +1,56 @@
+"""Keyset pagination over readings that share a timestamp"""
+
+import pytest
+
+import query_sensor_data
+import sensor_db
+from conftest import BASE_TS, reading
+
+
+@pytest.fixture(params=[None, "device"])
+def readings_db(request, writer, db_file, monkeypatch):
+    """
+    Four devices reporting at the same five instants, in one file or one
+    shard file per device (where ids repeat across files)
+    """
+    monkeypatch.setattr(sensor_db, "SHARD_BY", request.param)
+    monkeypatch.setattr(query_sensor_data, "DB_FILE", db_file)
+    rows = [reading(f"dev-{d}", BASE_TS + t * 60000, 20.0 + d)
+            for t in range(5) for d in range(4)]
+    assert writer.submit(rows).result(timeout=5) == len(rows)
+    return db_file
+
+
+def keys(rows):
+    return [(row["device_id"], row["ts"]) for row in rows]
+
+
+@pytest.mark.parametrize("page_size", [1, 3, 4, 7, 20])
+def test_pages_cover_ties_once(readings_db, page_size):
+    expected = keys(query_sensor_data.open_readings({}).fetchall())
+    assert len(expected) == 20
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = query_sensor_data.query_page({}, page_size, cursor)
+        assert len(rows) <= page_size
+        seen += keys(rows)
+        if cursor is None:
+            break
+
+    assert seen == expected
+    assert len(set(seen)) == len(seen)
+
+
+def test_page_ending_on_a_tie_resumes_inside_it(readings_db):
+    # Three of the four readings at BASE_TS
+    rows, cursor = query_sensor_data.query_page({}, 3)
+    assert {row["ts"] for row in rows} == {BASE_TS}
+
+    rows, _ = query_sensor_data.query_page({}, 2, cursor)
+    assert [row["ts"] for row in rows] == [BASE_TS, BASE_TS + 60000]
+
+
+def test_invalid_cursor_is_rejected(readings_db):
+    with pytest.raises(ValueError):
+        query_sensor_data.query_page({}, 3, "not-a-cursor")
@@ -0,0 +1,107 @@
+"""Query result cache: byte cap, invalidation by commits and ETags"""
+
+import time
+
+from query_cache import INVALIDATION_LOG, QueryCache, cache_key
+
+# A range that ended long ago: cached without a TTL
+PAST = {"device": "dev-a", "start_date": "2024-03-01", "end_date": "2024-03-01"}
+MARCH_1 = 1709294400000  # 2024-03-01 12:00 UTC
+
+
+def put(cache, name, size=10, filters=PAST, token=None):
+    key = cache_key("/query", {**filters, "name": name})
+    token = cache.token() if token is None else token
+    return key, cache.put(key, b"x" * size, "application/json", filters, token)
+
+
+def test_byte_cap_evicts_least_recently_used():
+    cache = QueryCache(max_bytes=30)
+    a, _ = put(cache, "a")
+    b, _ = put(cache, "b")
+    c, _ = put(cache, "c")
+    assert cache.get(a) is not None
+
+    d, _ = put(cache, "d")
+
+    assert cache.get(b) is None
+    assert all(cache.get(key) is not None for key in (a, c, d))
+    assert cache.size == 30
+    assert cache.evictions == 1
+
+
+def test_oversized_body_is_not_cached():
+    cache = QueryCache(max_bytes=100, max_entry_bytes=20)
+    key, entry = put(cache, "big", size=21)
+    assert entry is None
+    assert cache.get(key) is None
+    assert cache.size == 0
+
+
+def test_commit_drops_only_covering_entries():
+    cache = QueryCache()
+    march, _ = put(cache, "march")
+    other_device, _ = put(cache, "b", filters={**PAST, "device": "dev-b"})
+    april, _ = put(cache, "april", filters={**PAST, "start_date": "2024-04-01",
+                                             "end_date": "2024-04-01"})
+
+    cache.invalidate([{"device_id": "dev-a", "ts": MARCH_1}])
+
+    assert cache.get(march) is None
+    assert cache.get(other_device) is not None
+    assert cache.get(april) is not None
+
+
+def test_result_racing_a_commit_is_not_cached():
+    cache = QueryCache()
+    token = cache.token()
+    # A commit lands while the query runs
+    cache.invalidate([{"device_id": "dev-a", "ts": MARCH_1}])
+
+    key, entry = put(cache, "raced", token=token)
+    assert entry is None
+    assert cache.get(key) is None
+
+    # A commit elsewhere doesn't keep the result out
+    token = cache.token()
+    cache.invalidate([{"device_id": "dev-b", "ts": MARCH_1}])
+    assert put(cache, "unrelated", token=token)[1] is not None
+
+
+def test_token_older_than_the_log_is_refused():
+    cache = QueryCache()
+    token = cache.token()
+    for i in range(INVALIDATION_LOG + 1):
+        cache.invalidate([{"device_id": "dev-z", "ts": i}])
+    assert put(cache, "old", token=token)[1] is None
+
+
+def test_clear_refuses_results_started_before_it():
+    cache = QueryCache()
+    key, _ = put(cache, "a")
+    token = cache.token()
+    cache.clear()
+    assert cache.get(key) is None
+    assert put(cache, "b", token=token)[1] is None
+
+
+def test_query_etag_and_not_modified(client):
+    def post(temperature):
+        reading = {"device_id": "etag", "ts": int(time.time() * 1000), "temperature": temperature}
+        assert client.post("/sensor_data/batch?ack=commit", json=[reading]).status_code == 200
+
+    post(20.0)
+    first = client.get("/query?device=etag")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+
+    again = client.get("/query?device=etag", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+    time.sleep(0.002)
+    post(21.0)
+    changed = client.get("/query?device=etag", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.get_json()["count"] == 2
@@ -0,0 +1,114 @@
+"""Retention: compaction into rollup tiers and reading across the raw/tier boundary"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import query_sensor_data
+import sensor_db
+from conftest import BASE_TS, reading
+from retention import RETENTION_DAYS, build_tiered_query, compact
+from rollups import read_cutoffs
+
+HOUR = 3600000
+DAYS = 40
+DEVICES = ("dev-a", "dev-b")
+
+# Compaction runs DAYS days after the first reading
+NOW = datetime.fromtimestamp(BASE_TS / 1000) + timedelta(days=DAYS)
+
+
+@pytest.fixture
+def compacted_db(writer, db_file, monkeypatch):
+    """Hourly readings of two devices over DAYS days, compacted once"""
+    monkeypatch.setattr(query_sensor_data, "DB_FILE", db_file)
+    rows = [reading(device, BASE_TS + h * HOUR, 20.0 + (h % 10) / 10)
+            for h in range(DAYS * 24) for device in DEVICES]
+    assert writer.submit(rows).result(timeout=10) == len(rows)
+    writer.stop(timeout=5)
+
+    conn = sensor_db.connect(db_file)
+    try:
+        result = compact(conn, NOW, pause=0)
+    finally:
+        conn.close()
+    return db_file, result
+
+
+def raw_cutoff(db_file):
+    conn = sensor_db.connect(db_file)
+    try:
+        return read_cutoffs(conn)["raw"]
+    finally:
+        conn.close()
+
+
+def day(ts):
+    return datetime.fromtimestamp(ts / 1000).strftime("%Y-%m-%d")
+
+
+def all_rows():
+    return query_sensor_data.open_readings({}).fetchall()
+
+
+def test_compact_moves_old_readings_to_the_tiers(compacted_db):
+    db_file, result = compacted_db
+    cutoff = raw_cutoff(db_file)
+    older = sum(1 for h in range(DAYS * 24) if BASE_TS + h * HOUR < cutoff) * len(DEVICES)
+    assert cutoff == sensor_db.to_epoch_ms(
+        (NOW - timedelta(days=RETENTION_DAYS["raw"])).replace(hour=0))
+    assert result["raw"] == older > 0
+
+    rows = all_rows()
+    # One 5-minute bucket per hourly reading, so nothing is lost or doubled
+    assert len(rows) == DAYS * 24 * len(DEVICES)
+    assert all(row["id"] is None for row in rows if row["ts"] < cutoff)
+    assert all(row["id"] is not None for row in rows if row["ts"] >= cutoff)
+    keys = [(row["ts"], row["id"] or 0, row["device_id"]) for row in rows]
+    assert keys == sorted(keys)
+    assert [row["temperature"] for row in rows[:4]] == [20.0, 20.0, 20.1, 20.1]
+
+
+def test_compact_is_idempotent(compacted_db):
+    db_file, _ = compacted_db
+    before = all_rows()
+    conn = sensor_db.connect(db_file)
+    try:
+        cutoffs = read_cutoffs(conn)
+        again = compact(conn, NOW, pause=0)
+        assert read_cutoffs(conn) == cutoffs
+    finally:
+        conn.close()
+
+    assert (again["raw"], again["5m"]) == (0, 0)
+    assert [tuple(row) for row in all_rows()] == [tuple(row) for row in before]
+
+
+@pytest.mark.parametrize("page_size", [1, 5, 48, 100])
+def test_pages_continue_across_the_tier_boundary(compacted_db, page_size):
+    db_file, _ = compacted_db
+    cutoff = raw_cutoff(db_file)
+    # The last day served from the 5m tier and the first raw day
+    filters = {"start_date": day(cutoff - 24 * HOUR), "end_date": day(cutoff)}
+    expected = [(row["ts"], row["device_id"])
+                for row in query_sensor_data.open_readings(filters).fetchall()]
+    assert len(expected) == 48 * len(DEVICES)
+    assert expected[0][0] < cutoff <= expected[-1][0]
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = query_sensor_data.query_page(filters, page_size, cursor)
+        seen += [(row["ts"], row["device_id"]) for row in rows]
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_ranges_inside_the_raw_window_skip_the_tiers(compacted_db):
+    db_file, _ = compacted_db
+    cutoff = raw_cutoff(db_file)
+    filters = {"start_date": day(cutoff)}
+    query_sql, _ = build_tiered_query(filters, cutoffs={"raw": cutoff})
+    assert "UNION ALL" not in query_sql
+    query_sql, _ = build_tiered_query({}, cutoffs={"raw": cutoff})
+    assert "UNION ALL" in query_sql
@@ -0,0 +1,120 @@
+"""Numbered device uploads: sequence claims, compressed and compact bodies"""
+
+import gzip
+import json
+import time
+import zlib
+
+import pytest
+
+import env_server
+import sensor_db
+from env_server import decode_body, parse_batch
+from uploads import SequenceTracker
+
+
+def test_claim_accepts_each_seq_once_per_boot():
+    tracker = SequenceTracker()
+    assert tracker.claim("dev-a", "boot-1", 1) == ("", -1)
+    assert tracker.claim("dev-a", "boot-1", 1) is None
+    assert tracker.claim("dev-a", "boot-1", 0) is None
+    assert tracker.claim("dev-a", "boot-1", 2) == ("boot-1", 1)
+    # Other devices count on their own
+    assert tracker.claim("dev-b", "boot-1", 1) == ("", -1)
+
+
+def test_new_boot_resets_the_sequence():
+    tracker = SequenceTracker()
+    tracker.claim("dev-a", "boot-1", 50)
+    assert tracker.claim("dev-a", "boot-2", 0) == ("boot-1", 50)
+    assert tracker.claim("dev-a", "boot-2", 0) is None
+
+
+def test_release_lets_a_failed_batch_be_retried():
+    tracker = SequenceTracker()
+    tracker.claim("dev-a", "boot-1", 1)
+    previous = tracker.claim("dev-a", "boot-1", 2)
+    tracker.release("dev-a", "boot-1", 2, previous)
+    assert tracker.claim("dev-a", "boot-1", 2) == ("boot-1", 1)
+
+
+def test_release_keeps_a_later_claim():
+    tracker = SequenceTracker()
+    previous = tracker.claim("dev-a", "boot-1", 1)
+    tracker.claim("dev-a", "boot-1", 2)
+    tracker.release("dev-a", "boot-1", 1, previous)
+    assert tracker.claim("dev-a", "boot-1", 2) is None
+
+
+def test_committed_sequences_survive_a_restart(db_file):
+    conn = sensor_db.connect(db_file)
+    try:
+        tracker = SequenceTracker()
+        tracker.load(conn)
+        tracker.claim("dev-a", "boot-1", 7)
+        tracker.committed(conn, "dev-a", "boot-1", 7)
+        # A stale commit doesn't move the stored seq back
+        tracker.committed(conn, "dev-a", "boot-1", 3)
+
+        restarted = SequenceTracker()
+        restarted.load(conn)
+    finally:
+        conn.close()
+    assert restarted.claim("dev-a", "boot-1", 7) is None
+    assert restarted.claim("dev-a", "boot-1", 8) == ("boot-1", 7)
+
+
+def test_decode_body():
+    body = b'[{"temperature": 20.0}]'
+    assert decode_body(body, None) == body
+    assert decode_body(gzip.compress(body), "gzip") == body
+    assert decode_body(zlib.compress(body), "Deflate") == body
+    with pytest.raises(ValueError):
+        decode_body(body, "br")
+    with pytest.raises(ValueError):
+        decode_body(gzip.compress(b" " * (env_server.MAX_BATCH_BYTES + 1)), "gzip")
+
+
+def test_parse_batch_forms():
+    readings = [{"ts": 1, "temperature": 20.0}, {"ts": 2, "temperature": 21.0}]
+    assert parse_batch(json.dumps(readings), "application/json") == (readings, {})
+    ndjson = "\n".join(json.dumps(r) for r in readings) + "\n\n"
+    assert parse_batch(ndjson, "application/x-ndjson") == (readings, {})
+
+    upload = {"device_id": "dev-a", "boot": "b", "seq": 3,
+              "fields": ["ts", "temperature"], "rows": [[1, 20.0], [2, 21.0]]}
+    parsed, meta = parse_batch(json.dumps(upload), "application/json")
+    assert parsed == readings
+    assert meta["seq"] == 3
+    plain = {"device_id": "dev-a", "boot": "b", "seq": 3, "readings": readings}
+    assert parse_batch(json.dumps(plain), "application/json") == (readings, plain)
+
+    with pytest.raises(ValueError):
+        parse_batch(json.dumps({"temperature": 20.0}), "application/json")
+
+
+def post_upload(client, seq, boot="boot-1", age_ms=(3000, 2000, 1000)):
+    upload = {"device_id": "upload-dev", "boot": boot, "seq": seq,
+              "fields": ["age_ms", "temperature"], "rows": [[age, 20.0] for age in age_ms]}
+    return client.post("/sensor_data/batch", data=gzip.compress(json.dumps(upload).encode()),
+                       headers={"Content-Encoding": "gzip"}, content_type="application/json")
+
+
+def test_failed_write_releases_the_sequence(client, monkeypatch):
+    def fail(rows):
+        raise RuntimeError("disk full")
+
+    boot = f"boot-{time.time()}"
+    with monkeypatch.context() as patch:
+        patch.setattr(env_server.writer, "submit", fail)
+        assert post_upload(client, 1, boot).status_code == 400
+
+    retried = post_upload(client, 1, boot)
+    assert retried.status_code == 200
+    assert retried.get_json()["stored"] == 3
+
+    resent = post_upload(client, 1, boot)
+    assert resent.get_json()["status"] == "duplicate"
+    # A reboot starts numbering again
+    rebooted = post_upload(client, 1, boot + "-2", age_ms=(500,))
+    assert rebooted.get_json()["status"] == "success"
@@ -0,0 +1,89 @@
+"""
+Sequence numbers for buffered batch uploads
+A device numbers its batches (seq) within one boot (boot id) and resends a
+batch until it gets an answer. A batch whose seq was already committed for
+the current boot is a retransmission - the device never saw our reply -
+and is acknowledged without being stored again. The last committed seq of
+every device is kept in upload_sequences so this survives a server restart.
+"""
+
+import threading
+
+SEQUENCES_SQL = """
+    CREATE TABLE IF NOT EXISTS upload_sequences (
+        device_id TEXT PRIMARY KEY,
+        boot TEXT NOT NULL,
+        seq INTEGER NOT NULL
+    )
+"""
+
+
+class SequenceTracker:
+    """
+    Last accepted (boot, seq) per device
+
+    claim() reserves a seq before its rows are written, so two copies of a
+    batch arriving together can't both be stored; release() gives it back
+    if the write fails and committed() records it once it is on disk.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        """Create the table if needed and read every device's last sequence"""
+        conn.execute(SEQUENCES_SQL)
+        conn.commit()
+        with self._lock:
+            for device, boot, seq in conn.execute(
+                    "SELECT device_id, boot, seq FROM upload_sequences"):
+                self._last[device] = (boot, seq)
+
+    def claim(self, device, boot, seq):
+        """
+        Reserve seq for device; returns the previous (boot, seq) to hand to
+        release(), or None if the batch was already accepted
+        """
+        boot = str(boot)
+        with self._lock:
+            previous = self._last.get(device)
+            if previous is not None and previous[0] == boot and seq <= previous[1]:
+                return None
+            self._last[device] = (boot, seq)
+            return previous or ("", -1)
+
+    def release(self, device, boot, seq, previous):
+        """Undo a claim whose rows were not stored, so the device's retry is accepted"""
+        with self._lock:
+            if self._last.get(device) == (str(boot), seq):
+                self._last[device] = previous
+
+    def committed(self, conn, device, boot, seq):
+        """Persist a claimed sequence once its rows are committed"""
+        with conn:
+            conn.execute("INSERT INTO upload_sequences (device_id, boot, seq) VALUES (?, ?, ?) "
+                         "ON CONFLICT(device_id) DO UPDATE SET boot = excluded.boot, "
+                         "seq = excluded.seq WHERE excluded.boot != upload_sequences.boot "
+                         "OR excluded.seq > upload_sequences.seq",
+                         (device, str(boot), seq))
+
+
+class ReceiveStamps:
+    """
+    Server receive times for readings that carry no time of their own
+
+    (device_id, ts) is the dedup key, so two such readings of one device
+    arriving in the same millisecond would store only the first; each
+    stamp is at least a millisecond after the device's previous one.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def stamp(self, device, received_ms):
+        with self._lock:
+            ts = max(received_ms, self._last.get(device, 0) + 1)
+            self._last[device] = ts
+            return ts